@@ -7,6 +7,7 @@ import subprocess
 import sys
 from pathlib import Path
 import central.generate_hcl_config as generate_hcl_config
+import central.hw_topology as hw_topology
 from central.multi_node_utils import run_cmd_as_subprocess
 from central.multi_node_utils import run_per_ip
 import socket
@@ -100,16 +101,9 @@ class TrainingRunner(object):
 
     def get_peval(self):
         """ get_peval """
-        cmd1 = "lscpu 2>/dev/null | awk '/Socket\(s\)/  { print $2 }'"
-        cmd2 = "lscpu 2>/dev/null | awk '/Core\(s\) per socket/  { print $4 }'"
-        with subprocess.Popen(cmd1, shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT) as proc:
-            lscpu_output1 = proc.stdout.read()
-        with subprocess.Popen(cmd2, shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT) as proc:
-            lscpu_output2 = proc.stdout.read()
-        sockets = int(lscpu_output1)
-        corespsocket = int(lscpu_output2)
+        topology = hw_topology.get_cpu_topology()
+        sockets = topology.sockets
+        corespsocket = len(topology.cores) // sockets
         if corespsocket == 1:  # running inside VM?
             print(f"Warning !! cores per socket is {corespsocket}. Running inside a VM?")
             print(f"Warning !! mapping by slot instead of socket")
@@ -127,7 +121,14 @@ class TrainingRunner(object):
     def setup_config_env_mpirun(self):
         peval, _, _ = self.get_peval()
         if peval:
-            map_cmd = f"--map-by {self.__map_by}:PE={peval}"
+            if self.__map_by == "numa":
+                map_cmd = f"--map-by {hw_topology.get_mpi_map_by('numa', self.__world_size)}"
+                # Only the numa mapping places the ranks in these blocks, otherwise see --report-bindings
+                for binding in hw_topology.get_rank_cpu_bindings(self.__world_size):
+                    print(f"local rank {binding.local_rank}: NUMA node {binding.numa_node}, "
+                          f"compute cores {binding.compute_cpus}, data loader cores {binding.dataloader_cpus}")
+            else:
+                map_cmd = f"--map-by {self.__map_by}:PE={peval}"
         return map_cmd
 
     def create_pt_no_mpi_setup(self):
@@ -211,7 +212,10 @@ class TrainingRunner(object):
         cmd += f"-x MASTER_PORT={__master_port} "
         cmd += f"--mca plm_rsh_args \"-p {__sshport}\" --bind-to core "
         cmd += f"-H {hls_info} -n {__world_size} "
-        if __process_per_socket > 0:
+        __numa_nodes = len(hw_topology.get_cpu_topology().numa_nodes)
+        if self.__map_by == "numa" and __per_node_processes % __numa_nodes == 0:
+            cmd += f"--map-by ppr:{__per_node_processes // __numa_nodes}:numa:PE={__pe_val} "
+        elif __process_per_socket > 0:
             cmd += f"--map-by ppr:{__process_per_socket}:socket:PE={__pe_val} "
         else:
             cmd += f"--map-by ppr:{__per_node_processes}:node:PE={__pe_val} "
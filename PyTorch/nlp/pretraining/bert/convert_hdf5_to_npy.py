@@ -0,0 +1,80 @@
+# coding=utf-8
+# Copyright (c) 2021, Habana Labs Ltd.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Convert pretraining HDF5 shards into flat, memory-mappable NumPy shards.
+
+Each output .npy file holds one structured array with a record per sample, so
+run_pretraining.py --dataset_format=npy can memory-map the shard and read a
+whole batch of samples without decompressing or copying the full file.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+KEYS = ['input_ids', 'input_mask', 'segment_ids', 'masked_lm_positions', 'masked_lm_ids',
+        'next_sentence_labels']
+
+
+def convert_file(input_file, output_file):
+    with h5py.File(input_file, "r") as f:
+        num_samples = len(f[KEYS[0]])
+        dtype = np.dtype([(key, f[key].dtype, f[key].shape[1:]) for key in KEYS])
+        records = np.lib.format.open_memmap(output_file + ".tmp", mode="w+", dtype=dtype,
+                                            shape=(num_samples,))
+        for key in KEYS:
+            records[key] = f[key][:]
+        records.flush()
+        del records
+    os.rename(output_file + ".tmp", output_file)
+    return output_file, num_samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The input directory holding the .hdf5 pretraining shards.")
+    parser.add_argument("--output_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The output directory where the .npy shards will be written.")
+    parser.add_argument("--num_workers",
+                        default=os.cpu_count(),
+                        type=int,
+                        help="Number of shards converted in parallel.")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    input_files = sorted(f for f in os.listdir(args.input_dir)
+                         if os.path.isfile(os.path.join(args.input_dir, f)) and f.endswith(".hdf5"))
+
+    with ProcessPoolExecutor(max(1, args.num_workers)) as pool:
+        futures = [pool.submit(convert_file, os.path.join(args.input_dir, f),
+                               os.path.join(args.output_dir, os.path.splitext(f)[0] + ".npy"))
+                   for f in input_files]
+        for future in futures:
+            output_file, num_samples = future.result()
+            print("Wrote {} samples to {}".format(num_samples, output_file))
+
+
+if __name__ == "__main__":
+    main()
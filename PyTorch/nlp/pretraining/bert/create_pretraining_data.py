@@ -18,6 +18,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import argparse
 import logging
+import multiprocessing
 import os
 import random
 from io import open
@@ -62,14 +63,22 @@ class TrainingInstance(object):
     return self.__str__()
 
 
-def write_instance_to_example_file(instances, tokenizer, max_seq_length,
-                                    max_predictions_per_seq, output_file):
-  """Create TF example files from `TrainingInstance`s."""
- 
+# HDF5 storage type of every feature written by this script
+FEATURE_DTYPES = collections.OrderedDict([
+    ("input_ids", 'i4'),
+    ("input_mask", 'i1'),
+    ("segment_ids", 'i1'),
+    ("masked_lm_positions", 'i4'),
+    ("masked_lm_ids", 'i4'),
+    ("next_sentence_labels", 'i1'),
+])
+
 
-  total_written = 0
+def instances_to_features(instances, tokenizer, max_seq_length,
+                          max_predictions_per_seq, show_progress=True):
+  """Converts `TrainingInstance`s into padded feature arrays."""
   features = collections.OrderedDict()
- 
+
   num_instances = len(instances)
   features["input_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
   features["input_mask"] = np.zeros([num_instances, max_seq_length], dtype="int32")
@@ -79,7 +88,7 @@ def write_instance_to_example_file(instances, tokenizer, max_seq_length,
   features["next_sentence_labels"] = np.zeros(num_instances, dtype="int32")
 
 
-  for inst_index, instance in enumerate(tqdm(instances)):
+  for inst_index, instance in enumerate(tqdm(instances, disable=not show_progress)):
     input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
     input_mask = [1] * len(input_ids)
     segment_ids = list(instance.segment_ids)
@@ -114,8 +123,6 @@ def write_instance_to_example_file(instances, tokenizer, max_seq_length,
     features["masked_lm_ids"][inst_index] = masked_lm_ids
     features["next_sentence_labels"][inst_index] = next_sentence_label
 
-    total_written += 1
-
     # if inst_index < 20:
     #   tf.logging.info("*** Example ***")
     #   tf.logging.info("tokens: %s" % " ".join(
@@ -131,22 +138,101 @@ def write_instance_to_example_file(instances, tokenizer, max_seq_length,
     #     tf.logging.info(
     #         "%s: %s" % (feature_name, " ".join([str(x) for x in values])))
 
- 
+  return features
+
+
+def write_instance_to_example_file(instances, tokenizer, max_seq_length,
+                                    max_predictions_per_seq, output_file):
+  """Create TF example files from `TrainingInstance`s."""
+  features = instances_to_features(instances, tokenizer, max_seq_length,
+                                   max_predictions_per_seq)
+
   print("saving data")
   f= h5py.File(output_file, 'w')
-  f.create_dataset("input_ids", data=features["input_ids"], dtype='i4', compression='gzip')
-  f.create_dataset("input_mask", data=features["input_mask"], dtype='i1', compression='gzip')
-  f.create_dataset("segment_ids", data=features["segment_ids"], dtype='i1', compression='gzip')
-  f.create_dataset("masked_lm_positions", data=features["masked_lm_positions"], dtype='i4', compression='gzip')
-  f.create_dataset("masked_lm_ids", data=features["masked_lm_ids"], dtype='i4', compression='gzip')
-  f.create_dataset("next_sentence_labels", data=features["next_sentence_labels"], dtype='i1', compression='gzip')
+  for name, dtype in FEATURE_DTYPES.items():
+    f.create_dataset(name, data=features[name], dtype=dtype, compression='gzip')
   f.flush()
   f.close()
 
-def create_training_instances(input_files, tokenizer, max_seq_length,
-                              dupe_factor, short_seq_prob, masked_lm_prob,
-                              max_predictions_per_seq, rng):
-  """Create `TrainingInstance`s from raw text."""
+
+class StreamingHDF5Writer(object):
+  """Appends `TrainingInstance`s to an HDF5 file in fixed-size chunks.
+
+  Instances are buffered until `chunk_size` of them are pending, shuffled with
+  `rng` and appended to resizable datasets, so memory stays bounded by one
+  chunk regardless of how many instances are written.
+  """
+
+  def __init__(self, output_file, tokenizer, max_seq_length,
+               max_predictions_per_seq, chunk_size, rng):
+    self.tokenizer = tokenizer
+    self.max_seq_length = max_seq_length
+    self.max_predictions_per_seq = max_predictions_per_seq
+    self.chunk_size = chunk_size
+    self.rng = rng
+    self.buffer = []
+    self.total_written = 0
+    self.f = h5py.File(output_file, 'w')
+    for name, dtype in FEATURE_DTYPES.items():
+      if name == "next_sentence_labels":
+        shape = ()
+      elif name in ("masked_lm_positions", "masked_lm_ids"):
+        shape = (max_predictions_per_seq,)
+      else:
+        shape = (max_seq_length,)
+      self.f.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                            chunks=(min(chunk_size, 1024),) + shape,
+                            dtype=dtype, compression='gzip')
+
+  def write(self, instances):
+    self.buffer.extend(instances)
+    if len(self.buffer) >= self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    if not self.buffer:
+      return
+    self.rng.shuffle(self.buffer)
+    features = instances_to_features(self.buffer, self.tokenizer, self.max_seq_length,
+                                     self.max_predictions_per_seq, show_progress=False)
+    start = self.total_written
+    self.total_written += len(self.buffer)
+    for name in FEATURE_DTYPES:
+      dataset = self.f[name]
+      dataset.resize(self.total_written, axis=0)
+      dataset[start:self.total_written] = features[name]
+    self.buffer = []
+
+  def close(self):
+    self.flush()
+    self.f.flush()
+    self.f.close()
+    return self.total_written
+
+
+def tokenize_lines(lines, tokenizer, documents=None):
+  """Tokenizes raw lines into a list of documents of tokenized sentences."""
+  if documents is None:
+    documents = [[]]
+  for line in lines:
+    line = tokenization.convert_to_unicode(line).strip()
+
+    # Empty lines are used as document delimiters
+    if not line:
+      documents.append([])
+    tokens = tokenizer.tokenize(line)
+    if tokens:
+      documents[-1].append(tokens)
+  return documents
+
+
+def read_documents(input_files, tokenizer, rng, pool=None, lines_per_block=10000):
+  """Reads and tokenizes the documents of `input_files` in a shuffled order.
+
+  With a `pool`, the lines are split into blocks at document boundaries and
+  tokenized by the pool workers; blocks are merged back in input order, so the
+  documents are the same as when tokenizing in a single process.
+  """
   all_documents = [[]]
 
   # Input file format:
@@ -158,22 +244,109 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
   for input_file in input_files:
     print("creating instance from {}".format(input_file))
     with open(input_file, "r") as reader:
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-
-        # Empty lines are used as document delimiters
-        if not line:
-          all_documents.append([])
-        tokens = tokenizer.tokenize(line)
-        if tokens:
-          all_documents[-1].append(tokens)
+      if pool is None:
+        tokenize_lines(reader, tokenizer, all_documents)
+        continue
+      blocks = [[]]
+      for line in reader:
+        # start a new block only on a document delimiter
+        if len(blocks[-1]) >= lines_per_block and not line.strip():
+          blocks.append([])
+        blocks[-1].append(line)
+      for documents in pool.imap(_tokenize_block, blocks):
+        # as in the single process path, the lines before the first delimiter
+        # of a block continue the last document, even across files
+        all_documents[-1].extend(documents[0])
+        all_documents.extend(documents[1:])
 
   # Remove empty documents
   all_documents = [x for x in all_documents if x]
   rng.shuffle(all_documents)
+  return all_documents
+
+
+# State shared with the pool workers of the parallel mode, set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(state):
+  _worker_state.update(state)
+
+
+def _tokenize_block(lines):
+  return tokenize_lines(lines, _worker_state["tokenizer"])
+
+
+def _document_rng(random_seed, dupe_index, document_index):
+  # seeding from a string is stable across processes and Python runs
+  return random.Random("{}-{}-{}".format(random_seed, dupe_index, document_index))
+
+
+def _write_document_range(worker_index, start, end, output_file):
+  state = _worker_state
+  writer = StreamingHDF5Writer(
+      output_file, state["tokenizer"], state["max_seq_length"],
+      state["max_predictions_per_seq"], state["chunk_size"],
+      random.Random("{}-shuffle-{}".format(state["random_seed"], worker_index)))
+  vocab_words = list(state["tokenizer"].vocab.keys())
+  for dupe_index in range(state["dupe_factor"]):
+    for document_index in range(start, end):
+      writer.write(create_instances_from_document(
+          state["all_documents"], document_index, state["max_seq_length"],
+          state["short_seq_prob"], state["masked_lm_prob"],
+          state["max_predictions_per_seq"], vocab_words,
+          _document_rng(state["random_seed"], dupe_index, document_index)))
+  return output_file, writer.close()
+
+
+def create_training_files_parallel(input_files, tokenizer, output_file,
+                                   max_seq_length, dupe_factor, short_seq_prob,
+                                   masked_lm_prob, max_predictions_per_seq,
+                                   random_seed, num_workers, chunk_size):
+  """Creates the HDF5 output with a pool of `num_workers` processes.
+
+  The shuffled documents are split into `num_workers` contiguous ranges and
+  every worker streams the instances of its range into its own output file.
+  Each document draws from its own generator seeded by `random_seed`, the dupe
+  index and the document index, so the output only depends on the seed and
+  `num_workers`.
+  """
+  rng = random.Random(random_seed)
+  with multiprocessing.Pool(num_workers, _init_worker, ({"tokenizer": tokenizer},)) as pool:
+    all_documents = read_documents(input_files, tokenizer, rng, pool=pool)
+
+  state = {
+      "all_documents": all_documents,
+      "tokenizer": tokenizer,
+      "max_seq_length": max_seq_length,
+      "dupe_factor": dupe_factor,
+      "short_seq_prob": short_seq_prob,
+      "masked_lm_prob": masked_lm_prob,
+      "max_predictions_per_seq": max_predictions_per_seq,
+      "random_seed": random_seed,
+      "chunk_size": chunk_size,
+  }
+  if num_workers == 1:
+    output_files = [output_file]
+  else:
+    root, ext = os.path.splitext(output_file)
+    output_files = ["{}_part{}{}".format(root, i, ext) for i in range(num_workers)]
+  bounds = [len(all_documents) * i // num_workers for i in range(num_workers + 1)]
+
+  with multiprocessing.Pool(num_workers, _init_worker, (state,)) as pool:
+    results = pool.starmap(_write_document_range,
+                           [(i, bounds[i], bounds[i + 1], output_files[i])
+                            for i in range(num_workers)])
+  for path, num_written in results:
+    print("wrote {} instances to {}".format(num_written, path))
+  return results
+
+
+def create_training_instances(input_files, tokenizer, max_seq_length,
+                              dupe_factor, short_seq_prob, masked_lm_prob,
+                              max_predictions_per_seq, rng):
+  """Create `TrainingInstance`s from raw text."""
+  all_documents = read_documents(input_files, tokenizer, rng)
 
   vocab_words = list(tokenizer.vocab.keys())
   instances = []
@@ -446,6 +619,17 @@ def main():
                         type=int,
                         default=12345,
                         help="random seed for initialization")
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=0,
+                        help="Number of processes used to create the instances. 0 builds every instance in memory "
+                             "in a single process; otherwise the documents are split across the workers, each "
+                             "streaming to its own output file (suffixed with _part<i> when more than one).")
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=10000,
+                        help="Number of instances buffered, shuffled and written at once per worker "
+                             "when --num_workers is set.")
 
     args = parser.parse_args()
 
@@ -459,6 +643,14 @@ def main():
     else:
       raise ValueError("{} is not a valid path".format(args.input_file))
 
+    if args.num_workers > 0:
+      create_training_files_parallel(
+          input_files, tokenizer, args.output_file, args.max_seq_length,
+          args.dupe_factor, args.short_seq_prob, args.masked_lm_prob,
+          args.max_predictions_per_seq, args.random_seed, args.num_workers,
+          args.chunk_size)
+      return
+
     rng = random.Random(args.random_seed)
     instances = create_training_instances(
         input_files, tokenizer, args.max_seq_length, args.dupe_factor,
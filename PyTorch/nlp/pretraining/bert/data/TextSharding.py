@@ -14,6 +14,7 @@
 from collections import defaultdict
 from itertools import islice
 
+import heapq
 import multiprocessing
 import statistics
 
@@ -43,17 +44,20 @@ class Sharding:
 
 
     # Remember, the input files contain one article per line (the whitespace check is to skip extraneous blank lines)
-    def load_articles(self):
-        print('Start: Loading Articles')
-
-        global_article_count = 0
+    def iter_articles(self):
         for input_file in self.input_files:
             print('input file:', input_file)
             with open(input_file, mode='r', newline='\n') as f:
-                for i, line in enumerate(f):
+                for line in f:
                     if line.strip():
-                        self.articles[global_article_count] = line.rstrip()
-                        global_article_count += 1
+                        yield line.rstrip()
+
+
+    def load_articles(self):
+        print('Start: Loading Articles')
+
+        for global_article_count, article in enumerate(self.iter_articles()):
+            self.articles[global_article_count] = article
 
         print('End: Loading Articles: There are', len(self.articles), 'articles.')
 
@@ -294,6 +298,98 @@ class Sharding:
         print('End: Distribute Articles Over Shards')
 
 
+    def stream_articles_into_shards(self, segmenter, n_processes=1, window_size=10000,
+                                    max_buffered_bytes=256 * 1024 * 1024):
+        """Segments, balances and writes the articles in a single streaming pass.
+
+        Unlike load_articles, segment_articles_into_sentences, distribute_articles_over_shards and
+        write_shards_to_disk, the corpus is never held in memory. Articles are taken in windows of
+        window_size, largest first, and each goes to the shard with the fewest sentences so far,
+        found with a min-heap per split in O(log k). An article is routed to the test split whenever
+        that split is below fraction_test_set of the sentences seen. Shard contents are buffered and
+        appended to disk once max_buffered_bytes are pending.
+        """
+        print('Start: Stream Articles Into Shards')
+
+        training_names = list(self.output_training_files)
+        test_names = list(self.output_test_files)
+        # heap entries are (sentences in shard, shard index), so ties go to the lowest index
+        training_heap = [(0, i) for i in range(len(training_names))]
+        test_heap = [(0, i) for i in range(len(test_names))]
+        training_buffers = [[] for _ in training_names]
+        test_buffers = [[] for _ in test_names]
+
+        for name in training_names + test_names:
+            open(name, mode='w', newline='\n').close()
+
+        def flush():
+            for names, buffers in ((training_names, training_buffers), (test_names, test_buffers)):
+                for name, buffer in zip(names, buffers):
+                    if buffer:
+                        with open(name, mode='a', newline='\n') as f:
+                            f.write(''.join(buffer))
+                        del buffer[:]
+
+        counters = {'sentences': 0, 'test_sentences': 0, 'buffered_bytes': 0}
+
+        def assign(window):
+            # largest first keeps the shards within the size of the smaller articles of each other
+            window.sort(key=len, reverse=True)
+            for sentences in window:
+                n_sentences = len(sentences)
+                counters['sentences'] += n_sentences
+                if counters['test_sentences'] < self.fraction_test_set * counters['sentences']:
+                    heap, buffers = test_heap, test_buffers
+                    counters['test_sentences'] += n_sentences
+                else:
+                    heap, buffers = training_heap, training_buffers
+
+                count, shard_index = heap[0]
+                heapq.heapreplace(heap, (count + n_sentences, shard_index))
+
+                text = ''.join(line + '\n' for line in sentences) + '\n'    # Line break between articles
+                buffers[shard_index].append(text)
+                counters['buffered_bytes'] += len(text)
+                if counters['buffered_bytes'] >= max_buffered_bytes:
+                    flush()
+                    counters['buffered_bytes'] = 0
+
+        pool = multiprocessing.Pool(n_processes) if n_processes > 1 else None
+        try:
+            if pool is not None:
+                segmented = pool.imap(segmenter.segment_string, self.iter_articles(), chunksize=256)
+            else:
+                segmented = map(segmenter.segment_string, self.iter_articles())
+
+            n_articles = 0
+            window = []
+            for sentences in segmented:
+                window.append(sentences)
+                if len(window) == window_size:
+                    assign(window)
+                    window = []
+
+                n_articles += 1
+                if n_articles % 100000 == 0:
+                    print('Streaming article', n_articles)
+            assign(window)
+            flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        assert n_articles >= self.n_training_shards + self.n_test_shards, 'There are fewer articles than shards. Please add more data or reduce the number of shards requested.'
+
+        for count, _ in sorted(training_heap, key=lambda entry: entry[1]):
+            print('Training shard:', count)
+
+        for count, _ in sorted(test_heap, key=lambda entry: entry[1]):
+            print('Test shard:', count)
+
+        print('End: Stream Articles Into Shards: There are', n_articles, 'articles.')
+
+
     def write_shards_to_disk(self):
         print('Start: Write Shards to Disk')
         for shard in self.output_training_files:
@@ -0,0 +1,102 @@
+# Copyright (c) 2021, Habana Labs Ltd.  All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the in-memory and the streaming sharding of TextSharding.Sharding on a synthetic
+# one-article-per-line corpus. Sentences are split on '. ' so that the timings measure
+# the balancing and the I/O rather than NLTK.
+
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import TextSharding
+
+
+class PeriodSegmenter:
+    def segment_string(self, article):
+        return article.split('. ')
+
+
+def write_synthetic_corpus(path, n_articles, seed):
+    rng = random.Random(seed)
+    words = ['word{}'.format(i) for i in range(1000)]
+    with open(path, mode='w', newline='\n') as f:
+        for _ in range(n_articles):
+            # long-tailed article lengths, like Wikipedia
+            n_sentences = min(1 + int(rng.paretovariate(1.2)), 2000)
+            sentences = [' '.join(rng.choice(words) for _ in range(rng.randint(5, 25)))
+                         for _ in range(n_sentences)]
+            f.write('. '.join(sentences) + '\n')
+
+
+def run_method(method, input_file, output_dir, args, results):
+    prefix = os.path.join(output_dir, method)
+    sharding = TextSharding.Sharding([input_file], prefix, args.n_training_shards, args.n_test_shards,
+                                     args.fraction_test_set)
+    segmenter = PeriodSegmenter()
+    start = time.time()
+    if method == 'streaming':
+        sharding.stream_articles_into_shards(segmenter, n_processes=args.n_processes)
+    else:
+        sharding.load_articles()
+        sharding.segment_articles_into_sentences(segmenter)
+        sharding.distribute_articles_over_shards()
+        sharding.write_shards_to_disk()
+    elapsed = time.time() - start
+
+    counts = []
+    for name in list(sharding.output_training_files):
+        with open(name) as f:
+            counts.append(sum(1 for line in f if line.strip()))
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results[method] = (elapsed, peak_rss_mb, min(counts), max(counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the BERT text sharding methods')
+    parser.add_argument('--n_articles', type=int, default=100000)
+    parser.add_argument('--n_training_shards', type=int, default=256)
+    parser.add_argument('--n_test_shards', type=int, default=256)
+    parser.add_argument('--fraction_test_set', type=float, default=0.1)
+    parser.add_argument('--n_processes', type=int, default=1)
+    parser.add_argument('--methods', type=str, default='in_memory,streaming')
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_file = os.path.join(work_dir, 'synthetic_one_article_per_line.txt')
+        write_synthetic_corpus(input_file, args.n_articles, args.seed)
+
+        results = multiprocessing.Manager().dict()
+        for method in args.methods.split(','):
+            # run every method in its own process so peak RSS is measured separately
+            p = multiprocessing.Process(target=run_method, args=(method, input_file, work_dir, args, results))
+            p.start()
+            p.join()
+
+        print('{:>10} {:>10} {:>14} {:>22}'.format('method', 'time (s)', 'peak RSS (MB)', 'training shard min/max'))
+        for method, (elapsed, peak_rss_mb, min_count, max_count) in results.items():
+            print('{:>10} {:>10.2f} {:>14.1f} {:>22}'.format(method, elapsed, peak_rss_mb,
+                                                              '{}/{}'.format(min_count, max_count)))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -133,10 +133,13 @@ def main(args):
             segmenter = TextSharding.NLTKSegmenter()
             sharding = TextSharding.Sharding(args.input_files, output_file_prefix, args.n_training_shards, args.n_test_shards, args.fraction_test_set)
 
-            sharding.load_articles()
-            sharding.segment_articles_into_sentences(segmenter)
-            sharding.distribute_articles_over_shards()
-            sharding.write_shards_to_disk()
+            if args.sharding_method == 'streaming':
+                sharding.stream_articles_into_shards(segmenter, n_processes=args.n_processes)
+            else:
+                sharding.load_articles()
+                sharding.segment_articles_into_sentences(segmenter)
+                sharding.distribute_articles_over_shards()
+                sharding.write_shards_to_disk()
 
         else:
             assert False, 'Unsupported dataset for sharding'
@@ -290,6 +293,17 @@ if __name__ == "__main__":
         default='nltk'
     )
 
+    parser.add_argument(
+        '--sharding_method',
+        type=str,
+        help='Specify how articles are balanced over shards: in memory, or streamed to disk with a heap-based balancer',
+        choices={
+            'in_memory',
+            'streaming'
+        },
+        default='in_memory'
+    )
+
     parser.add_argument(
         '--n_processes',
         type=int,
@@ -32,7 +32,7 @@ from tqdm import tqdm, trange
 import os
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Dataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, BatchSampler, Dataset
 from torch.utils.data.distributed import DistributedSampler
 import math
 import multiprocessing
@@ -64,7 +64,13 @@ except ImportError:
 from lamb import NVLAMB
 
 import dllogger
-from concurrent.futures import ProcessPoolExecutor
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import central.hw_topology as hw_topology
+except ImportError:
+    hw_topology = None
 
 torch._C._jit_set_profiling_mode(False)
 torch._C._jit_set_profiling_executor(False)
@@ -85,13 +91,28 @@ signal.signal(signal.SIGTERM, signal_handler)
 
 #Workaround because python functions are not picklable
 class WorkerInitObj(object):
-    def __init__(self, seed):
+    def __init__(self, seed, bind_workers=False):
         self.seed = seed
+        self.bind_workers = bind_workers
     def __call__(self, id):
         np.random.seed(seed=self.seed + id)
         random.seed(self.seed + id)
+        if self.bind_workers:
+            # pin the worker to the data loader cores of its local rank
+            hw_topology.bind_dataloader_worker()
 
 def create_pretraining_dataset(input_file, max_pred_length, shared_list, args, worker_init):
+    if args.dataset_format == 'npy':
+        # the dataset reads a whole batch per index list, so batching is done by the sampler
+        train_data = pretraining_mmap_dataset(input_file=input_file, max_pred_length=max_pred_length)
+        train_sampler = BatchSampler(RandomSampler(train_data),
+                                     batch_size=args.train_batch_size * args.n_pu,
+                                     drop_last=False)
+        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=None,
+                                      num_workers=4, worker_init_fn=worker_init,
+                                      pin_memory=True)
+        return train_dataloader, input_file
+
     train_data = pretraining_dataset(input_file=input_file, max_pred_length=max_pred_length)
     train_sampler = RandomSampler(train_data)
     train_dataloader = DataLoader(train_data, sampler=train_sampler,
@@ -100,6 +121,53 @@ def create_pretraining_dataset(input_file, max_pred_length, shared_list, args, w
                                   pin_memory=True)
     return train_dataloader, input_file
 
+class ShardPrefetcher(object):
+    """Builds the DataLoaders of upcoming shards in the background.
+
+    Up to `depth` shards are read ahead of the one being trained on. Loading runs
+    in threads so it works the same way on HPU, GPU and CPU, and the DataLoader
+    does not have to be pickled back from a worker process. `wait_time` holds the
+    total number of seconds get() blocked on a shard that was not ready yet.
+    """
+
+    def __init__(self, data_files, depth, max_pred_length, args, worker_init):
+        self.data_files = iter(data_files)
+        self.depth = depth
+        self.max_pred_length = max_pred_length
+        self.args = args
+        self.worker_init = worker_init
+        self.wait_time = 0.0
+        self.pending = collections.deque()
+        self.executor = ThreadPoolExecutor(max_workers=depth) if depth > 0 else None
+        for _ in range(depth):
+            self._submit_next()
+
+    def _submit_next(self):
+        data_file = next(self.data_files, None)
+        if data_file is not None:
+            self.pending.append(self.executor.submit(create_pretraining_dataset, data_file,
+                                                     self.max_pred_length, None, self.args,
+                                                     self.worker_init))
+
+    def get(self):
+        start = time.time()
+        if self.executor is None:
+            result = create_pretraining_dataset(next(self.data_files), self.max_pred_length,
+                                                None, self.args, self.worker_init)
+        else:
+            result = self.pending.popleft().result(timeout=None)
+            self._submit_next()
+        self.wait_time += time.time() - start
+        return result
+
+    def shutdown(self):
+        if self.executor is None:
+            return
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
 class pretraining_dataset(Dataset):
 
     def __init__(self, input_file, max_pred_length):
@@ -132,6 +200,51 @@ class pretraining_dataset(Dataset):
         return [input_ids, segment_ids, input_mask,
                 masked_lm_labels, next_sentence_labels]
 
+class pretraining_mmap_dataset(Dataset):
+    """Memory-mapped view of a shard written by convert_hdf5_to_npy.py.
+
+    Indexing takes a list of sample indices and returns the whole batch, so only
+    the rows of the batch are read from the page cache. The shard is mapped
+    lazily, which keeps DataLoader workers from pickling the array.
+    """
+
+    def __init__(self, input_file, max_pred_length):
+        self.input_file = input_file
+        self.max_pred_length = max_pred_length
+        self.records = None
+        self.num_samples = len(np.load(input_file, mmap_mode='r'))
+
+    def __len__(self):
+        'Denotes the total number of samples'
+        return self.num_samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['records'] = None
+        return state
+
+    def __getitem__(self, indices):
+        if self.records is None:
+            self.records = np.load(self.input_file, mmap_mode='r')
+        # sorted indices turn the gather into a forward scan over the mapping
+        batch = self.records[np.sort(np.asarray(indices))]
+
+        input_ids = batch['input_ids'].astype(np.int64)
+        # as in pretraining_dataset, at most max_pred_length predictions per sample
+        masked_lm_positions = batch['masked_lm_positions'][:, :self.max_pred_length]
+        masked_lm_ids = batch['masked_lm_ids'][:, :self.max_pred_length]
+
+        # only the predictions before the first zero position are valid
+        valid = np.cumprod(masked_lm_positions != 0, axis=1).astype(bool)
+        masked_lm_labels = np.full(input_ids.shape, -1, dtype=np.int64)
+        masked_lm_labels[np.nonzero(valid)[0], masked_lm_positions[valid]] = masked_lm_ids[valid]
+
+        return [torch.from_numpy(input_ids),
+                torch.from_numpy(batch['segment_ids'].astype(np.int64)),
+                torch.from_numpy(batch['input_mask'].astype(np.int64)),
+                torch.from_numpy(masked_lm_labels),
+                torch.from_numpy(batch['next_sentence_labels'].astype(np.int64))]
+
 class BertPretrainingCriterion(torch.nn.Module):
     def __init__(self, vocab_size):
         super(BertPretrainingCriterion, self).__init__()
@@ -318,14 +431,35 @@ def parse_arguments():
     parser.add_argument("--use_lazy_mode",
                         action='store_true',
                         help='run model in lazy execution mode')
+    parser.add_argument('--prefetch_depth',
+                        type=int,
+                        default=1,
+                        help="Number of upcoming data shards to load in the background while training. "
+                             "Each prefetched shard is held in host memory; 0 loads shards synchronously.")
+    parser.add_argument('--dataset_format',
+                        default='hdf5',
+                        choices=['hdf5', 'npy'],
+                        help="Format of the shards in input_dir. 'npy' memory-maps shards produced by "
+                             "convert_hdf5_to_npy.py and builds each batch in a single pass.")
+    parser.add_argument('--bind_dataloader_workers',
+                        action='store_true',
+                        help="Pin the data loader workers to the NUMA-local data loader cores of their local "
+                             "rank, as computed by central/hw_topology.py. Requires the repository root in "
+                             "PYTHONPATH.")
 
     args = parser.parse_args()
     args.fp16 = args.fp16 or args.amp
 
+    if args.bind_dataloader_workers and hw_topology is None:
+        raise ValueError("--bind_dataloader_workers requires the repository root in PYTHONPATH")
+
 
     if args.steps_this_run < 0:
         args.steps_this_run = args.max_steps
 
+    if args.prefetch_depth < 0:
+        raise ValueError("Invalid prefetch_depth parameter: {}, should be >= 0".format(args.prefetch_depth))
+
     return args
 
 def unflatten_tensor(flat, tensor_list):
@@ -680,7 +814,7 @@ def main():
     np.random.seed(args.seed + args.local_rank)
     torch.manual_seed(args.seed + args.local_rank)
     torch.cuda.manual_seed(args.seed + args.local_rank)
-    worker_init = WorkerInitObj(args.seed + args.local_rank)
+    worker_init = WorkerInitObj(args.seed + args.local_rank, args.bind_dataloader_workers)
     device, args = setup_training(args)
 
 
@@ -714,9 +848,9 @@ def main():
         average_training_time_per_step = 0
         average_perf_per_step = 0
         loss_list = []
+        # time the step loop spent blocked on the next batch or the next shard
+        data_wait_time = 0.0
 
-        if device.type == 'cuda':
-            pool = ProcessPoolExecutor(1)
         starting_time = time.time()
         # Note: We loop infinitely over epochs, termination is handled via iteration count
         while True:
@@ -724,7 +858,8 @@ def main():
             restored_data_loader = None
             if not args.resume_from_checkpoint or epoch > 0 or (args.phase2 and global_step < 1) or args.init_checkpoint:
                 files = [os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir) if
-                         os.path.isfile(os.path.join(args.input_dir, f)) and 'training' in f]
+                         os.path.isfile(os.path.join(args.input_dir, f)) and 'training' in f and
+                         (args.dataset_format != 'npy' or f.endswith('.npy'))]
                 files.sort()
                 num_files = len(files)
                 random.Random(args.seed + epoch).shuffle(files)
@@ -749,13 +884,8 @@ def main():
             previous_file = data_file
 
             if restored_data_loader is None:
-                train_data = pretraining_dataset(data_file, args.max_predictions_per_seq)
-                train_sampler = RandomSampler(train_data)
-                train_dataloader = DataLoader(train_data, sampler=train_sampler,
-                                              batch_size=args.train_batch_size * args.n_pu,
-                                              num_workers=4, worker_init_fn=worker_init,
-                                              pin_memory=True)
-                # shared_file_list["0"] = (train_dataloader, data_file)
+                train_dataloader, _ = create_pretraining_dataset(data_file, args.max_predictions_per_seq,
+                                                                 shared_file_list, args, worker_init)
             else:
                 train_dataloader = restored_data_loader
                 restored_data_loader = None
@@ -764,24 +894,27 @@ def main():
             if args.allreduce_post_accumulation and not args.use_habana:
                 overflow_buf = torch.cuda.IntTensor([0])
 
+            next_data_files = []
             for f_id in range(f_start_id + 1 , len(files)):
-
-
                 if get_world_size() > num_files:
-                    data_file = files[(f_id*get_world_size()+get_rank() + remainder*f_id)%num_files]
+                    next_data_files.append(files[(f_id*get_world_size()+get_rank() + remainder*f_id)%num_files])
                 else:
-                    data_file = files[(f_id*get_world_size()+get_rank())%num_files]
+                    next_data_files.append(files[(f_id*get_world_size()+get_rank())%num_files])
+            prefetcher = ShardPrefetcher(next_data_files, args.prefetch_depth,
+                                         args.max_predictions_per_seq, args, worker_init)
 
-                previous_file = data_file
+            for f_id in range(f_start_id + 1 , len(files)):
 
-                if device.type == 'cuda':
-                    dataset_future = pool.submit(create_pretraining_dataset, data_file, args.max_predictions_per_seq, shared_file_list, args, worker_init)
+                data_file = next_data_files[f_id - f_start_id - 1]
+                previous_file = data_file
 
                 train_iter = tqdm(train_dataloader, desc="Iteration", disable=args.disable_progress_bar) if is_main_process() else train_dataloader
 
                 if raw_train_start is None:
                     raw_train_start = time.time()
+                data_wait_start = time.time()
                 for step, batch in enumerate(train_iter):
+                    data_wait_time += time.time() - data_wait_start
 
                     training_steps += 1
 
@@ -857,14 +990,16 @@ def main():
                         if is_main_process():
                             dllogger.log(step=(epoch, global_step, ), data={"final_loss": final_loss,
                                                                             "average_training_time_step": average_training_time_per_step,
-                                                                            "average_perf_per_step": average_perf_per_step})
+                                                                            "average_perf_per_step": average_perf_per_step,
+                                                                            "data_wait_time": data_wait_time + prefetcher.wait_time})
                     elif training_steps % (args.log_freq * args.gradient_accumulation_steps) == 0:
                         if is_main_process():
                             dllogger.log(step=(epoch, global_step, ), data={"average_loss": average_loss / (args.log_freq * divisor),
                                                                             "step_loss": loss.item() * args.gradient_accumulation_steps / divisor,
                                                                             "learning_rate": optimizer.param_groups[0]['lr'],
                                                                             "average_training_time_step": average_training_time_per_step,
-                                                                            "average_perf_per_step": average_perf_per_step})
+                                                                            "average_perf_per_step": average_perf_per_step,
+                                                                            "data_wait_time": data_wait_time + prefetcher.wait_time})
                         average_loss = 0
 
 
@@ -933,18 +1068,17 @@ def main():
                         # timeout from the cluster scheduler
                         if global_step >= args.steps_this_run or timeout_sent:
                             del train_dataloader
-                            # thread.join()
+                            prefetcher.shutdown()
                             return args, final_loss, train_time_raw, global_step
 
+                    data_wait_start = time.time()
+
                 del train_dataloader
-                # thread.join()
-                # Make sure pool has finished and switch train_dataloader
-                # NOTE: Will block until complete
-                if device.type == 'cuda':
-                    train_dataloader, data_file = dataset_future.result(timeout=None)
-                else:
-                    train_dataloader, data_file = create_pretraining_dataset(data_file, args.max_predictions_per_seq, shared_file_list, args, worker_init)
+                # Switch to the prefetched train_dataloader
+                # NOTE: Will block until the shard is loaded
+                train_dataloader, data_file = prefetcher.get()
 
+            prefetcher.shutdown()
             epoch += 1
     if args.use_lazy_mode:
         os.environ.pop("PT_HPU_LAZY_MODE")
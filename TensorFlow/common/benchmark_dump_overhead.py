@@ -0,0 +1,107 @@
+###############################################################################
+# Copyright (C) 2021 Habana Labs, Ltd. an Intel Company
+###############################################################################
+"""
+Measures the step time overhead of tensor dumping (TensorFlow/common/debug.py).
+
+Trains a small MLP with a tf.function training step without dumping, with
+dumping on every step and with the sampled mode, and prints the mean step time
+and the overhead relative to the run without dumping.
+
+    python3 -m TensorFlow.common.benchmark_dump_overhead --steps 2000 --dump_every_n_steps 100
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import tensorflow as tf
+
+from TensorFlow.common.debug import dump_callback
+
+
+def run(steps, batch_size, hidden_size, config=None):
+    with (dump_callback(config) if config else _NoDump()):
+        model = tf.keras.Sequential([
+            tf.keras.layers.Dense(hidden_size, activation='relu', name='dense_1'),
+            tf.keras.layers.Dense(hidden_size, activation='relu', name='dense_2'),
+            tf.keras.layers.Dense(10, name='logits'),
+        ])
+        optimizer = tf.keras.optimizers.SGD(0.01)
+        loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+        features = tf.random.normal([batch_size, hidden_size])
+        labels = tf.random.uniform([batch_size], maxval=10, dtype=tf.int32)
+
+        @tf.function
+        def train_step():
+            with tf.GradientTape() as tape:
+                loss = loss_fn(labels, model(features, training=True))
+            grads = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return loss
+
+        # tracing and warmup
+        for _ in range(10):
+            train_step()
+        start = time.perf_counter()
+        for _ in range(steps):
+            loss = train_step()
+        loss.numpy()
+        return (time.perf_counter() - start) / steps
+
+
+class _NoDump(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--hidden_size', type=int, default=1024)
+    parser.add_argument('--op_regex', type=str, default='.*(MatMul|Relu).*')
+    parser.add_argument('--tensor_debug_mode', type=str, default='FULL_TENSOR')
+    parser.add_argument('--dump_every_n_steps', type=int, default=100)
+    parser.add_argument('--max_bytes_per_rank', type=int, default=1 << 30)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        base_config = {
+            "tensor_debug_mode": args.tensor_debug_mode,
+            "circular_buffer_size": 1000,
+            "op_regex": args.op_regex,
+        }
+        configs = {
+            'none': None,
+            'every_step': dict(base_config),
+            'sampled': dict(base_config, dump_every_n_steps=args.dump_every_n_steps,
+                            max_bytes_per_rank=args.max_bytes_per_rank),
+        }
+        results = {}
+        for name, config in configs.items():
+            config_file = None
+            if config is not None:
+                config["dump_root"] = os.path.join(work_dir, name)
+                config_file = os.path.join(work_dir, name + '.json')
+                with open(config_file, 'w') as f:
+                    json.dump(config, f)
+            results[name] = run(args.steps, args.batch_size, args.hidden_size, config_file)
+
+        print('{:>12} {:>14} {:>10}'.format('mode', 'step time (ms)', 'overhead'))
+        for name, step_time in results.items():
+            overhead = 100. * (step_time / results['none'] - 1.)
+            print('{:>12} {:>14.3f} {:>9.1f}%'.format(name, 1000. * step_time, overhead))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,10 +22,13 @@ from tensorflow.core.protobuf import debug_event_pb2
 from tensorflow.python.debug.lib import debug_events_writer
 from tensorflow.python.framework import op_callbacks
 from tensorflow.python.ops import gen_debug_ops
+import numpy as np
 import tensorflow as tf
 import re
 import os
 import json
+import threading
+import weakref
 from TensorFlow.common.horovod_helpers import horovod_enabled, hvd_rank
 
 
@@ -34,7 +37,29 @@ flags.DEFINE_string(name='dump_config', default=None,
 
 
 class _DumpCallback(object):
-    def __init__(self, dump_root, tensor_debug_mode, circular_buffer_size, op_regex, output_regex=None):
+    """
+    Dumps the outputs of the ops matching op_regex (and output_regex) with DebugIdentityV2.
+
+    By default every matching op is dumped on every step. Setting any of the
+    sampling options in the config switches to the sampled mode, in which each
+    dump op is guarded by a host-side gate evaluated once per step:
+      dump_every_n_steps: dump only every Nth step,
+      dump_steps: [first, last) - dump only steps in this window,
+      max_bytes_per_rank: stop dumping once the rank's dump files reach this size,
+      flush_interval_secs: period of the flush thread (default 10 when a budget
+        is set).
+    Steps are counted by the executions of the first graph (or, eagerly, the
+    first op) in which a dump op was added.
+
+    The DebugIdentityV2 ops still write synchronously in the step. The flush
+    thread only flushes the DebugEventsWriter and then checks the size of the
+    rank's dump files against max_bytes_per_rank. The budget is therefore not
+    exact: a rank can overshoot it by what it dumps in one flush interval, and
+    lower flush_interval_secs bounds the overshoot more tightly.
+    """
+
+    def __init__(self, dump_root, tensor_debug_mode, circular_buffer_size, op_regex, output_regex=None,
+                 dump_every_n_steps=None, dump_steps=None, max_bytes_per_rank=None, flush_interval_secs=None):
         self._dump_root = dump_root
         if horovod_enabled():
             self._dump_root = os.path.join(
@@ -49,6 +74,23 @@ class _DumpCallback(object):
         self._tfdbg_run_id = ''
         self._dump_op_counter = 0
 
+        self._dump_every_n_steps = dump_every_n_steps
+        self._dump_steps = tuple(dump_steps) if dump_steps is not None else None
+        self._max_bytes_per_rank = max_bytes_per_rank
+        if flush_interval_secs is None and max_bytes_per_rank is not None:
+            flush_interval_secs = 10
+        self._flush_interval_secs = flush_interval_secs
+        self._sampled = any(option is not None for option in (
+            dump_every_n_steps, dump_steps, max_bytes_per_rank))
+        self._lock = threading.Lock()
+        self._step = -1
+        self._budget_exceeded = False
+        self._gates = weakref.WeakKeyDictionary()
+        self._step_gate_key = None
+        self._adding_dump_ops = False
+        self._flush_stop = threading.Event()
+        self._flush_thread = None
+
         debug_writer_args = {
             "dump_root": self._dump_root,
             "circular_buffer_size": self._circular_buffer_size
@@ -60,7 +102,65 @@ class _DumpCallback(object):
         self._writer = debug_events_writer.DebugEventsWriter(
             **debug_writer_args)
 
+    def _should_dump(self, count_step):
+        with self._lock:
+            if count_step:
+                self._step += 1
+            if self._budget_exceeded:
+                return False
+            if self._dump_steps is not None and not (self._dump_steps[0] <= self._step < self._dump_steps[1]):
+                return False
+            if self._dump_every_n_steps is not None and self._step % self._dump_every_n_steps != 0:
+                return False
+            return True
+
+    def _gate(self, op_name, graph):
+        """ Returns the predicate guarding the dump ops of op_name in the sampled mode. """
+        if graph is None:
+            # eager: the first dumped op marks the steps
+            if self._step_gate_key is None:
+                self._step_gate_key = op_name
+            return self._should_dump(op_name == self._step_gate_key)
+
+        if graph not in self._gates:
+            if self._step_gate_key is None:
+                self._step_gate_key = id(graph)
+            count_step = self._step_gate_key == id(graph)
+            gate = tf.numpy_function(
+                lambda: np.array(self._should_dump(count_step)), [], tf.bool, name="dump_gate")
+            self._gates[graph] = tf.reshape(gate, [])
+        return self._gates[graph]
+
+    def _dump_bytes(self):
+        total = 0
+        for root, _, files in os.walk(self._dump_root):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _flush_loop(self):
+        while not self._flush_stop.wait(self._flush_interval_secs):
+            self._flush()
+
+    def _flush(self):
+        self._writer.FlushNonExecutionFiles()
+        self._writer.FlushExecutionFiles()
+        # Checked only after a flush, as the file sizes are exact then.
+        if self._max_bytes_per_rank is not None and not self._budget_exceeded:
+            dump_bytes = self._dump_bytes()
+            if dump_bytes >= self._max_bytes_per_rank:
+                with self._lock:
+                    self._budget_exceeded = True
+                logging.info("Tensor dump budget of %d bytes exceeded (%d bytes at step %d), dumping stopped" % (
+                    self._max_bytes_per_rank, dump_bytes, self._step))
+
     def callback(self, op_type, inputs, attrs, outputs, op_name=None, graph=None):
+        if self._adding_dump_ops:
+            # ops created for the gate and the conditional dumps themselves
+            return None
         if op_name is not None and self._op_regex.match(op_name):
             graph_name = "missing-graph-name"
             if graph is not None and hasattr(graph, "name"):
@@ -90,22 +190,50 @@ class _DumpCallback(object):
                     debug_identity_op_kwargs["tfdbg_run_id"] = self._tfdbg_run_id
 
                 self._dump_op_counter = self._dump_op_counter + 1
-                new_outputs.append(gen_debug_ops.debug_identity_v2(
-                    output, **debug_identity_op_kwargs))
+                if self._sampled and output.dtype not in (tf.resource, tf.variant):
+                    new_outputs.append(self._sampled_dump(
+                        output, op_name, graph, debug_identity_op_kwargs))
+                else:
+                    new_outputs.append(gen_debug_ops.debug_identity_v2(
+                        output, **debug_identity_op_kwargs))
 
             return new_outputs
         else:
             return None
 
+    def _sampled_dump(self, output, op_name, graph, debug_identity_op_kwargs):
+        self._adding_dump_ops = True
+        try:
+            gate = self._gate(op_name, graph)
+            if graph is None:
+                if gate:
+                    return gen_debug_ops.debug_identity_v2(output, **debug_identity_op_kwargs)
+                return output
+            return tf.cond(gate,
+                           lambda: gen_debug_ops.debug_identity_v2(output, **debug_identity_op_kwargs),
+                           lambda: tf.identity(output))
+        finally:
+            self._adding_dump_ops = False
+
     def __enter__(self, *args, **kwargs):
         op_callbacks.add_op_callback(self.callback)
-        logging.info("Enabled tensor dumping")
+        if self._flush_interval_secs and self._flush_thread is None:
+            self._flush_stop.clear()
+            self._flush_thread = threading.Thread(target=self._flush_loop, name="tensor_dump_flush", daemon=True)
+            self._flush_thread.start()
+        logging.info("Enabled tensor dumping" + (" (sampled)" if self._sampled else ""))
 
     def __exit__(self, *args, **kwargs):
         op_callbacks.remove_op_callback(self.callback)
+        if self._flush_thread is not None:
+            self._flush_stop.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+            self._flush()
         logging.info("Disabled tensor dumping")
 
     def __del__(self):
+        self._flush_stop.set()
         self._writer.Close()
 
 
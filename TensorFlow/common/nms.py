@@ -0,0 +1,171 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+"""Multi-class non-maximum suppression of a batch of images with NumPy.
+
+Replaces the host side NMS loops of the detection models, which run the
+greedy NMS of every class one box at a time, with a batched greedy NMS:
+
+- the boxes of all the classes are sorted by score together and boxes of
+  different classes never suppress each other, as if every class was offset
+  to its own region of the image. The pairs of boxes of different classes are
+  masked instead of offsetting the coordinates, which would round them.
+- the sorted boxes are processed in blocks. The pairwise IoU of the boxes of a
+  block, and their IoU with the boxes already selected, are computed at once,
+  and the greedy selection within the block is resolved by iterating
+  "keep the boxes not suppressed by a kept box" until it converges.
+- images stop when they have max_output_size boxes, since the following boxes
+  have lower scores.
+
+The selection is the same as the greedy per class NMS followed by taking the
+max_output_size best boxes of all the classes, up to the order of boxes with
+equal scores.
+"""
+
+import numpy as np
+
+
+def _pairwise_iou(boxes1, areas1, boxes2, areas2, pixel_offset):
+    """IoU of every box of boxes1 with every box of boxes2, for each image."""
+    lt = np.maximum(boxes1[:, :, None, :2], boxes2[:, None, :, :2])
+    rb = np.minimum(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])
+    delta = np.maximum(rb - lt + pixel_offset, 0)
+    intersection = delta[..., 0] * delta[..., 1]
+    return intersection / (areas1[:, :, None] + areas2[:, None, :] - intersection)
+
+
+def _suppresses(iou, iou_threshold, suppress_equal):
+    # NaN IoUs, of empty boxes, suppress as in the greedy loops.
+    if suppress_equal:
+        return np.logical_not(iou < iou_threshold)
+    return np.logical_not(iou <= iou_threshold)
+
+
+def _rank_in_class(classes, valid):
+    """Rank of every valid box among the valid boxes of its class, in order."""
+    num_boxes = classes.shape[1]
+    keys = np.where(valid, classes.astype(np.int64), np.iinfo(np.int64).max)
+    by_class = np.argsort(keys, axis=1, kind='stable')
+    sorted_keys = np.take_along_axis(keys, by_class, axis=1)
+    positions = np.broadcast_to(np.arange(num_boxes), classes.shape)
+    is_first = np.ones(classes.shape, dtype=bool)
+    is_first[:, 1:] = sorted_keys[:, 1:] != sorted_keys[:, :-1]
+    first_positions = np.maximum.accumulate(np.where(is_first, positions, 0), axis=1)
+    ranks = np.empty_like(by_class)
+    np.put_along_axis(ranks, by_class, positions - first_positions, axis=1)
+    return ranks
+
+
+def batched_nms(boxes,
+                scores,
+                classes,
+                iou_threshold,
+                max_output_size,
+                valid=None,
+                max_size_per_class=None,
+                pixel_offset=0.0,
+                suppress_equal=False,
+                block_size=128):
+    """Greedy per class non-maximum suppression of a batch of images.
+
+    Args:
+      boxes: a float array with shape [batch_size, num_boxes, 4] of the box
+        corners, either [y1, x1, y2, x2] or [x1, y1, x2, y2].
+      scores: a float array with shape [batch_size, num_boxes].
+      classes: an integer array with shape [batch_size, num_boxes], boxes of
+        different classes do not suppress each other.
+      iou_threshold: boxes overlapping a selected box of the same class with an
+        IoU above this threshold are suppressed.
+      max_output_size: the maximum number of boxes selected per image.
+      valid: (optional) a boolean array with shape [batch_size, num_boxes] of
+        the boxes to consider, all of them if None.
+      max_size_per_class: (optional) only the max_size_per_class best valid
+        boxes of every class are considered.
+      pixel_offset: added to the box sides, 1 for the integer pixel convention
+        where a box from x1 to x2 is x2 - x1 + 1 wide.
+      suppress_equal: whether boxes with an IoU equal to iou_threshold are
+        suppressed.
+      block_size: the number of boxes of every block.
+
+    Returns:
+      selected: an integer array with shape [batch_size, max_output_size] of
+        the indices of the selected boxes, by decreasing score and padded with
+        -1.
+      num_selected: an integer array with shape [batch_size] of the number of
+        selected boxes of every image.
+    """
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+    classes = np.asarray(classes)
+    batch_size, num_boxes = scores.shape
+    if valid is None:
+        valid = np.ones([batch_size, num_boxes], dtype=bool)
+
+    # Decreasing scores, the last of equal scores first, as argsort()[::-1].
+    order = np.argsort(scores, axis=1, kind='stable')[:, ::-1]
+    sorted_boxes = np.take_along_axis(boxes, order[:, :, None], axis=1)
+    sorted_classes = np.take_along_axis(classes, order, axis=1)
+    sorted_valid = np.take_along_axis(np.asarray(valid, dtype=bool), order, axis=1)
+    if max_size_per_class is not None:
+        sorted_valid &= _rank_in_class(sorted_classes, sorted_valid) < max_size_per_class
+
+    sides = sorted_boxes[:, :, 2:] - sorted_boxes[:, :, :2] + pixel_offset
+    sorted_areas = sides[:, :, 0] * sides[:, :, 1]
+    ends = num_boxes - np.argmax(sorted_valid[:, ::-1], axis=1)
+    ends[np.logical_not(np.any(sorted_valid, axis=1))] = 0
+
+    # Positions of the selected boxes in the sorted order.
+    selected = np.zeros([batch_size, max_output_size], dtype=np.int64)
+    num_selected = np.zeros([batch_size], dtype=np.int64)
+    upper = np.triu(np.ones([block_size, block_size], dtype=bool), k=1)
+
+    for start in range(0, num_boxes, block_size):
+        images = np.flatnonzero((num_selected < max_output_size) & (ends > start))
+        if len(images) == 0:
+            break
+
+        block = slice(start, start + block_size)
+        block_boxes = sorted_boxes[images, block]
+        block_areas = sorted_areas[images, block]
+        block_classes = sorted_classes[images, block]
+        block_valid = sorted_valid[images, block]
+        size = block_boxes.shape[1]
+
+        # Suppressed by the boxes selected in the previous blocks.
+        max_selected = np.max(num_selected[images])
+        if max_selected > 0:
+            previous = selected[images, :max_selected]
+            iou = _pairwise_iou(
+                np.take_along_axis(sorted_boxes[images], previous[:, :, None], axis=1),
+                np.take_along_axis(sorted_areas[images], previous, axis=1),
+                block_boxes, block_areas, pixel_offset)
+            suppressed = _suppresses(iou, iou_threshold, suppress_equal)
+            suppressed &= np.take_along_axis(sorted_classes[images], previous, axis=1)[:, :, None] == \
+                block_classes[:, None, :]
+            suppressed &= (np.arange(max_selected) < num_selected[images, None])[:, :, None]
+            block_valid &= np.logical_not(np.any(suppressed, axis=1))
+
+        # suppresses[i, j]: box i of the block suppresses box j if it is kept.
+        suppresses = _suppresses(
+            _pairwise_iou(block_boxes, block_areas, block_boxes, block_areas, pixel_offset),
+            iou_threshold, suppress_equal)
+        suppresses &= block_classes[:, :, None] == block_classes[:, None, :]
+        suppresses &= upper[:size, :size]
+
+        # The boxes up to position k are final after k + 1 iterations, and the
+        # only fixed point is the greedy selection.
+        keep = block_valid
+        while True:
+            next_keep = block_valid & np.logical_not(np.any(keep[:, :, None] & suppresses, axis=1))
+            if np.array_equal(next_keep, keep):
+                break
+            keep = next_keep
+
+        for image, image_keep in zip(images, keep):
+            positions = start + np.flatnonzero(image_keep)[:max_output_size - num_selected[image]]
+            selected[image, num_selected[image]:num_selected[image] + len(positions)] = positions
+            num_selected[image] += len(positions)
+
+    selected = np.where(np.arange(max_output_size) < num_selected[:, None],
+                        np.take_along_axis(order, selected, axis=1), -1)
+    return selected, num_selected
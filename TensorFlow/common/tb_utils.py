@@ -1,3 +1,5 @@
+import collections
+import json
 import os
 import time
 import tensorflow as tf
@@ -84,6 +86,127 @@ def write_hparams_v2(writer, hparams: dict):
         hp.hparams(hparams)
 
 
+class StepTimer(object):
+    """
+    Collects a per-step timing breakdown of a training loop.
+
+    Every step is split into the time blocked on the input iterator
+    ('data_wait'), the time in the step itself ('step') and the time spent
+    between steps in hooks and callbacks ('callbacks'). The last
+    `window_size` steps are kept and summarized as p50/p95/p99 in
+    milliseconds. Summaries can also be appended to a JSONL file, one line
+    per report.
+
+    Each step gets one data wait sample, the time blocked in next() since
+    the end of the previous step. Only iterators wrapped with
+    `wrap_iterator` (or waits reported with `add_data_wait`) are accounted
+    as data wait. Otherwise, e.g. when Keras or Estimator pull from a
+    tf.data iterator inside the graph, fetching the next element is part of
+    the step time and no data wait is reported at all.
+
+    :param window_size: - number of most recent steps the percentiles are
+        computed over
+    :param log_file: - optional path of the JSONL file
+    """
+
+    COMPONENTS = ('data_wait', 'step', 'callbacks')
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window_size=100, log_file=None):
+        self._times = {name: collections.deque(maxlen=window_size)
+                       for name in self.COMPONENTS}
+        self._log_file = log_file
+        self._log = None
+        self._step_start = None
+        self._step_end = None
+        self._wait_in_step = 0.
+        self._wait_between_steps = 0.
+        self._wait_before_step = 0.
+        self._measures_data_wait = False
+
+    def begin_step(self):
+        now = time.perf_counter()
+        if self._step_end is not None:
+            self._times['callbacks'].append(max(
+                0., now - self._step_end - self._wait_between_steps))
+        self._wait_before_step = self._wait_between_steps
+        self._wait_between_steps = 0.
+        self._wait_in_step = 0.
+        self._step_start = now
+
+    def end_step(self):
+        now = time.perf_counter()
+        if self._step_start is None:
+            return
+        self._times['step'].append(
+            max(0., now - self._step_start - self._wait_in_step))
+        if self._measures_data_wait:
+            self._times['data_wait'].append(
+                self._wait_before_step + self._wait_in_step)
+        self._step_start = None
+        self._step_end = now
+
+    def reset(self):
+        """Forgets the open step, e.g. after a pause for evaluation."""
+        self._step_start = None
+        self._step_end = None
+        self._wait_in_step = 0.
+        self._wait_between_steps = 0.
+        self._wait_before_step = 0.
+
+    def add_data_wait(self, seconds):
+        self._measures_data_wait = True
+        if self._step_start is not None:
+            self._wait_in_step += seconds
+        else:
+            self._wait_between_steps += seconds
+
+    def wrap_iterator(self, iterator):
+        """Returns an iterator that reports the time blocked in next()."""
+        iterator = iter(iterator)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_data_wait(time.perf_counter() - start)
+            yield element
+
+    def summary(self):
+        """Returns {'<component>_p<N>_ms': value} over the current window."""
+        result = {}
+        for name in self.COMPONENTS:
+            times = sorted(self._times[name])
+            if not times:
+                continue
+            for p in self.PERCENTILES:
+                # nearest-rank percentile
+                index = max(0, -(-p * len(times) // 100) - 1)
+                result[f'{name}_p{p}_ms'] = 1000. * times[index]
+        return result
+
+    def write_log(self, step, summary, **extra):
+        if self._log_file is None:
+            return
+        if self._log is None:
+            log_dir = os.path.dirname(self._log_file)
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
+            self._log = open(self._log_file, 'a')
+        record = {'step': int(step), 'time': round(time.time(), 3)}
+        record.update({k: round(v, 3) for k, v in summary.items()})
+        record.update(extra)
+        self._log.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._log.flush()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
 class ExamplesPerSecondEstimatorHook(tf.compat.v1.train.StepCounterHook):
     """Calculate and report global_step/sec and examples/sec during runtime."""
     # Copy-pasted from tensorflow_estimator/python/estimator/tpu/tpu_estimator.py
@@ -96,7 +219,8 @@ class ExamplesPerSecondEstimatorHook(tf.compat.v1.train.StepCounterHook):
                  summary_writer=None,
                  extra_metrics=None,
                  log_global_step=False,
-                 verbose=False):
+                 verbose=False,
+                 step_timer=None):
         super().__init__(
             every_n_steps=every_n_steps,
             every_n_secs=every_n_secs,
@@ -112,6 +236,7 @@ class ExamplesPerSecondEstimatorHook(tf.compat.v1.train.StepCounterHook):
             self._metrics['global_step/sec'] = 1
         if batch_size is not None:
             self._metrics['examples/sec'] = batch_size
+        self._step_timer = step_timer
 
     def _add_summary(self, tag, value, step):
         Summary = tf.compat.v1.Summary
@@ -128,9 +253,35 @@ class ExamplesPerSecondEstimatorHook(tf.compat.v1.train.StepCounterHook):
             for name, factor in self._metrics.items():
                 value = factor * global_step_per_sec
                 self._add_summary(name, value, global_step)
+        if self._step_timer is not None:
+            timings = self._step_timer.summary()
+            if self._summary_writer is not None:
+                for name, value in timings.items():
+                    self._add_summary(f'step_timing/{name}', value, global_step)
+            self._step_timer.write_log(
+                global_step, timings,
+                **{name: factor * global_step_per_sec
+                   for name, factor in self._metrics.items()})
 
     def after_create_session(self, session, coord):
         self._timer.reset()
+        if self._step_timer is not None:
+            self._step_timer.reset()
+
+    def before_run(self, run_context):
+        if self._step_timer is not None:
+            self._step_timer.begin_step()
+        return super().before_run(run_context)
+
+    def after_run(self, run_context, run_values):
+        if self._step_timer is not None:
+            self._step_timer.end_step()
+        super().after_run(run_context, run_values)
+
+    def end(self, session):
+        super().end(session)
+        if self._step_timer is not None:
+            self._step_timer.close()
 
 
 class ExamplesPerSecondKerasHookV1(Callback):
@@ -139,22 +290,42 @@ class ExamplesPerSecondKerasHookV1(Callback):
                  every_n_secs=None,
                  output_dir=None,
                  summary_writer=None,
-                 batch_size=None):
+                 batch_size=None,
+                 step_timer=None):
+        super().__init__()
         self.writer = summary_writer or SummaryWriterCache.get(output_dir)
         self._timer = tf.compat.v1.train.SecondOrStepTimer(
             every_n_secs, every_n_steps)
         self._total_examples = 0
         self._should_trigger = True
         self._batch_size = batch_size
+        self._step_timer = step_timer
 
     def on_train_begin(self, logs=None):
         self._timer.reset()
+        if self._step_timer is not None:
+            self._step_timer.reset()
+
+    def on_train_end(self, logs=None):
+        if self._step_timer is not None:
+            self._step_timer.close()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # do not count validation as callback time of the next step
+        if self._step_timer is not None:
+            self._step_timer.reset()
 
     def on_train_batch_begin(self, batch, logs=None):
+        logs = logs or {}
+        if self._step_timer is not None:
+            self._step_timer.begin_step()
         self._should_trigger = self._timer.should_trigger_for_step(
             logs.get('batch', batch))
 
     def on_train_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        if self._step_timer is not None:
+            self._step_timer.end_step()
         step = logs.get('batch', batch)
         self._total_examples += logs.get('size', 0)
         if self._should_trigger:
@@ -166,8 +337,31 @@ class ExamplesPerSecondKerasHookV1(Callback):
                     total_examples = self._batch_size * elapsed_steps
                 self._log_and_record(
                     elapsed_steps, elapsed_time, step, total_examples)
+                self._log_step_timing(
+                    elapsed_steps, elapsed_time, step, total_examples)
                 self._total_examples = 0
 
+    def _log_step_timing(self, elapsed_steps, elapsed_time,
+                         global_step, total_examples=None):
+        if self._step_timer is None:
+            return
+        timings = self._step_timer.summary()
+        self._write_step_timing(timings, global_step)
+        extra = {'global_step/sec': elapsed_steps / elapsed_time}
+        if total_examples is not None:
+            extra['examples/sec'] = total_examples / elapsed_time
+        self._step_timer.write_log(global_step, timings, **extra)
+
+    def _write_step_timing(self, timings, global_step):
+        if self.writer is None:
+            return
+        Summary = tf.compat.v1.Summary
+        summary = Summary(value=[
+            Summary.Value(tag=f'step_timing/{name}', simple_value=value)
+            for name, value in timings.items()
+        ])
+        self.writer.add_summary(summary, global_step)
+
     def _log_and_record(self, elapsed_steps, elapsed_time,
                         global_step, total_examples=None):
         Summary = tf.compat.v1.Summary
@@ -193,9 +387,11 @@ class ExamplesPerSecondKerasHookV2(ExamplesPerSecondKerasHookV1):
                  every_n_secs=None,
                  output_dir=None,
                  summary_writer=None,
-                 batch_size=None):
+                 batch_size=None,
+                 step_timer=None):
         writer = summary_writer or summary_ops_v2.create_file_writer_v2(output_dir)
-        super().__init__(every_n_steps, every_n_secs, output_dir, writer, batch_size)
+        super().__init__(every_n_steps, every_n_secs, output_dir, writer,
+                         batch_size, step_timer)
 
     def _log_and_record(self, elapsed_steps, elapsed_time,
                         global_step, total_examples=None):
@@ -209,6 +405,14 @@ class ExamplesPerSecondKerasHookV2(ExamplesPerSecondKerasHookV1):
                     summary_ops_v2.scalar('examples/sec', examples_per_sec,
                                           step=global_step)
 
+    def _write_step_timing(self, timings, global_step):
+        if self.writer is None:
+            return
+        with self.writer.as_default(), summary_ops_v2.always_record_summaries():
+            for name, value in timings.items():
+                summary_ops_v2.scalar(f'step_timing/{name}', value,
+                                      step=global_step)
+
 
 ExamplesPerSecondKerasHook = ExamplesPerSecondKerasHookV1
 
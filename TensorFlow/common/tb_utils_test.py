@@ -0,0 +1,123 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Tests of StepTimer, run from the repository root with
+python -m unittest TensorFlow.common.tb_utils_test"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from TensorFlow.common.tb_utils import StepTimer
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SlowIterator(object):
+    """Takes `wait` seconds of the fake clock to return every element."""
+
+    def __init__(self, clock, waits):
+        self._clock = clock
+        self._waits = iter(waits)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._clock.sleep(next(self._waits))
+        return 'element'
+
+
+class StepTimerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('time.perf_counter', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_steps(self, timer, waits, step_time, callback_time):
+        for _ in timer.wrap_iterator(SlowIterator(self.clock, waits)):
+            timer.begin_step()
+            self.clock.sleep(step_time)
+            timer.end_step()
+            self.clock.sleep(callback_time)
+
+    def test_wrapped_iterator(self):
+        timer = StepTimer()
+        self.run_steps(timer, [0.5, 0.25, 0.25, 0.25], 1., 0.125)
+        self.assertEqual(list(timer._times['data_wait']), [0.5, 0.25, 0.25, 0.25])
+        self.assertEqual(list(timer._times['step']), [1.] * 4)
+        self.assertEqual(list(timer._times['callbacks']), [0.125] * 3)
+        summary = timer.summary()
+        self.assertEqual(summary['data_wait_p50_ms'], 250.)
+        self.assertEqual(summary['data_wait_p99_ms'], 500.)
+        self.assertEqual(summary['step_p95_ms'], 1000.)
+
+    def test_one_data_wait_sample_per_step(self):
+        timer = StepTimer()
+        waits = iter([0.5, 0.25])
+        for _ in range(2):
+            # Waits both before and inside the step
+            timer.add_data_wait(next(waits))
+            timer.begin_step()
+            timer.add_data_wait(0.125)
+            self.clock.sleep(1.125)
+            timer.end_step()
+        self.assertEqual(list(timer._times['data_wait']), [0.625, 0.375])
+        self.assertEqual(list(timer._times['step']), [1., 1.])
+
+    def test_unwrapped_iterator(self):
+        timer = StepTimer()
+        for _ in range(3):
+            timer.begin_step()
+            self.clock.sleep(1.)
+            timer.end_step()
+        self.assertEqual(list(timer._times['data_wait']), [])
+        self.assertEqual(list(timer._times['step']), [1.] * 3)
+        summary = timer.summary()
+        self.assertNotIn('data_wait_p50_ms', summary)
+        self.assertEqual(summary['step_p50_ms'], 1000.)
+
+    def test_reset(self):
+        timer = StepTimer()
+        self.run_steps(timer, [0.5], 1., 0.125)
+        timer.reset()
+        self.clock.sleep(10.)
+        self.run_steps(timer, [0.25], 1., 0.125)
+        self.assertEqual(list(timer._times['callbacks']), [])
+        self.assertEqual(list(timer._times['data_wait']), [0.5, 0.25])
+
+    def test_window(self):
+        timer = StepTimer(window_size=2)
+        self.run_steps(timer, [0.5, 0.25, 0.25], 1., 0.)
+        self.assertEqual(list(timer._times['data_wait']), [0.25, 0.25])
+
+    def test_write_log(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, 'logs', 'step_timing.jsonl')
+            timer = StepTimer(log_file=log_file)
+            self.run_steps(timer, [0.5, 0.25], 1., 0.)
+            timer.write_log(2, timer.summary(), IPS=8.)
+            timer.write_log(4, timer.summary())
+            timer.close()
+            with open(log_file) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([record['step'] for record in records], [2, 4])
+        self.assertEqual(records[0]['IPS'], 8.)
+        self.assertEqual(records[0]['data_wait_p99_ms'], 500.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -85,6 +85,9 @@ class SSDArgParser(argparse.ArgumentParser):
                           help='Maximum number of checkpoints to keep', type=int)
         self.add_argument('--save_summary_steps', default=1,
                           help='How often save summary', type=int)
+        self.add_argument('--step_timing', default=False, action='store_true',
+                          help='Every save_summary_steps, log p50/p95/p99 of the step and hook time per step '
+                               'to step_timing.jsonl in model_dir')
         self.add_argument('--static', default=False, action='store_true',
                           help='Enables use of static dataloader')
         self.add_argument('--recipe_cache', default='/tmp/ssd_recipe_cache/',
@@ -23,6 +23,8 @@
 # - Formatted with autopep8
 # - Removed __future__ imports
 # - Added absolute paths in imports
+# - Replaced the NMS loop of every class of decode_single with batched_nms
+#   and decode the predictions of compute_map in batches
 
 """COCO-style evaluation metrics.
 
@@ -42,6 +44,7 @@ import six
 
 import tensorflow.compat.v1 as tf
 
+from TensorFlow.common.nms import batched_nms
 from TensorFlow.computer_vision.SSD_ResNet34 import constants
 
 
@@ -70,7 +73,8 @@ def create_coco(val_json_file, use_cpp_extension=True):
 
 def compute_map(labels_and_predictions,
                 coco_gt,
-                use_cpp_extension=True):
+                use_cpp_extension=True,
+                batch_size=32):
     """Use model predictions to compute mAP.
 
     The evaluation code is largely copied from the MLPerf reference
@@ -82,6 +86,7 @@ def compute_map(labels_and_predictions,
       labels_and_predictions: A map from TPU predict method.
       coco_gt: ground truch COCO object.
       use_cpp_extension: use cocoeval C++ library.
+      batch_size: number of examples decoded at once.
     Returns:
       Evaluation result.
     """
@@ -89,27 +94,37 @@ def compute_map(labels_and_predictions,
     predictions = []
     tic = time.time()
 
+    def decode_examples(examples):
+        decoded = decode_batch(
+            np.stack([example['pred_box'] for example in examples]),
+            np.stack([example['pred_scores'] for example in examples]),
+            np.stack([example['indices'] for example in examples]),
+            constants.OVERLAP_CRITERIA, constants.MAX_NUM_EVAL_BOXES,
+            constants.MAX_NUM_EVAL_BOXES)
+
+        for example, (loc, label, prob) in zip(examples, decoded):
+            htot, wtot, _ = example[constants.RAW_SHAPE]
+            for loc_, label_, prob_ in zip(loc, label, prob):
+                # Ordering convention differs, hence [1], [0] rather than [0], [1]
+                predictions.append([
+                    int(example[constants.SOURCE_ID]),
+                    loc_[1] * wtot, loc_[0] * htot, (loc_[3] - loc_[1]) * wtot,
+                    (loc_[2] - loc_[0]) * htot, prob_,
+                    constants.CLASS_INV_MAP[label_]
+                ])
+
+    examples = []
     for example in labels_and_predictions:
         if constants.IS_PADDED in example and example[
                 constants.IS_PADDED]:
             continue
 
-        htot, wtot, _ = example[constants.RAW_SHAPE]
-        pred_box = example['pred_box']
-        pred_scores = example['pred_scores']
-        indices = example['indices']
-        loc, label, prob = decode_single(
-            pred_box, pred_scores, indices, constants.OVERLAP_CRITERIA,
-            constants.MAX_NUM_EVAL_BOXES, constants.MAX_NUM_EVAL_BOXES)
-
-        for loc_, label_, prob_ in zip(loc, label, prob):
-            # Ordering convention differs, hence [1], [0] rather than [0], [1]
-            predictions.append([
-                int(example[constants.SOURCE_ID]),
-                loc_[1] * wtot, loc_[0] * htot, (loc_[3] - loc_[1]) * wtot,
-                (loc_[2] - loc_[0]) * htot, prob_,
-                constants.CLASS_INV_MAP[label_]
-            ])
+        examples.append(example)
+        if len(examples) == batch_size:
+            decode_examples(examples)
+            examples = []
+    if examples:
+        decode_examples(examples)
 
     toc = time.time()
     tf.logging.info('Prepare predictions DONE (t={:0.2f}s).'.format(toc - tic))
@@ -141,26 +156,6 @@ def compute_map(labels_and_predictions,
     return {'COCO/' + key: value for key, value in zip(metric_names, stats)}
 
 
-def calc_iou(target, candidates):
-    target_tiled = np.tile(target[np.newaxis, :], (candidates.shape[0], 1))
-    # Left Top & Right Bottom
-    lt = np.maximum(target_tiled[:, :2], candidates[:, :2])
-
-    rb = np.minimum(target_tiled[:, 2:], candidates[:, 2:])
-
-    delta = np.maximum(rb - lt, 0)
-
-    intersect = delta[:, 0] * delta[:, 1]
-
-    delta1 = target_tiled[:, 2:] - target_tiled[:, :2]
-    area1 = delta1[:, 0] * delta1[:, 1]
-    delta2 = candidates[:, 2:] - candidates[:, :2]
-    area2 = delta2[:, 0] * delta2[:, 1]
-
-    iou = intersect/(area1 + area2 - intersect)
-    return iou
-
-
 def decode_single(bboxes_in,
                   scores_in,
                   indices,
@@ -186,58 +181,60 @@ def decode_single(bboxes_in,
     Returns:
       boxes, labels and scores after NMS.
     """
+    return decode_batch(bboxes_in[np.newaxis], scores_in[np.newaxis],
+                        indices[np.newaxis], criteria, max_output, max_num)[0]
 
-    bboxes_out = []
-    scores_out = []
-    labels_out = []
-
-    for i, score in enumerate(np.split(scores_in, scores_in.shape[1], 1)):
-        class_indices = indices[:, i]
-        bboxes = bboxes_in[class_indices, :]
-        score = np.squeeze(score, 1)
-
-        # skip background
-        if i == 0:
-            continue
-
-        mask = score > constants.MIN_SCORE
-        if not np.any(mask):
-            continue
 
-        bboxes, score = bboxes[mask, :], score[mask]
+def decode_batch(bboxes_in,
+                 scores_in,
+                 indices,
+                 criteria,
+                 max_output,
+                 max_num=200):
+    """Implement Non-maximum suppression of a batch of images.
 
-        score_idx_sorted = np.argsort(score)
-        score_sorted = score[score_idx_sorted]
+    Runs the NMS of every class of all the images at once with
+    TensorFlow.common.nms.batched_nms.
 
-        score_idx_sorted = score_idx_sorted[-max_num:]
-        candidates = []
-
-        # perform non-maximum suppression
-        while len(score_idx_sorted):
-            idx = score_idx_sorted[-1]
-            bboxes_sorted = bboxes[score_idx_sorted, :]
-            bboxes_idx = bboxes[idx, :]
-            iou = calc_iou(bboxes_idx, bboxes_sorted)
-
-            score_idx_sorted = score_idx_sorted[iou < criteria]
-            candidates.append(idx)
-
-        bboxes_out.append(bboxes[candidates, :])
-        scores_out.append(score[candidates])
-        labels_out.extend([i]*len(candidates))
-
-    if len(scores_out) == 0:
-        tf.logging.info("No objects detected. Returning dummy values.")
-        return (
-            np.zeros(shape=(1, 4), dtype=np.float32),
-            np.zeros(shape=(1,), dtype=np.int32),
-            np.ones(shape=(1,), dtype=np.float32) * constants.DUMMY_SCORE,
-        )
-
-    bboxes_out = np.concatenate(bboxes_out, axis=0)
-    scores_out = np.concatenate(scores_out, axis=0)
-    labels_out = np.array(labels_out)
+    Args:
+      bboxes_in: a Tensor with shape [batch_size, N, 4], the boxes of every
+        image as in decode_single.
+      scores_in: a Tensor with shape [batch_size,
+        constants.MAX_NUM_EVAL_BOXES, num_classes].
+      indices: a Tensor with shape [batch_size, constants.MAX_NUM_EVAL_BOXES,
+        num_classes].
+      criteria: a float number to specify the threshold of NMS.
+      max_output: maximum output length.
+      max_num: maximum number of boxes per class before NMS.
 
-    max_ids = np.argsort(scores_out)[-max_output:]
+    Returns:
+      a list of the boxes, labels and scores after NMS of every image, by
+      increasing score as decode_single.
+    """
+    batch_size, num_boxes, num_classes = scores_in.shape
+    bboxes = np.take_along_axis(
+        bboxes_in, np.reshape(indices, [batch_size, -1, 1]), axis=1)
+    scores = np.reshape(scores_in, [batch_size, -1])
+    labels = np.reshape(
+        np.broadcast_to(np.arange(num_classes), scores_in.shape), [batch_size, -1])
+    # skip background
+    valid = (labels > 0) & (scores > constants.MIN_SCORE)
+
+    selected, num_selected = batched_nms(
+        bboxes, scores, labels, criteria, max_output, valid=valid,
+        max_size_per_class=max_num, suppress_equal=True)
+
+    decoded = []
+    for i in range(batch_size):
+        if num_selected[i] == 0:
+            tf.logging.info("No objects detected. Returning dummy values.")
+            decoded.append((
+                np.zeros(shape=(1, 4), dtype=np.float32),
+                np.zeros(shape=(1,), dtype=np.int32),
+                np.ones(shape=(1,), dtype=np.float32) * constants.DUMMY_SCORE,
+            ))
+            continue
 
-    return bboxes_out[max_ids, :], labels_out[max_ids], scores_out[max_ids]
+        max_ids = selected[i, :num_selected[i]][::-1]
+        decoded.append((bboxes[i, max_ids], labels[i, max_ids], scores[i, max_ids]))
+    return decoded
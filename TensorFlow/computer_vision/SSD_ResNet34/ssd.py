@@ -36,6 +36,7 @@
 # - Removed train_and_eval mode
 # - Formatted with autopep8
 # - Added absolute paths in imports
+# - Added per-step timing breakdown via --step_timing
 
 """Training script for SSD.
 """
@@ -47,7 +48,7 @@ from TensorFlow.computer_vision.SSD_ResNet34 import dataloader
 from TensorFlow.computer_vision.SSD_ResNet34 import static_dataloader
 from TensorFlow.computer_vision.SSD_ResNet34 import coco_metric
 from TensorFlow.common.tb_utils import (
-    write_hparams_v1, TBSummary, ExamplesPerSecondEstimatorHook)
+    write_hparams_v1, TBSummary, ExamplesPerSecondEstimatorHook, StepTimer)
 
 import datetime
 import math
@@ -300,9 +301,14 @@ if __name__ == '__main__':
             steps = ARGS.steps
 
         train_hooks.append(SSDTrainingHook(steps, params))
+        step_timer = None
+        if ARGS.step_timing:
+            # the Estimator pulls from the dataset inside the step, so there is no data wait series
+            step_timer = StepTimer(window_size=params['save_summary_steps'],
+                                   log_file=os.path.join(params['model_dir'], 'step_timing.jsonl'))
         train_hooks.append(ExamplesPerSecondEstimatorHook(
             params['batch_size'], params['save_summary_steps'],
-            output_dir=params['model_dir']))
+            output_dir=params['model_dir'], step_timer=step_timer))
 
         tf.logging.info('Starting training cycle for %d steps.' % steps)
 
@@ -20,6 +20,7 @@
 # - added dtype, hvd_workers, dump_config, no_hpu, synth_data, disable_ckpt_saving,
 #   use_horovod, tensorboard_logging, bf16_config_path, tf_verbosity,
 #   kubernetes_run options
+# - added step_timing option
 # - SmartFormatter for textwrapping help message
 
 """Command line argument parsing"""
@@ -165,6 +166,9 @@ def get_parser(description, distributed_launcher):
     parser.add_argument('--log_all_workers', dest='log_all_workers', action='store_true',
                         help="""Enable logging data for every horovod worker in a separate directory named `worker_N`""")
 
+    parser.add_argument('--step_timing', dest='step_timing', action='store_true',
+                        help="""Log p50/p95/p99 of the data wait, step and logging time per step to step_timing.jsonl in log_dir""")
+
     DEFAULT_BF16_CONFIG_PATH = os.fspath(Path(os.path.realpath(__file__)).parents[1].joinpath("bf16_config/unet.json"))
     parser.add_argument('--bf16_config_path', metavar='</path/to/custom/bf16/config>', required=False, type=str, default=DEFAULT_BF16_CONFIG_PATH,
                         help="""Path to custom mixed precision config to use given in JSON format.""")
@@ -208,6 +212,7 @@ def parse_args(description="UNet-medical", distributed_launcher=False):
         'use_horovod': flags.use_horovod,
         'tensorboard_logging': flags.tensorboard_logging,
         'log_all_workers': flags.log_all_workers,
+        'step_timing': flags.step_timing,
         'bf16_config_path': flags.bf16_config_path,
         'tf_verbosity': flags.tf_verbosity,
     })
@@ -20,6 +20,7 @@
 # - added synthetic data option for deterministic training
 # - added tensorboard logging and performance measurements logs
 # - in a training mode return loss from train_step as a numpy object to transfer the data to host
+# - added per-step data wait, step and logging time breakdown with StepTimer
 
 import os
 from time import time
@@ -34,7 +35,7 @@ from TensorFlow.common.horovod_helpers import hvd, horovod_enabled, hvd_size, hv
 from TensorFlow.common.tb_utils import write_hparams_v2
 
 
-def train(params, model, dataset, logger, tb_logger=None):
+def train(params, model, dataset, logger, tb_logger=None, step_timer=None):
     np.random.seed(params.seed)
     tf.random.set_seed(params.seed)
 
@@ -97,9 +98,16 @@ def train(params, model, dataset, logger, tb_logger=None):
     else:
         timestamp = time()
         dataset_fn = dataset.synth_fn if params.synth_data else dataset.train_fn
-        for iteration, (images, labels) in enumerate(dataset_fn()):
+        train_iterator = dataset_fn()
+        if step_timer is not None:
+            train_iterator = step_timer.wrap_iterator(train_iterator)
+        for iteration, (images, labels) in enumerate(train_iterator):
+            if step_timer is not None:
+                step_timer.begin_step()
             # assign returned loss as a numpy object to transfer the data to host
             loss = train_step(images, labels, warmup_batch=iteration == 0).numpy()
+            if step_timer is not None:
+                step_timer.end_step()
             if worker_id == 0 or params.log_all_workers:
                 if iteration % params.log_every == 0:
                     duration = float(time() - timestamp) / params.log_every
@@ -122,9 +130,20 @@ def train(params, model, dataset, logger, tb_logger=None):
                             tf.summary.scalar("examples/sec", data["IPS"], step=iteration)
                             tf.summary.scalar("global_step/sec", 1. / duration, step=iteration)
 
+                    if step_timer is not None:
+                        timings = step_timer.summary()
+                        step_timer.write_log(iteration, timings, IPS=data["IPS"])
+                        if tb_logger is not None:
+                            with tb_logger.train_writer.as_default():
+                                for name, value in timings.items():
+                                    tf.summary.scalar(f"step_timing/{name}", value, step=iteration)
+
                 if (params.evaluate_every > 0) and (iteration % params.evaluate_every == 0):
                     evaluate(params, model, dataset, logger, tb_logger,
                              restore_checkpoint=False)
+                    if step_timer is not None:
+                        # do not count evaluation as logging time of the next step
+                        step_timer.reset()
 
                 f1_loss.reset_states()
                 ce_loss.reset_states()
@@ -132,6 +151,8 @@ def train(params, model, dataset, logger, tb_logger=None):
             if iteration >= max_steps:
                 break
 
+        if step_timer is not None:
+            step_timer.close()
         if not params.disable_ckpt_saving and worker_id == 0:
             checkpoint.save(file_prefix=os.path.join(params.model_dir, "checkpoint"))
 
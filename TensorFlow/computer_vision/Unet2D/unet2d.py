@@ -18,6 +18,7 @@
 # - renamed script from main.py to unet2d.py
 # - included HPU horovod helpers
 # - added tensorboard logging functionality
+# - added per-step timing log
 
 import os
 from collections import namedtuple
@@ -31,6 +32,7 @@ from runtime.arguments import parse_args
 from data_loading.data_loader import Dataset
 from TensorFlow.common.debug import dump_callback
 from TensorFlow.common.horovod_helpers import hvd_init, horovod_enabled, hvd_size, hvd_rank
+from TensorFlow.common.tb_utils import StepTimer
 
 
 def main():
@@ -46,15 +48,21 @@ def main():
     params.model_dir = model_dir
     logger = get_logger(params)
 
+    log_dir = params.log_dir
+    if horovod_enabled() and params.log_all_workers:
+        log_dir = os.path.join(log_dir, f'worker_{hvd_rank()}')
+
     tb_logger = None
     if params.tensorboard_logging:
-        log_dir = params.log_dir
-        if horovod_enabled() and params.log_all_workers:
-            log_dir = os.path.join(log_dir, f'worker_{hvd_rank()}')
         tb_logger = namedtuple('TBSummaryWriters', 'train_writer eval_writer')(
             tf.summary.create_file_writer(log_dir),
             tf.summary.create_file_writer(os.path.join(log_dir, 'eval')))
 
+    step_timer = None
+    if params.step_timing:
+        step_timer = StepTimer(window_size=params.log_every,
+                               log_file=os.path.join(log_dir, 'step_timing.jsonl'))
+
     model = Unet()
 
     dataset = Dataset(data_dir=params.data_dir,
@@ -67,7 +75,7 @@ def main():
 
     if 'train' in params.exec_mode:
         with dump_callback(params.dump_config):
-            train(params, model, dataset, logger, tb_logger)
+            train(params, model, dataset, logger, tb_logger, step_timer)
 
     if 'evaluate' in params.exec_mode:
         evaluate(params, model, dataset, logger, tb_logger)
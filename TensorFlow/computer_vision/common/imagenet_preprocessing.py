@@ -17,6 +17,8 @@
 # - flag to specify seed used for dataset shuffling
 # - flags to control image preprocessing
 # - flag to influence parallelism of dataset processing
+# - on-disk cache of decoded and downscaled images
+# - per-host CPU budget for tf.data parallelism sized from measured stage costs
 
 # Copyright (C) 2020-2021 Habana Labs, Ltd. an Intel Company
 
@@ -49,7 +51,13 @@ try:
 except ImportError:
   hvd = None
 
+try:
+  import central.hw_topology as hw_topology
+except ImportError:
+  hw_topology = None
+
 import os
+import time
 from absl import flags
 from absl import logging
 import tensorflow as tf
@@ -81,6 +89,18 @@ flags.DEFINE_integer(name='sample_distorted_bounding_box_seed', default=0, help=
 flags.DEFINE_integer(name='random_flip_left_right_seed', default=None, help='Seed used in image preprocessing')
 flags.DEFINE_integer(name='dataset_parallel_calls', default=tf.data.experimental.AUTOTUNE, help='Determines the number of parallel calls in dataset operations')
 flags.DEFINE_integer(name='interleave_cycle_length', default=10, help='Determines cycle lenght for dataset interleave function')
+flags.DEFINE_boolean(name='dataset_host_budget', default=False,
+                     help='Split the CPU cores of the host evenly across its local Horovod ranks and size the '
+                          'interleave and map parallelism of each rank from the measured cost of the read, decode '
+                          'and augment stages, instead of --interleave_cycle_length and --dataset_parallel_calls.')
+flags.DEFINE_boolean(name='bind_dataloader_cores', default=False,
+                     help='Pin each local rank to its NUMA-local compute and data loader cores, as computed by '
+                          'central/hw_topology.py, and size the tf.data private thread pool to its data loader '
+                          'cores. Requires the repository root in PYTHONPATH.')
+flags.DEFINE_string(name='decoded_cache_dir', default=None,
+                    help='Host-local directory for an on-disk cache of images decoded and downscaled to the '
+                         'resize minimum. The first epoch fills it, later epochs and runs skip JPEG decoding. '
+                         'Random crop and flip still run on every epoch.')
 
 def process_record_dataset(dataset,
                            is_training,
@@ -91,7 +111,8 @@ def process_record_dataset(dataset,
                            datasets_num_private_threads=None,
                            drop_remainder=False,
                            tf_data_experimental_slack=False,
-                           experimental_preloading=False):
+                           experimental_preloading=False,
+                           num_parallel_calls=None):
   """Given a Dataset with raw records, return an iterator over the records.
 
   Args:
@@ -110,6 +131,8 @@ def process_record_dataset(dataset,
       batches. If True, the batch dimension will be static.
     tf_data_experimental_slack: Whether to enable tf.data's
       `experimental_slack` option.
+    num_parallel_calls: Parallelism of the record parsing, by default taken
+      from --dataset_parallel_calls.
 
   Returns:
     Dataset of (image, label) pairs ready for iteration.
@@ -129,10 +152,11 @@ def process_record_dataset(dataset,
     # Repeats the dataset for the number of epochs to train.
     dataset = dataset.repeat()
 
-  if hvd and hvd.is_initialized() and flags.FLAGS.dataset_parallel_calls == tf.data.experimental.AUTOTUNE:
-    num_parallel_calls = 16
-  else:
-    num_parallel_calls = flags.FLAGS.dataset_parallel_calls
+  if num_parallel_calls is None:
+    if hvd and hvd.is_initialized() and flags.FLAGS.dataset_parallel_calls == tf.data.experimental.AUTOTUNE:
+      num_parallel_calls = 16
+    else:
+      num_parallel_calls = flags.FLAGS.dataset_parallel_calls
   # Parses the raw records into images and labels.
   dataset = dataset.map(
       lambda value: parse_record_fn(value, is_training, dtype),
@@ -249,7 +273,7 @@ def parse_record(raw_record, is_training, dtype):
 
   Args:
     raw_record: scalar Tensor tf.string containing a serialized
-      Example protocol buffer.
+      Example protocol buffer, or a dict produced by decode_and_resize_record.
     is_training: A boolean denoting whether the input is for training.
     dtype: data type to use for images/features.
 
@@ -257,15 +281,26 @@ def parse_record(raw_record, is_training, dtype):
     Tuple with processed image tensor in a channel-last format and
     one-hot-encoded label tensor.
   """
-  image_buffer, label, bbox = parse_example_proto(raw_record)
-
-  image = preprocess_image(
-      image_buffer=image_buffer,
-      bbox=bbox,
-      output_height=DEFAULT_IMAGE_SIZE,
-      output_width=DEFAULT_IMAGE_SIZE,
-      num_channels=NUM_CHANNELS,
-      is_training=is_training)
+  if isinstance(raw_record, dict):
+    # Element of the decoded cache, see decode_and_resize_record.
+    label, bbox = raw_record['label'], raw_record['bbox']
+    image = preprocess_decoded_image(
+        image=raw_record['image'],
+        bbox=bbox,
+        output_height=DEFAULT_IMAGE_SIZE,
+        output_width=DEFAULT_IMAGE_SIZE,
+        num_channels=NUM_CHANNELS,
+        is_training=is_training)
+  else:
+    image_buffer, label, bbox = parse_example_proto(raw_record)
+
+    image = preprocess_image(
+        image_buffer=image_buffer,
+        bbox=bbox,
+        output_height=DEFAULT_IMAGE_SIZE,
+        output_width=DEFAULT_IMAGE_SIZE,
+        num_channels=NUM_CHANNELS,
+        is_training=is_training)
   image = tf.cast(image, dtype)
 
   # Subtract one so that labels are in [0, 1000), and cast to float32 for
@@ -301,6 +336,192 @@ def get_parse_record_fn(use_keras_image_data_format=False):
   return parse_record_fn
 
 
+# Seconds per record of every stage, as last measured by measure_pipeline_stages.
+_stage_timings = {}
+
+
+def get_pipeline_stage_timings():
+  """Returns the per-record cost of the read, decode and augment stages."""
+  return dict(_stage_timings)
+
+
+def measure_pipeline_stages(filename, parse_record_fn, is_training, dtype,
+                            num_records=256, decoded_cache=False):
+  """Measures the single-threaded cost of every input pipeline stage.
+
+  Must run eagerly. `read` is the TFRecord reading, timed on the first read
+  of the file by this process, `decode` the proto parsing and JPEG decoding
+  and `augment` the rest of `parse_record_fn` (crop, flip, resize and
+  normalization).
+
+  With the decoded cache, `decode` is decode_and_resize_record, run while the
+  cache is filled, and `augment` is `parse_record_fn` on its output, the
+  record map of every epoch.
+
+  Args:
+    filename: A TFRecord file of the input.
+    parse_record_fn: Function to use for parsing the records.
+    is_training: A boolean denoting whether the input is for training.
+    dtype: Data type to use for images/features.
+    num_records: The number of records timed.
+    decoded_cache: Whether the input pipeline uses the decoded cache.
+
+  Returns:
+    Dict of stage name to seconds per record.
+
+  Raises:
+    RuntimeError: If not executing eagerly.
+  """
+  if not tf.executing_eagerly():
+    raise RuntimeError('measure_pipeline_stages iterates datasets and must run '
+                       'eagerly, --dataset_host_budget needs TF2 behavior')
+
+  def time_per_record(dataset, elements=None):
+    start = time.time()
+    count = 0
+    for element in dataset:
+      count += 1
+      if elements is not None:
+        elements.append(element)
+    return (time.time() - start) / max(count, 1)
+
+  options = tf.data.Options()
+  options.experimental_threading.private_threadpool_size = 1
+  records = []
+  timings = {
+      'read': time_per_record(
+          tf.data.TFRecordDataset(filename).take(num_records).with_options(options),
+          records),
+  }
+  raw = tf.data.Dataset.from_tensor_slices(records).with_options(options)
+  if decoded_cache:
+    # The first pass fills the in-memory cache, the second one times the
+    # record map on the decoded images.
+    decoded = raw.map(decode_and_resize_record).cache()
+    timings['decode'] = time_per_record(decoded)
+    timings['augment'] = time_per_record(
+        decoded.map(lambda value: parse_record_fn(value, is_training, dtype)))
+  else:
+    timings['decode'] = time_per_record(raw.map(
+        lambda value: tf.image.decode_jpeg(parse_example_proto(value)[0],
+                                           channels=NUM_CHANNELS)))
+    parse_time = time_per_record(
+        raw.map(lambda value: parse_record_fn(value, is_training, dtype)))
+    timings['augment'] = max(parse_time - timings['decode'], 0.0)
+  _stage_timings.update(timings)
+  logging.info('Input pipeline cost per record: %s',
+               ', '.join('%s %.3f ms' % (stage, seconds * 1000)
+                         for stage, seconds in timings.items()))
+  return timings
+
+
+def get_host_budgeted_parallelism(stage_timings, decoded_cache=False):
+  """Splits this rank's share of the host cores between the pipeline stages.
+
+  The cores of the host are divided evenly between its local Horovod ranks.
+  Each rank's share is then split between the file interleave and the record
+  map in proportion to their measured cost per record. With the decoded
+  cache, the files are decoded by the interleave while the cache is filled.
+
+  Args:
+    stage_timings: Dict returned by measure_pipeline_stages.
+    decoded_cache: Whether the input pipeline uses the decoded cache.
+
+  Returns:
+    Tuple of (rank_cores, interleave_cycle_length, map_parallel_calls).
+  """
+  local_ranks = hvd.local_size() if hvd and hvd.is_initialized() else 1
+  rank_cores = max(1, (os.cpu_count() or 1) // local_ranks)
+  read = stage_timings['read']
+  if decoded_cache:
+    read += stage_timings['decode']
+  total = stage_timings['read'] + stage_timings['decode'] + stage_timings['augment']
+  interleave_cycle_length = max(1, int(round(rank_cores * read / total))) if total > 0 else 1
+  map_parallel_calls = max(1, rank_cores - interleave_cycle_length)
+  logging.info('Host budget: %d local ranks, %d cores per rank, interleave '
+               'cycle length %d, map parallel calls %d', local_ranks,
+               rank_cores, interleave_cycle_length, map_parallel_calls)
+  return rank_cores, interleave_cycle_length, map_parallel_calls
+
+
+def decode_and_resize_record(raw_record, num_channels=NUM_CHANNELS,
+                             resize_min=_RESIZE_MIN):
+  """Decodes a record into the element stored in the decoded cache.
+
+  The image is decoded and resized, preserving its aspect ratio, so that its
+  smallest side is `resize_min`. The bounding boxes are relative to the image
+  size and need no adjustment.
+
+  Args:
+    raw_record: scalar Tensor tf.string containing a serialized
+      Example protocol buffer.
+    num_channels: Integer depth of the image buffer for decoding.
+    resize_min: The size of the smallest side of the cached image.
+
+  Returns:
+    Dict with the uint8 `image`, the int32 `label` and the `bbox` tensor.
+  """
+  image_buffer, label, bbox = parse_example_proto(raw_record)
+  image = tf.image.decode_jpeg(image_buffer, channels=num_channels)
+  image = _aspect_preserving_resize(image, resize_min)
+  image = tf.saturate_cast(tf.round(image), tf.uint8)
+  return {'image': image, 'label': label, 'bbox': bbox}
+
+
+def get_decoded_cache_filename(cache_dir, filename):
+  """Returns the cache file prefix of the decoded records of one input file.
+
+  Args:
+    cache_dir: The directory of the decoded cache.
+    filename: The input TFRecord file, a string or a scalar tf.string Tensor.
+  """
+  prefix = os.path.join(cache_dir, 'imagenet_decoded_%d_' % _RESIZE_MIN)
+  if isinstance(filename, str):
+    return prefix + os.path.basename(filename)
+  return tf.strings.join([prefix, tf.strings.regex_replace(filename, r'^.*/', '')])
+
+
+def is_decoded_cache_complete(cache_filename):
+  """Returns whether the cache of one input file was completely written."""
+  # tf.data writes the index when the cache is complete and removes the lock
+  # file of its writer.
+  return (tf.io.gfile.exists(cache_filename + '.index') and
+          not tf.io.gfile.glob(cache_filename + '*.lockfile'))
+
+
+def read_decoded_files(filenames, cache_dir, cycle_length, num_parallel_calls,
+                       map_parallel_calls, use_cache=True):
+  """Reads the decoded records of the input files through their caches.
+
+  Every input file is cached in its own file, so the cache is shared by the
+  ranks of a host and reused by later runs with any number of ranks.
+
+  Args:
+    filenames: A dataset of input TFRecord files.
+    cache_dir: The directory of the decoded cache.
+    cycle_length: The number of files read at once.
+    num_parallel_calls: The parallelism of the file interleave.
+    map_parallel_calls: The decode parallelism of every file.
+    use_cache: Whether to read and fill the cache, or decode the files again.
+
+  Returns:
+    A dataset of the dicts returned by decode_and_resize_record.
+  """
+  def read_file(filename):
+    dataset = tf.data.TFRecordDataset(filename).map(
+        decode_and_resize_record, num_parallel_calls=map_parallel_calls,
+        deterministic=True)
+    if use_cache:
+      dataset = dataset.cache(get_decoded_cache_filename(cache_dir, filename))
+    return dataset
+
+  return filenames.interleave(
+      read_file,
+      cycle_length=cycle_length,
+      num_parallel_calls=num_parallel_calls,
+      deterministic=True)
+
+
 def input_fn(is_training,
              data_dir,
              batch_size,
@@ -313,7 +534,8 @@ def input_fn(is_training,
              training_dataset_cache=False,
              filenames=None,
              experimental_preloading=False,
-             use_distributed_eval=False):
+             use_distributed_eval=False,
+             decoded_cache_dir=None):
   """Input function which provides batches for train or eval.
 
   Args:
@@ -333,19 +555,54 @@ def input_fn(is_training,
        Typically used to improve training performance when training data is in
        remote storage and can fit into worker memory.
     filenames: Optional field for providing the file names of the TFRecords.
+    decoded_cache_dir: Directory of the on-disk cache of decoded images,
+      defaults to --decoded_cache_dir. Each input file is cached in its own
+      file, so all ranks of a host can use the same directory and the cache is
+      reused by later runs with any sharding. When every rank reads all the
+      files, only the first local rank fills the cache.
 
   Returns:
     A dataset that can be used for iteration.
   """
+  if decoded_cache_dir is None:
+    decoded_cache_dir = flags.FLAGS.decoded_cache_dir
   if filenames is None:
     filenames = get_filenames(is_training, data_dir)
+
+  if flags.FLAGS.bind_dataloader_cores:
+    if hw_topology is None:
+      raise ValueError('--bind_dataloader_cores requires the repository root in PYTHONPATH')
+    # tf.data runs on threads of this process, so the whole rank is pinned.
+    binding = hw_topology.bind_rank()
+    if binding is None:
+      logging.warning('--bind_dataloader_cores: no local rank in the environment, not pinning')
+    else:
+      logging.info('Pinned local rank %d to compute cores %s and data loader cores %s',
+                   binding.local_rank, binding.compute_cpus, binding.dataloader_cpus)
+      datasets_num_private_threads = (datasets_num_private_threads or
+                                      len(binding.dataloader_cpus))
+
+  interleave_cycle_length = flags.FLAGS.interleave_cycle_length
+  interleave_parallel_calls = flags.FLAGS.dataset_parallel_calls
+  map_parallel_calls = None
+  if flags.FLAGS.dataset_host_budget:
+    stage_timings = measure_pipeline_stages(
+        filenames[hvd.rank() % len(filenames) if hvd and hvd.is_initialized() else 0],
+        parse_record_fn, is_training, dtype, decoded_cache=bool(decoded_cache_dir))
+    rank_cores, interleave_cycle_length, map_parallel_calls = (
+        get_host_budgeted_parallelism(stage_timings, decoded_cache=bool(decoded_cache_dir)))
+    interleave_parallel_calls = interleave_cycle_length
+    datasets_num_private_threads = datasets_num_private_threads or rank_cores
+
   dataset = tf.data.Dataset.from_tensor_slices(filenames)
+  sharded = False
 
   if hvd and hvd.is_initialized() and (is_training or use_distributed_eval):
     logging.info(
       'HVD sharding the dataset: input_pipeline_id=%d num_input_pipelines=%d',
       hvd.rank(), hvd.size())
     dataset = dataset.shard(hvd.size(), hvd.rank())
+    sharded = True
 
   if input_context:
     logging.info(
@@ -353,6 +610,56 @@ def input_fn(is_training,
         input_context.input_pipeline_id, input_context.num_input_pipelines)
     dataset = dataset.shard(input_context.num_input_pipelines,
                             input_context.input_pipeline_id)
+    sharded = True
+
+  if decoded_cache_dir:
+    # The files are not shuffled, so that every cache file is filled in the
+    # same order on every run; records are still shuffled by
+    # process_record_dataset.
+    tf.io.gfile.makedirs(decoded_cache_dir)
+    if map_parallel_calls:
+      # The host budget sized the interleave to read and decode the files.
+      file_map_parallel_calls = 1
+    else:
+      file_map_parallel_calls = flags.FLAGS.dataset_parallel_calls
+      if file_map_parallel_calls > 0:
+        file_map_parallel_calls = max(1, file_map_parallel_calls // interleave_cycle_length)
+    read_args = dict(cache_dir=decoded_cache_dir,
+                     cycle_length=interleave_cycle_length,
+                     num_parallel_calls=interleave_parallel_calls,
+                     map_parallel_calls=file_map_parallel_calls)
+    if sharded or not (hvd and hvd.is_initialized()) or hvd.local_rank() == 0:
+      logging.info('Caching decoded images in %s', decoded_cache_dir)
+      dataset = read_decoded_files(dataset, **read_args)
+    else:
+      # Every rank reads all the files, only the first local rank writes their
+      # caches. The other ranks read the caches completed before this call and
+      # decode the other files again; they cannot wait for the first rank,
+      # which fills the caches while iterating its own dataset.
+      cached = [filename for filename in filenames if is_decoded_cache_complete(
+          get_decoded_cache_filename(decoded_cache_dir, filename))]
+      uncached = [filename for filename in filenames if filename not in cached]
+      logging.info('Reading %d of %d files from the decoded images cache in %s',
+                   len(cached), len(filenames), decoded_cache_dir)
+      dataset = read_decoded_files(
+          tf.data.Dataset.from_tensor_slices(tf.constant(cached, dtype=tf.string)),
+          **read_args).concatenate(read_decoded_files(
+              tf.data.Dataset.from_tensor_slices(tf.constant(uncached, dtype=tf.string)),
+              use_cache=False, **read_args))
+
+    return process_record_dataset(
+        dataset=dataset,
+        is_training=is_training,
+        batch_size=batch_size,
+        shuffle_buffer=_SHUFFLE_BUFFER,
+        parse_record_fn=parse_record_fn,
+        dtype=dtype,
+        datasets_num_private_threads=datasets_num_private_threads,
+        drop_remainder=drop_remainder,
+        tf_data_experimental_slack=tf_data_experimental_slack,
+        experimental_preloading=experimental_preloading,
+        num_parallel_calls=map_parallel_calls
+    )
 
   if is_training:
     # Shuffle the input files
@@ -364,8 +671,8 @@ def input_fn(is_training,
   # CPU cores.
   dataset = dataset.interleave(
       tf.data.TFRecordDataset,
-      cycle_length=flags.FLAGS.interleave_cycle_length,
-      num_parallel_calls=flags.FLAGS.dataset_parallel_calls)
+      cycle_length=interleave_cycle_length,
+      num_parallel_calls=interleave_parallel_calls)
 
   if is_training and training_dataset_cache:
     # Improve training performance when training data is in remote storage and
@@ -382,7 +689,8 @@ def input_fn(is_training,
       datasets_num_private_threads=datasets_num_private_threads,
       drop_remainder=drop_remainder,
       tf_data_experimental_slack=tf_data_experimental_slack,
-      experimental_preloading=experimental_preloading
+      experimental_preloading=experimental_preloading,
+      num_parallel_calls=map_parallel_calls
   )
 
 
@@ -436,6 +744,37 @@ def _decode_crop_and_flip(image_buffer, bbox, num_channels):
   return cropped
 
 
+def _crop_and_flip(image, bbox):
+  """Crops a decoded image to a random part of the image, and randomly flips.
+
+  Same distortion as _decode_crop_and_flip, applied to an already decoded
+  image.
+
+  Args:
+    image: 3-D uint8 image tensor.
+    bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
+      where each coordinate is [0, 1) and the coordinates are arranged as
+      [ymin, xmin, ymax, xmax].
+
+  Returns:
+    3-D tensor with cropped image.
+  """
+  bbox_begin, bbox_size, _ = tf.image.sample_distorted_bounding_box(
+      tf.shape(input=image),
+      bounding_boxes=bbox,
+      seed=flags.FLAGS.sample_distorted_bounding_box_seed,
+      min_object_covered=0.1,
+      aspect_ratio_range=[0.75, 1.33],
+      area_range=[0.05, 1.0],
+      max_attempts=100,
+      use_image_if_no_bounding_boxes=True)
+  cropped = tf.slice(image, bbox_begin, bbox_size)
+
+  # Flip to add a little more random distortion in.
+  cropped = tf.image.random_flip_left_right(cropped, seed=flags.FLAGS.random_flip_left_right_seed)
+  return cropped
+
+
 def _central_crop(image, crop_height, crop_width):
   """Performs central crops of the given image list.
 
@@ -599,3 +938,36 @@ def preprocess_image(image_buffer, bbox, output_height, output_width,
   image.set_shape([output_height, output_width, num_channels])
 
   return _mean_image_subtraction(image, CHANNEL_MEANS, num_channels)
+
+
+def preprocess_decoded_image(image, bbox, output_height, output_width,
+                             num_channels, is_training=False):
+  """Preprocesses an image of the decoded cache.
+
+  Same as preprocess_image for an image that was already decoded and resized
+  to the resize minimum by decode_and_resize_record.
+
+  Args:
+    image: 3-D uint8 image tensor.
+    bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
+      where each coordinate is [0, 1) and the coordinates are arranged as
+      [ymin, xmin, ymax, xmax].
+    output_height: The height of the image after preprocessing.
+    output_width: The width of the image after preprocessing.
+    num_channels: Integer depth of the image.
+    is_training: `True` if we're preprocessing the image for training and
+      `False` otherwise.
+
+  Returns:
+    A preprocessed image.
+  """
+  if is_training:
+    image = _crop_and_flip(image, bbox)
+    image = _resize_image(image, output_height, output_width)
+  else:
+    image = _central_crop(image, output_height, output_width)
+    image = tf.cast(image, tf.float32)
+
+  image.set_shape([output_height, output_width, num_channels])
+
+  return _mean_image_subtraction(image, CHANNEL_MEANS, num_channels)
@@ -12,6 +12,7 @@
 # - Added steps-based training duration specification via --steps_per_epoch and --validation_steps flags
 # - Added StepLearningRateScheduleWithWarmup learning rate scheduler for warmup
 # - Added deterministic mode
+# - Added per-step timing breakdown via --step_timing flag
 
 import tensorflow as tf
 from tensorflow.keras.optimizers import SGD
@@ -29,7 +30,7 @@ from habana_frameworks.tensorflow import load_habana_module
 from habana_frameworks.tensorflow.multinode_helpers import comm_size, comm_rank
 from habana_frameworks.tensorflow.distribute import HPUStrategy
 from TensorFlow.common.tb_utils import (
-    TensorBoardWithHParamsV2, ExamplesPerSecondKerasHookV2)
+    TensorBoardWithHParamsV2, ExamplesPerSecondKerasHookV2, StepTimer)
 
 import os
 import random
@@ -184,13 +185,19 @@ def main():
             log_dir = os.path.join(log_dir, 'worker_' + str(comm_rank()))
             local_batch_size = batch_size // strategy.num_replicas_in_sync
 
+        step_timer = None
+        if args.step_timing:
+            # model.fit pulls from the dataset inside the step, so there is no data wait series
+            step_timer = StepTimer(window_size=save_summary_steps,
+                                   log_file=os.path.join(log_dir, 'step_timing.jsonl'))
+
         callbacks += [
             TensorBoardWithHParamsV2(
                 args.__dict__, log_dir=log_dir,
                 update_freq=save_summary_steps, profile_batch=0),
             ExamplesPerSecondKerasHookV2(
                 save_summary_steps, output_dir=log_dir,
-                batch_size=local_batch_size),
+                batch_size=local_batch_size, step_timer=step_timer),
         ]
 
     if (args.evaluate_checkpoint_path is not None):
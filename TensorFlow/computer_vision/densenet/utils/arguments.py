@@ -52,6 +52,9 @@ class DenseNetArgumentParser(argparse.ArgumentParser):
                           help='steps between saving summaries to TensorBoard; '
                                'when None, logging to TensorBoard is disabled. '
                                '(enabling this option might affect the performance)')
+        self.add_argument('--step_timing', action='store_true',
+                          help='with --save_summary_steps, also log p50/p95/p99 of the step and '
+                               'callback time per step to step_timing.jsonl in the log directory')
         self.add_argument('--run_on_hpu', action='store_true',
                           help='whether to use HPU for training')
         self.add_argument('--use_hpu_strategy', action='store_true',
@@ -25,6 +25,7 @@ from __future__ import print_function
 
 import collections
 import numpy as np
+from TensorFlow.common.nms import batched_nms
 import tensorflow.compat.v1 as tf
 from object_detection import argmax_matcher
 from object_detection import box_list
@@ -393,56 +394,70 @@ def _generate_detections(cls_outputs, box_outputs, anchor_boxes, indices,
     detections: detection results in a tensor with each row representing
       [image_id, x, y, width, height, score, class]
   """
-  anchor_boxes = anchor_boxes[indices, :]
-  scores = sigmoid(cls_outputs)
+  return _generate_detections_batch(
+      cls_outputs[np.newaxis], box_outputs[np.newaxis], anchor_boxes,
+      indices[np.newaxis], classes[np.newaxis], np.reshape(image_id, [1]),
+      np.reshape(image_scale, [1]), num_classes)[0]
+
+
+def _generate_detections_batch(cls_outputs, box_outputs, anchor_boxes,
+                               indices, classes, image_ids, image_scales,
+                               num_classes):
+  """Generates detections of a batch of images with model outputs and anchors.
+
+  Runs the class-wise nms of all the images at once with
+  TensorFlow.common.nms.batched_nms, and selects the same detections as the
+  nms of every class of every image.
+
+  Args:
+    cls_outputs: a numpy array with shape [batch_size, N, 1], which has the
+      highest class scores on all feature levels.
+    box_outputs: a numpy array with shape [batch_size, N, 4], which stacks box
+      regression outputs on all feature levels.
+    anchor_boxes: a numpy array with shape [num_anchors, 4], which stacks
+      anchors on all feature levels.
+    indices: a numpy array with shape [batch_size, N], which is the indices
+      from top-k selection.
+    classes: a numpy array with shape [batch_size, N], which represents the
+      class prediction on all selected anchors from top-k selection.
+    image_ids: a numpy array with shape [batch_size] of the image ids.
+    image_scales: a numpy array with shape [batch_size] of the scales between
+      original images and input images for the detector.
+    num_classes: a integer that indicates the number of classes.
+
+  Returns:
+    detections: detection results in a numpy array with shape
+      [batch_size, MAX_DETECTIONS_PER_IMAGE, 7], with each row representing
+      [image_id, x, y, width, height, score, class], padded with dummy
+      detections.
+  """
+  batch_size, num_boxes = indices.shape
+  scores = sigmoid(cls_outputs)[:, :, 0]
   # apply bounding box regression to anchors
   boxes = decode_box_outputs(
-      box_outputs.swapaxes(0, 1), anchor_boxes.swapaxes(0, 1))
-  boxes = boxes[:, [1, 0, 3, 2]]
-  # run class-wise nms
-  detections = []
-  for c in range(num_classes):
-    indices = np.where(classes == c)[0]
-    if indices.shape[0] == 0:
-      continue
-    boxes_cls = boxes[indices, :]
-    scores_cls = scores[indices]
-    # Select top-scoring boxes in each class and apply non-maximum suppression
-    # (nms) for boxes in the same class. The selected boxes from each class are
-    # then concatenated for the final detection outputs.
-    all_detections_cls = np.column_stack((boxes_cls, scores_cls))
-    top_detection_idx = nms(all_detections_cls, 0.5)
-    top_detections_cls = all_detections_cls[top_detection_idx]
-    top_detections_cls[:, 2] -= top_detections_cls[:, 0]
-    top_detections_cls[:, 3] -= top_detections_cls[:, 1]
-    top_detections_cls = np.column_stack(
-        (np.repeat(image_id, len(top_detection_idx)),
-         top_detections_cls,
-         np.repeat(c + 1, len(top_detection_idx)))
-    )
-    detections.append(top_detections_cls)
-
-  def _generate_dummy_detections(number):
-    detections_dummy = np.zeros((number, 7), dtype=np.float32)
-    detections_dummy[:, 0] = image_id[0]
-    detections_dummy[:, 5] = _DUMMY_DETECTION_SCORE
-    return detections_dummy
-
-  if detections:
-    detections = np.vstack(detections)
-    # take final 100 detections
-    indices = np.argsort(-detections[:, -2])
-    detections = np.array(
-        detections[indices[0:MAX_DETECTIONS_PER_IMAGE]], dtype=np.float32)
-    # Add dummy detections to fill up to 100 detections
-    n = max(MAX_DETECTIONS_PER_IMAGE - len(detections), 0)
-    detections_dummy = _generate_dummy_detections(n)
-    detections = np.vstack([detections, detections_dummy])
-    detections[:, 1:5] *= image_scale
-  else:
-    detections = _generate_dummy_detections(MAX_DETECTIONS_PER_IMAGE)
-    detections[:, 1:5] *= image_scale
-
+      np.reshape(box_outputs, [-1, 4]).swapaxes(0, 1),
+      np.reshape(anchor_boxes[indices], [-1, 4]).swapaxes(0, 1))
+  boxes = np.reshape(boxes, [batch_size, num_boxes, 4])[:, :, [1, 0, 3, 2]]
+  # run class-wise nms, boxes of different classes do not suppress each other.
+  selected, _ = batched_nms(
+      boxes, scores, classes, 0.5, MAX_DETECTIONS_PER_IMAGE,
+      valid=(classes >= 0) & (classes < num_classes), pixel_offset=1.0)
+
+  detections = np.zeros((batch_size, MAX_DETECTIONS_PER_IMAGE, 7),
+                        dtype=np.float32)
+  detections[:, :, 0] = np.reshape(image_ids, [batch_size, 1])
+  detections[:, :, 5] = _DUMMY_DETECTION_SCORE
+  is_selected = selected >= 0
+  selected = np.maximum(selected, 0)
+  top_boxes = np.take_along_axis(boxes, selected[:, :, np.newaxis], axis=1)
+  top_boxes[:, :, 2:] -= top_boxes[:, :, :2]
+  detections[:, :, 1:5] = np.where(is_selected[:, :, np.newaxis], top_boxes, 0)
+  detections[:, :, 5] = np.where(
+      is_selected, np.take_along_axis(scores, selected, axis=1),
+      _DUMMY_DETECTION_SCORE)
+  detections[:, :, 6] = np.where(
+      is_selected, np.take_along_axis(classes, selected, axis=1) + 1, 0)
+  detections[:, :, 1:5] *= np.reshape(image_scales, [batch_size, 1, 1])
   return detections
 
 
@@ -600,3 +615,11 @@ class AnchorLabeler(object):
           cls_outputs, box_outputs, self._anchors.boxes, indices, classes,
           image_id, image_scale, self._num_classes
       ], tf.float32)
+
+  def generate_detections_batch(self, cls_outputs, box_outputs, indices,
+                                classes, image_ids, image_scales):
+    """Generate detections of a batch of images in a single py_func."""
+    return tf.py_func(_generate_detections_batch, [
+        cls_outputs, box_outputs, self._anchors.boxes, indices, classes,
+        image_ids, image_scales, self._num_classes
+    ], tf.float32)
@@ -0,0 +1,110 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+"""Tests for the detections generated by anchors."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import anchors
+
+
+def _generate_detections_per_class(cls_outputs, box_outputs, anchor_boxes,
+                                   indices, classes, image_id, image_scale,
+                                   num_classes):
+  """Runs the nms of every class one at a time, as anchors did before."""
+  scores = anchors.sigmoid(cls_outputs)
+  boxes = anchors.decode_box_outputs(
+      box_outputs.swapaxes(0, 1), anchor_boxes[indices, :].swapaxes(0, 1))
+  boxes = boxes[:, [1, 0, 3, 2]]
+  detections = []
+  for c in range(num_classes):
+    indices_cls = np.where(classes == c)[0]
+    if indices_cls.shape[0] == 0:
+      continue
+    all_detections_cls = np.column_stack(
+        (boxes[indices_cls, :], scores[indices_cls]))
+    top_detections_cls = all_detections_cls[
+        anchors.nms(all_detections_cls, 0.5)]
+    top_detections_cls[:, 2] -= top_detections_cls[:, 0]
+    top_detections_cls[:, 3] -= top_detections_cls[:, 1]
+    detections.append(np.column_stack(
+        (np.repeat(image_id, len(top_detections_cls)), top_detections_cls,
+         np.repeat(c + 1, len(top_detections_cls)))))
+
+  detections = np.vstack(detections)
+  detections = np.array(
+      detections[np.argsort(-detections[:, -2])]
+      [:anchors.MAX_DETECTIONS_PER_IMAGE], dtype=np.float32)
+  dummy_detections = np.zeros(
+      (anchors.MAX_DETECTIONS_PER_IMAGE - len(detections), 7),
+      dtype=np.float32)
+  dummy_detections[:, 0] = image_id[0]
+  dummy_detections[:, 5] = anchors._DUMMY_DETECTION_SCORE
+  detections = np.vstack([detections, dummy_detections])
+  detections[:, 1:5] *= image_scale
+  return detections
+
+
+class GenerateDetectionsTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(GenerateDetectionsTest, self).setUp()
+    rng = np.random.RandomState(1234)
+    self.num_classes = 5
+    self.batch_size = 3
+    num_anchors, num_boxes = 2000, 1000
+    # Anchors clustered in a small image, so that many boxes overlap.
+    centers = rng.uniform(0, 64, (num_anchors, 2))
+    sizes = rng.uniform(4, 32, (num_anchors, 2))
+    self.anchor_boxes = np.concatenate(
+        [centers - sizes / 2, centers + sizes / 2], axis=1).astype(np.float32)
+    self.cls_outputs = rng.randn(
+        self.batch_size, num_boxes, 1).astype(np.float32)
+    self.box_outputs = (rng.randn(self.batch_size, num_boxes, 4) *
+                        0.2).astype(np.float32)
+    self.indices = rng.randint(0, num_anchors, (self.batch_size, num_boxes))
+    self.classes = rng.randint(
+        0, self.num_classes, (self.batch_size, num_boxes))
+    self.image_ids = np.array([3, 1, 4])
+    self.image_scales = np.array([1.0, 0.5, 2.0], dtype=np.float32)
+
+  def test_generate_detections(self):
+    for i in range(self.batch_size):
+      args = (self.cls_outputs[i], self.box_outputs[i], self.anchor_boxes,
+              self.indices[i], self.classes[i], self.image_ids[i:i + 1],
+              self.image_scales[i:i + 1], self.num_classes)
+      self.assertAllEqual(anchors._generate_detections(*args),
+                          _generate_detections_per_class(*args))
+
+  def test_generate_detections_batch(self):
+    detections = anchors._generate_detections_batch(
+        self.cls_outputs, self.box_outputs, self.anchor_boxes, self.indices,
+        self.classes, self.image_ids, self.image_scales, self.num_classes)
+    self.assertEqual(detections.shape,
+                     (self.batch_size, anchors.MAX_DETECTIONS_PER_IMAGE, 7))
+    for i in range(self.batch_size):
+      self.assertAllEqual(
+          detections[i],
+          anchors._generate_detections(
+              self.cls_outputs[i], self.box_outputs[i], self.anchor_boxes,
+              self.indices[i], self.classes[i], self.image_ids[i:i + 1],
+              self.image_scales[i:i + 1], self.num_classes))
+
+  def test_generate_dummy_detections(self):
+    detections = anchors._generate_detections(
+        self.cls_outputs[0, :10], self.box_outputs[0, :10], self.anchor_boxes,
+        self.indices[0, :10], np.full([10], self.num_classes),
+        self.image_ids[:1], self.image_scales[:1], self.num_classes)
+    self.assertAllEqual(detections[:, 0], np.full([100], 3))
+    self.assertAllEqual(detections[:, 1:5], np.zeros([100, 4]))
+    self.assertAllEqual(detections[:, 5],
+                        np.full([100], anchors._DUMMY_DETECTION_SCORE))
+
+
+if __name__ == '__main__':
+  tf.disable_v2_behavior()
+  tf.test.main()
@@ -346,19 +346,29 @@ def coco_metric_fn(batch_size,
                    **kwargs):
   """Evaluation metric fn. Performed on CPU, do not reference TPU ops."""
   # add metrics to output
-  detections_bs = []
-  for index in range(batch_size):
-    cls_outputs_per_sample = kwargs['cls_outputs_all'][index]
-    box_outputs_per_sample = kwargs['box_outputs_all'][index]
-    indices_per_sample = kwargs['indices_all'][index]
-    classes_per_sample = kwargs['classes_all'][index]
-    detections = anchor_labeler.generate_detections(
-        cls_outputs_per_sample, box_outputs_per_sample, indices_per_sample,
-        classes_per_sample, tf.slice(kwargs['source_ids'], [index], [1]),
-        tf.slice(kwargs['image_scales'], [index], [1]),
-        disable_pyfun=kwargs.get('disable_pyfun', None),
-    )
-    detections_bs.append(detections)
+  if kwargs.get('disable_pyfun', None):
+    detections_bs = []
+    for index in range(batch_size):
+      cls_outputs_per_sample = kwargs['cls_outputs_all'][index]
+      box_outputs_per_sample = kwargs['box_outputs_all'][index]
+      indices_per_sample = kwargs['indices_all'][index]
+      classes_per_sample = kwargs['classes_all'][index]
+      detections = anchor_labeler.generate_detections(
+          cls_outputs_per_sample, box_outputs_per_sample, indices_per_sample,
+          classes_per_sample, tf.slice(kwargs['source_ids'], [index], [1]),
+          tf.slice(kwargs['image_scales'], [index], [1]),
+          disable_pyfun=True,
+      )
+      detections_bs.append(detections)
+  else:
+    # Runs the nms of the whole batch in one py_func.
+    detections_bs = anchor_labeler.generate_detections_batch(
+        kwargs['cls_outputs_all'][:batch_size],
+        kwargs['box_outputs_all'][:batch_size],
+        kwargs['indices_all'][:batch_size],
+        kwargs['classes_all'][:batch_size],
+        kwargs['source_ids'][:batch_size],
+        kwargs['image_scales'][:batch_size])
 
   if testdev_dir:
     eval_metric = coco_metric.EvaluationMetric(testdev_dir=testdev_dir)
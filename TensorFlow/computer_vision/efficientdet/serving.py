@@ -0,0 +1,432 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+r"""Dynamic micro-batching serving of EfficientDet.
+
+ServingDriver runs one sess.run for the batch of every caller. MicroBatcher
+queues the images of concurrent callers instead and serves them in batches:
+
+- a batch is dispatched when it has max_batch_size images, or max_wait_ms
+  after its oldest image arrived. The wait is counted from the oldest image,
+  so the images queued while the previous batch ran are dispatched at once,
+  and the batches grow with the load.
+- batches are padded, by repeating their last image, to the smallest of a few
+  fixed batch shapes, so that the device only runs graphs of these shapes.
+- images of different shapes are batched separately.
+
+The batcher serves in-process calls to predict() and submit(), and HTTP
+requests with make_http_server, and reports the p50/p99 latency and the
+images/sec. It runs the model with one ServingDriver per batch shape, or with
+a StandInModel simulating the device time, to load test it on CPU:
+
+python serving.py --runmode=load_test --num_clients=32 --max_batch_size=8 \
+    --max_wait_ms=5
+
+python serving.py --runmode=http --model_name=efficientdet-d0 \
+    --ckpt_path=/tmp/efficientdet-d0 --port=8080
+curl --data-binary @img.jpg http://localhost:8080/detect
+curl http://localhost:8080/stats
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import io
+import json
+import threading
+import time
+from concurrent import futures
+from http import server
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+from PIL import Image
+
+
+def default_batch_shapes(max_batch_size):
+  """Returns the powers of 2 below max_batch_size, and max_batch_size."""
+  batch_shapes = []
+  batch_size = 1
+  while batch_size < max_batch_size:
+    batch_shapes.append(batch_size)
+    batch_size *= 2
+  return batch_shapes + [max_batch_size]
+
+
+class ServingStats(object):
+  """Latency and throughput of the images served by a MicroBatcher."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._latencies = []
+      self._batch_sizes = []
+      self._padded_batch_sizes = []
+      self._start_time = None
+      self._end_time = None
+
+  def record(self, enqueue_times, padded_batch_size, end_time):
+    """Records a batch served at end_time."""
+    with self._lock:
+      self._latencies.extend(end_time - t for t in enqueue_times)
+      self._batch_sizes.append(len(enqueue_times))
+      self._padded_batch_sizes.append(padded_batch_size)
+      start_time = min(enqueue_times)
+      if self._start_time is None or start_time < self._start_time:
+        self._start_time = start_time
+      self._end_time = end_time
+
+  def summary(self):
+    """Returns a dictionary of the serving metrics."""
+    with self._lock:
+      if not self._latencies:
+        return {'num_images': 0}
+      num_images = len(self._latencies)
+      latencies_ms = np.array(self._latencies) * 1000
+      return {
+          'num_images': num_images,
+          'num_batches': len(self._batch_sizes),
+          'images_per_sec': num_images / max(
+              self._end_time - self._start_time, 1e-9),
+          'latency_p50_ms': float(np.percentile(latencies_ms, 50)),
+          'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+          'mean_batch_size': float(np.mean(self._batch_sizes)),
+          'padding_ratio': 1 - num_images / sum(self._padded_batch_sizes),
+      }
+
+
+_Request = collections.namedtuple('_Request', ['image', 'future',
+                                               'enqueue_time'])
+
+
+class MicroBatcher(object):
+  """Queues the images of concurrent callers and serves them in batches.
+
+  Example usage:
+
+    serve_fn = build_serve_fn('efficientdet-d0', '/tmp/efficientdet-d0',
+                              default_batch_shapes(8))
+    with MicroBatcher(serve_fn, max_batch_size=8, max_wait_ms=5) as batcher:
+      predictions = batcher.predict(np.array(Image.open('img.jpg')))
+      print(batcher.stats.summary())
+  """
+
+  def __init__(self,
+               serve_fn,
+               max_batch_size=8,
+               max_wait_ms=5.0,
+               batch_shapes=None):
+    """Initialize the batcher and start its worker thread.
+
+    Args:
+      serve_fn: a function serving an array of images with shape
+        [batch_size, height, width, 3], batch_size being one of batch_shapes,
+        and returning the predictions of every image.
+      max_batch_size: maximum number of images of a batch.
+      max_wait_ms: maximum time a batch waits for more images after its oldest
+        image arrived.
+      batch_shapes: the batch sizes the batches are padded to. If None, use
+        default_batch_shapes(max_batch_size).
+    """
+    self._serve_fn = serve_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait = max_wait_ms / 1000
+    self._batch_shapes = sorted(batch_shapes or
+                                default_batch_shapes(max_batch_size))
+    if self._batch_shapes[-1] < max_batch_size:
+      raise ValueError('The largest batch shape %d is smaller than '
+                       'max_batch_size %d' %
+                       (self._batch_shapes[-1], max_batch_size))
+
+    self.stats = ServingStats()
+    # Queued requests of every image shape, in arrival order.
+    self._pending = collections.OrderedDict()
+    self._cond = threading.Condition()
+    self._closed = False
+    self._worker = threading.Thread(target=self._run, name='micro_batcher')
+    self._worker.daemon = True
+    self._worker.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def submit(self, image):
+    """Queues an image and returns a future of its predictions."""
+    image = np.asarray(image)
+    request = _Request(image, futures.Future(), time.time())
+    with self._cond:
+      if self._closed:
+        raise RuntimeError('MicroBatcher is closed')
+      self._pending.setdefault(image.shape, collections.deque()).append(request)
+      self._cond.notify()
+    return request.future
+
+  def predict(self, image, timeout=None):
+    """Serves an image and returns its predictions."""
+    return self.submit(image).result(timeout)
+
+  def close(self):
+    """Serves the queued images and stops the worker thread."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._worker.join()
+
+  def batch_shape(self, batch_size):
+    """Returns the batch size a batch of batch_size images is padded to."""
+    for batch_shape in self._batch_shapes:
+      if batch_shape >= batch_size:
+        return batch_shape
+    raise ValueError('No batch shape for %d images' % batch_size)
+
+  def _next_batch(self):
+    """Waits for the next batch, returns None once closed and drained."""
+    with self._cond:
+      while not self._pending:
+        if self._closed:
+          return None
+        self._cond.wait()
+
+      image_shape = min(self._pending,
+                        key=lambda shape: self._pending[shape][0].enqueue_time)
+      queue = self._pending[image_shape]
+      deadline = queue[0].enqueue_time + self._max_wait
+      while len(queue) < self._max_batch_size and not self._closed:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        self._cond.wait(timeout)
+
+      batch = [queue.popleft()
+               for _ in range(min(len(queue), self._max_batch_size))]
+      if not queue:
+        del self._pending[image_shape]
+      return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+
+      batch_shape = self.batch_shape(len(batch))
+      images = [request.image for request in batch]
+      images += [images[-1]] * (batch_shape - len(batch))
+      try:
+        predictions = self._serve_fn(np.stack(images))
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception('Failed to serve a batch of %d images', len(batch))
+        for request in batch:
+          request.future.set_exception(e)
+        continue
+
+      # Recorded before the futures resolve, so that the stats of a batch are
+      # visible to the clients it answers.
+      self.stats.record([request.enqueue_time for request in batch],
+                        batch_shape, time.time())
+      for request, prediction in zip(batch, predictions):
+        request.future.set_result(prediction)
+
+
+class StandInModel(object):
+  """Stands in for the model, taking the time of the device for a batch."""
+
+  def __init__(self, batch_ms=10.0, image_ms=2.0, max_detections=100):
+    """Initialize the stand-in model.
+
+    Args:
+      batch_ms: fixed time of every batch.
+      image_ms: additional time of every image of the batch.
+      max_detections: number of detections of every image.
+    """
+    self.batch_ms = batch_ms
+    self.image_ms = image_ms
+    self.max_detections = max_detections
+
+  def __call__(self, image_arrays):
+    batch_size = len(image_arrays)
+    time.sleep((self.batch_ms + self.image_ms * batch_size) / 1000)
+    # [image_id, x, y, width, height, score, class], as ServingDriver.
+    detections = np.zeros((batch_size, self.max_detections, 7),
+                          dtype=np.float32)
+    detections[:, :, 0] = np.arange(batch_size)[:, np.newaxis]
+    return detections
+
+
+def build_serve_fn(model_name,
+                   ckpt_path,
+                   batch_shapes,
+                   image_size=None,
+                   min_score_thresh=0.2,
+                   max_boxes_to_draw=50):
+  """Builds a ServingDriver for every batch shape, returns their serve_fn."""
+  import tensorflow.compat.v1 as tf  # pylint: disable=g-import-not-at-top
+  import inference  # pylint: disable=g-import-not-at-top
+
+  drivers = {}
+  for batch_size in batch_shapes:
+    driver = inference.ServingDriver(model_name, ckpt_path, image_size,
+                                     batch_size=batch_size)
+    # Every batch shape is a graph of its own, restored in its own session.
+    driver.sess = tf.Session(graph=tf.Graph())
+    driver.build(min_score_thresh=min_score_thresh,
+                 max_boxes_to_draw=max_boxes_to_draw)
+    drivers[batch_size] = driver
+
+  def serve_fn(image_arrays):
+    return drivers[len(image_arrays)].serve_images(image_arrays)
+
+  return serve_fn
+
+
+def make_http_server(batcher, port, host='127.0.0.1'):
+  """Returns an HTTP server of the batcher.
+
+  POST /detect with an encoded image returns its detections as JSON, and GET
+  /stats returns the serving metrics.
+  """
+
+  class Handler(server.BaseHTTPRequestHandler):
+    """Serves the requests with the batcher."""
+
+    def _send_json(self, code, content):
+      body = json.dumps(content).encode()
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      if self.path != '/stats':
+        self._send_json(404, {'error': 'Not found: %s' % self.path})
+        return
+      self._send_json(200, batcher.stats.summary())
+
+    def do_POST(self):  # pylint: disable=invalid-name
+      if self.path != '/detect':
+        self._send_json(404, {'error': 'Not found: %s' % self.path})
+        return
+      body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      try:
+        image = np.array(Image.open(io.BytesIO(body)).convert('RGB'))
+      except IOError as e:
+        self._send_json(400, {'error': 'Invalid image: %s' % e})
+        return
+      try:
+        detections = batcher.predict(image)
+      except Exception as e:  # pylint: disable=broad-except
+        self._send_json(500, {'error': str(e)})
+        return
+      self._send_json(200, {'detections': np.asarray(detections).tolist()})
+
+    def log_message(self, *args):
+      logging.debug(*args)
+
+  http_server = server.ThreadingHTTPServer((host, port), Handler)
+  http_server.daemon_threads = True
+  return http_server
+
+
+def run_load_test(batcher, images, num_clients, num_requests):
+  """Sends num_requests images from num_clients concurrent clients.
+
+  Every client sends its next image as soon as it has the predictions of the
+  previous one.
+
+  Returns:
+    The serving metrics of the requests.
+  """
+  batcher.stats.reset()
+  counter = iter(range(num_requests))
+  lock = threading.Lock()
+
+  def client():
+    while True:
+      with lock:
+        i = next(counter, None)
+      if i is None:
+        return
+      batcher.predict(images[i % len(images)])
+
+  clients = [threading.Thread(target=client) for _ in range(num_clients)]
+  for thread in clients:
+    thread.start()
+  for thread in clients:
+    thread.join()
+  return batcher.stats.summary()
+
+
+flags.DEFINE_string('runmode', 'load_test', 'Run mode: {load_test, http}')
+flags.DEFINE_string('model_name', 'efficientdet-d0', 'Model.')
+flags.DEFINE_string('ckpt_path', None,
+                    'Checkpoint dir, if None serve a stand-in model.')
+flags.DEFINE_integer('image_size', 512, 'Size of the load test images.')
+flags.DEFINE_integer('max_batch_size', 8, 'Maximum images of a batch.')
+flags.DEFINE_float('max_wait_ms', 5.0, 'Maximum wait of a batch for images.')
+flags.DEFINE_list('batch_shapes', None,
+                  'Batch sizes the batches are padded to, if None the powers '
+                  'of 2 up to max_batch_size.')
+flags.DEFINE_float('stand_in_batch_ms', 10.0,
+                   'Fixed time of every batch of the stand-in model.')
+flags.DEFINE_float('stand_in_image_ms', 2.0,
+                   'Time of every image of the stand-in model.')
+flags.DEFINE_integer('num_clients', 16, 'Concurrent load test clients.')
+flags.DEFINE_integer('num_requests', 2000, 'Number of load test requests.')
+flags.DEFINE_integer('port', 8080, 'Port of the HTTP server.')
+
+FLAGS = flags.FLAGS
+
+
+def main(_):
+  if FLAGS.batch_shapes:
+    batch_shapes = sorted(int(b) for b in FLAGS.batch_shapes)
+  else:
+    batch_shapes = default_batch_shapes(FLAGS.max_batch_size)
+
+  if FLAGS.ckpt_path:
+    serve_fn = build_serve_fn(FLAGS.model_name, FLAGS.ckpt_path, batch_shapes)
+  else:
+    logging.info('No ckpt_path, serving a stand-in model')
+    serve_fn = StandInModel(FLAGS.stand_in_batch_ms, FLAGS.stand_in_image_ms)
+
+  with MicroBatcher(serve_fn, FLAGS.max_batch_size, FLAGS.max_wait_ms,
+                    batch_shapes) as batcher:
+    if FLAGS.runmode == 'load_test':
+      rng = np.random.RandomState(0)
+      images = [
+          rng.randint(0, 256, (FLAGS.image_size, FLAGS.image_size, 3),
+                      dtype=np.uint8) for _ in range(8)
+      ]
+      # Warm up the graphs of every batch shape.
+      for batch_size in batch_shapes:
+        serve_fn(np.stack([images[0]] * batch_size))
+      summary = run_load_test(batcher, images, FLAGS.num_clients,
+                              FLAGS.num_requests)
+      for key, value in summary.items():
+        print('%s: %s' % (key, value))
+    elif FLAGS.runmode == 'http':
+      http_server = make_http_server(batcher, FLAGS.port)
+      logging.info('Serving on port %d', FLAGS.port)
+      try:
+        http_server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+      finally:
+        http_server.server_close()
+        logging.info('Serving stats: %s', batcher.stats.summary())
+    else:
+      raise ValueError('Unknown runmode %s' % FLAGS.runmode)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,127 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+"""Tests for serving."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+import threading
+from urllib import request as urllib_request
+
+import numpy as np
+from PIL import Image
+import tensorflow.compat.v1 as tf
+
+import serving
+
+
+class RecordingModel(object):
+  """Returns the batch index of every image, and records the batch sizes."""
+
+  def __init__(self):
+    self.batch_sizes = []
+
+  def __call__(self, image_arrays):
+    self.batch_sizes.append(len(image_arrays))
+    return [image[0, 0, 0] for image in image_arrays]
+
+
+class MicroBatcherTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(MicroBatcherTest, self).setUp()
+    self.model = RecordingModel()
+
+  def images(self, num_images, size=4):
+    return [np.full((size, size, 3), i, dtype=np.uint8)
+            for i in range(num_images)]
+
+  def test_default_batch_shapes(self):
+    self.assertEqual(serving.default_batch_shapes(1), [1])
+    self.assertEqual(serving.default_batch_shapes(8), [1, 2, 4, 8])
+    self.assertEqual(serving.default_batch_shapes(6), [1, 2, 4, 6])
+
+  def test_max_batch_size(self):
+    with serving.MicroBatcher(self.model, max_batch_size=4,
+                              max_wait_ms=1000) as batcher:
+      results = [batcher.submit(image) for image in self.images(8)]
+      self.assertEqual([r.result(10) for r in results], list(range(8)))
+    self.assertEqual(self.model.batch_sizes, [4, 4])
+
+  def test_max_wait(self):
+    with serving.MicroBatcher(self.model, max_batch_size=8,
+                              max_wait_ms=1) as batcher:
+      self.assertEqual(batcher.predict(self.images(1)[0], timeout=10), 0)
+    self.assertEqual(self.model.batch_sizes, [1])
+
+  def test_padding(self):
+    with serving.MicroBatcher(self.model, max_batch_size=8,
+                              max_wait_ms=1000) as batcher:
+      self.assertEqual(batcher.batch_shape(3), 4)
+      results = [batcher.submit(image) for image in self.images(3)]
+    self.assertEqual([r.result() for r in results], [0, 1, 2])
+    self.assertEqual(self.model.batch_sizes, [4])
+    summary = batcher.stats.summary()
+    self.assertEqual(summary['num_images'], 3)
+    self.assertEqual(summary['num_batches'], 1)
+    self.assertAllClose(summary['padding_ratio'], 0.25)
+    self.assertGreaterEqual(summary['latency_p99_ms'],
+                            summary['latency_p50_ms'])
+
+  def test_image_shapes(self):
+    images = self.images(2, size=4) + self.images(2, size=8)
+    with serving.MicroBatcher(self.model, max_batch_size=4,
+                              max_wait_ms=1000) as batcher:
+      results = [batcher.submit(image) for image in images]
+    self.assertEqual([r.result() for r in results], [0, 1, 0, 1])
+    self.assertEqual(self.model.batch_sizes, [2, 2])
+
+  def test_batch_shapes(self):
+    with self.assertRaises(ValueError):
+      serving.MicroBatcher(self.model, max_batch_size=8, batch_shapes=[1, 4])
+
+  def test_serve_fn_error(self):
+
+    def serve_fn(image_arrays):
+      raise RuntimeError('device error')
+
+    with serving.MicroBatcher(serve_fn, max_batch_size=2) as batcher:
+      with self.assertRaisesRegex(RuntimeError, 'device error'):
+        batcher.predict(self.images(1)[0], timeout=10)
+
+  def test_load_test(self):
+    model = serving.StandInModel(batch_ms=1, image_ms=0)
+    with serving.MicroBatcher(model, max_batch_size=4,
+                              max_wait_ms=1) as batcher:
+      summary = serving.run_load_test(batcher, self.images(2), num_clients=8,
+                                      num_requests=64)
+    self.assertEqual(summary['num_images'], 64)
+    self.assertGreater(summary['images_per_sec'], 0)
+    self.assertGreater(summary['mean_batch_size'], 1)
+
+  def test_http_server(self):
+    with serving.MicroBatcher(self.model, max_batch_size=2) as batcher:
+      http_server = serving.make_http_server(batcher, 0)
+      thread = threading.Thread(target=http_server.serve_forever)
+      thread.start()
+      try:
+        url = 'http://127.0.0.1:%d' % http_server.server_address[1]
+        image = io.BytesIO()
+        Image.fromarray(self.images(8)[7]).save(image, format='PNG')
+        response = urllib_request.urlopen(
+            urllib_request.Request(url + '/detect', data=image.getvalue()))
+        self.assertEqual(json.loads(response.read()), {'detections': 7})
+        stats = json.loads(urllib_request.urlopen(url + '/stats').read())
+        self.assertEqual(stats['num_images'], 1)
+      finally:
+        http_server.shutdown()
+        http_server.server_close()
+        thread.join()
+
+
+if __name__ == '__main__':
+  tf.disable_v2_behavior()
+  tf.test.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Benchmark of the anchor target cache of the training input.
+
+Parses the same training images with the training dataset_parser, matching
+the anchors on the fly and looking them up in an anchor target cache built with
+`python -m mask_rcnn.anchor_target_cache`, and reports the images per second
+of both, and the hits and misses of the cache.
+
+python benchmark_anchor_targets.py \
+    --training_file_pattern="/data/train-*.tfrecord" \
+    --anchor_target_cache=/data/anchor_target_cache --num_images 2000
+"""
+
+import argparse
+import functools
+import time
+
+import tensorflow as tf
+
+from mask_rcnn.anchor_target_cache import AnchorTargetCache
+from mask_rcnn.dataloader_utils import dataset_parser
+from mask_rcnn.hyperparameters import mask_rcnn_params
+
+
+def run_parser(file_pattern, params, num_images, num_parallel_calls, anchor_target_cache):
+    dataset = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+    dataset = dataset.flat_map(tf.data.TFRecordDataset).take(num_images)
+    dataset = dataset.map(
+        functools.partial(
+            dataset_parser,
+            mode=tf.estimator.ModeKeys.TRAIN,
+            params=params,
+            use_instance_mask=params['include_mask'],
+            anchor_target_cache=anchor_target_cache
+        ),
+        num_parallel_calls=num_parallel_calls
+    )
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    start = time.time()
+    count = 0
+    for _ in dataset:
+        count += 1
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the Mask R-CNN anchor target cache')
+    parser.add_argument('--training_file_pattern', required=True, help='TFRecords file pattern for the training files')
+    parser.add_argument('--anchor_target_cache', required=True, help='Directory of the anchor target cache')
+    parser.add_argument('--num_images', type=int, default=1000)
+    parser.add_argument('--num_parallel_calls', type=int, default=tf.data.experimental.AUTOTUNE)
+    args = parser.parse_args()
+
+    params = mask_rcnn_params.default_config().values()
+    anchor_target_cache = AnchorTargetCache(args.anchor_target_cache)
+    anchor_target_cache.check_params(params)
+
+    # Reads the records once, so that both runs read them from the page cache.
+    for _ in tf.data.Dataset.list_files(args.training_file_pattern, shuffle=False).flat_map(
+            tf.data.TFRecordDataset).take(args.num_images):
+        pass
+
+    results = {}
+    for name, cache in (('on the fly', None), ('cached', anchor_target_cache)):
+        results[name] = run_parser(args.training_file_pattern, params, args.num_images, args.num_parallel_calls, cache)
+
+    print('{:>12} {:>12}'.format('matching', 'images/sec'))
+    for name, images_per_sec in results.items():
+        print('{:>12} {:>12.1f}'.format(name, images_per_sec))
+    print('speedup {:.2f}x, cache hits {}, misses {}'.format(
+        results['cached'] / results['on the fly'], anchor_target_cache.hits, anchor_target_cache.misses))
+
+
+if __name__ == '__main__':
+    main()
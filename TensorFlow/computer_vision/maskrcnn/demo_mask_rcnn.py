@@ -134,7 +134,11 @@ def create_command_str(args):
         cmd_parts.append(f'--train_batch_size={args.train_batch_size}')
     if args.eval_batch_size is not None:
         cmd_parts.append(f'--eval_batch_size={args.eval_batch_size}')
+    if args.eval_processes is not None:
+        cmd_parts.append(f'--eval_processes={args.eval_processes}')
     cmd_parts.append(f'--training_file_pattern="{args.dataset}/train-*.tfrecord"')
+    if args.anchor_target_cache is not None:
+        cmd_parts.append(f'--anchor_target_cache="{args.anchor_target_cache}"')
     cmd_parts.append(f'--validation_file_pattern="{args.dataset}/val-*.tfrecord"')
     cmd_parts.append(f'--val_json_file="{args.dataset}/{val_json_file}"')
     if args.pyramid_roi_impl is not None:
@@ -193,6 +197,8 @@ if __name__ == '__main__':
     parser.add_argument('--eval_samples', metavar='<samples>', help='Number of eval samples. Number of steps will be divided by "eval_batch_size".',
                         type=int, default=5000)
     parser.add_argument('--eval_batch_size', metavar='<eval_batch_size>', help='Batch size for evaluation.', type=int)
+    parser.add_argument('--eval_processes', metavar='<eval_processes>', help='Number of processes of the COCO evaluation, the number of CPUs by default.', type=int)
+    parser.add_argument('--anchor_target_cache', metavar='<anchor_target_cache>', help='Directory of the anchor matchings of the training images, built with "python -m mask_rcnn.anchor_target_cache".')
     parser.add_argument('--num_steps_per_eval', metavar='<num_steps_per_eval>', help='Number of steps used for evaluation.', type=int)
     parser.add_argument('--deterministic', help='Enable deterministic behavior', action='store_true', default=False)
     parser.add_argument('--seed', metavar='<seed>', help='Seed to be used by model.', type=int)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Offline cache of the anchor matchings of the training images.
+
+The only augmentation of the training images is a random horizontal flip, so
+the anchors of a training image are matched with its groundtruth boxes in one
+of two ways. The cache stores both matchings of every training image, keyed by
+its source id, and the training parser looks them up instead of computing the
+IoU of every anchor with every box again on every epoch. The score targets are
+still subsampled at random, and the box targets encoded, from the looked up
+matching; images missing from the cache are matched on the fly.
+
+Only the anchors matched with a box and the ignored anchors are stored, the
+other anchors are negatives. The cache directory contains:
+  params.json: the parameters of the matching the cache was built with.
+  source_ids.npy: the sorted source ids of the cached images.
+  spans.npy: [num_images, 2, 2] array, the anchors of the image source_ids[i]
+    are [begin, end) = spans[i, flip] in the two following files.
+  anchor_indices.bin: int32 indices of the anchors.
+  anchor_matches.bin: int16 match results of the anchors, the index of the
+    matched box or -2 for ignored anchors.
+
+Usage, with the flags of mask_rcnn_main.py, so that the cache is built with the
+parameters of the training run:
+
+python -m mask_rcnn.anchor_target_cache \
+    --training_file_pattern="/data/train-*.tfrecord" \
+    --anchor_target_cache="/data/anchor_target_cache"
+"""
+
+import functools
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from mask_rcnn import dataloader_utils
+from mask_rcnn.utils.logging_formatter import logging
+
+PARAMS_FILENAME = 'params.json'
+
+# Parameters the anchor matching of a training image depends on.
+CACHE_PARAMS = (
+    'image_size',
+    'min_level',
+    'max_level',
+    'num_scales',
+    'aspect_ratios',
+    'anchor_scale',
+    'rpn_positive_overlap',
+    'rpn_negative_overlap',
+    'skip_crowd_during_training',
+)
+
+
+def cache_params(params):
+    """Returns the parameters of the anchor matching, as stored in params.json."""
+    return json.loads(json.dumps({key: params[key] for key in CACHE_PARAMS}))
+
+
+def write_anchor_target_cache(cache_dir, params, matchings):
+    """Writes the anchor matchings of the training images to cache_dir.
+
+    Args:
+      cache_dir: the cache directory, created if it does not exist.
+      params: the parameters the anchors were matched with.
+      matchings: iterable of (source_id, match_results) pairs, match_results
+        being an integer array of shape [2, num_anchors] of the match results of
+        the image and of the flipped image.
+
+    Returns:
+      the numbers of cached images and of skipped source ids. Images without a
+      source id, or sharing it with another image, are skipped.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    source_ids = []
+    spans = []
+    size = 0
+    with open(os.path.join(cache_dir, 'anchor_indices.bin'), 'wb') as indices_file, \
+            open(os.path.join(cache_dir, 'anchor_matches.bin'), 'wb') as matches_file:
+        for source_id, match_results in matchings:
+            for flip_match_results in match_results:
+                indices = np.flatnonzero(flip_match_results != -1)
+                indices_file.write(indices.astype('<i4').tobytes())
+                matches_file.write(flip_match_results[indices].astype('<i2').tobytes())
+                spans.append((size, size + len(indices)))
+                size += len(indices)
+            source_ids.append(source_id)
+
+    source_ids = np.array(source_ids, dtype=np.int64)
+    spans = np.array(spans, dtype=np.int64).reshape([-1, 2, 2])
+
+    unique_ids, id_counts = np.unique(source_ids, return_counts=True)
+    skipped_ids = unique_ids[(id_counts > 1) | (unique_ids == -1)]
+    kept = np.logical_not(np.isin(source_ids, skipped_ids))
+    order = np.argsort(source_ids[kept])
+    np.save(os.path.join(cache_dir, 'source_ids.npy'), source_ids[kept][order])
+    np.save(os.path.join(cache_dir, 'spans.npy'), spans[kept][order])
+
+    # Written last, a cache without params.json is incomplete.
+    with open(os.path.join(cache_dir, PARAMS_FILENAME), 'w') as f:
+        json.dump(cache_params(params), f, indent=2)
+
+    return int(np.sum(kept)), len(skipped_ids)
+
+
+def _load_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros([0], dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class AnchorTargetCache(object):
+    """Anchor matchings of the training images, looked up by source id.
+
+    Counts the hits and misses of the lookups, and logs them every
+    `log_every_n_lookups` lookups.
+    """
+
+    def __init__(self, cache_dir, log_every_n_lookups=10000):
+        params_path = os.path.join(cache_dir, PARAMS_FILENAME)
+        if not os.path.isfile(params_path):
+            raise FileNotFoundError("Anchor target cache not found: %s" % cache_dir)
+
+        with open(params_path) as f:
+            self._params = json.load(f)
+
+        self._cache_dir = cache_dir
+        self._source_ids = np.load(os.path.join(cache_dir, 'source_ids.npy'))
+        self._spans = np.load(os.path.join(cache_dir, 'spans.npy'))
+        self._anchor_indices = _load_array(os.path.join(cache_dir, 'anchor_indices.bin'), '<i4')
+        self._anchor_matches = _load_array(os.path.join(cache_dir, 'anchor_matches.bin'), '<i2')
+
+        self._log_every_n_lookups = log_every_n_lookups
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._source_ids)
+
+    def check_params(self, params):
+        """Raises a ValueError if `params` match the anchors unlike the cache."""
+        expected_params = cache_params(params)
+        if expected_params != self._params:
+            raise ValueError(
+                "The anchor target cache %s was built with %s, rebuild it for %s" %
+                (self._cache_dir, self._params, expected_params)
+            )
+
+    def get(self, source_id, flip):
+        """Returns the cached anchor indices and match results, None on a miss."""
+        i = np.searchsorted(self._source_ids, source_id)
+        hit = i < len(self._source_ids) and self._source_ids[i] == source_id
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            if (self.hits + self.misses) % self._log_every_n_lookups == 0:
+                logging.info("Anchor target cache: %d hits, %d misses" % (self.hits, self.misses))
+
+        if not hit:
+            return None
+
+        begin, end = self._spans[i, int(flip)]
+        return self._anchor_indices[begin:end], self._anchor_matches[begin:end]
+
+    def match_results(self, source_id, flip, num_anchors, match_fn):
+        """Looks up the match results of the anchors of a training image.
+
+        Args:
+          source_id: int64 scalar tensor, the source id of the image.
+          flip: boolean scalar tensor, whether the image is flipped.
+          num_anchors: integer number of anchors.
+          match_fn: a function returning the match results, called on a miss.
+
+        Returns:
+          match_results: int32 tensor with shape [num_anchors], as returned by
+            AnchorLabeler.match_anchors.
+        """
+        def lookup(source_id, flip):
+            cached = self.get(source_id, flip)
+            if cached is None:
+                return np.array(False), np.zeros([0], np.int32), np.zeros([0], np.int32)
+
+            anchor_indices, anchor_matches = cached
+            return np.array(True), anchor_indices.astype(np.int32), anchor_matches.astype(np.int32)
+
+        hit, anchor_indices, anchor_matches = tf.numpy_function(
+            lookup, [source_id, flip], [tf.bool, tf.int32, tf.int32]
+        )
+        hit.set_shape([])
+        anchor_indices.set_shape([None])
+        anchor_matches.set_shape([None])
+
+        def cached_match_results():
+            return tf.tensor_scatter_nd_update(
+                tf.fill([num_anchors], -1),
+                tf.expand_dims(anchor_indices, axis=1),
+                anchor_matches
+            )
+
+        match_results = tf.cond(hit, cached_match_results, match_fn)
+        match_results.set_shape([num_anchors])
+        return match_results
+
+
+def anchor_matchings(file_pattern, params):
+    """Yields the source id and the anchor matchings of the training images."""
+    dataset = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=8,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+    dataset = dataset.map(
+        functools.partial(dataloader_utils.anchor_matches_parser, params=params),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    for step, (source_id, match_results) in enumerate(dataset.as_numpy_iterator()):
+        if (step + 1) % 1000 == 0:
+            logging.info("Matched the anchors of %d images" % (step + 1))
+        yield source_id, match_results
+
+
+if __name__ == "__main__":
+    from absl import app
+
+    from mask_rcnn.hyperparameters import mask_rcnn_params
+    from mask_rcnn.hyperparameters import params_io
+    from mask_rcnn.hyperparameters.cmdline_utils import define_hparams_flags
+
+    FLAGS = define_hparams_flags()
+
+    def main(argv):
+        del argv  # Unused.
+
+        logging.set_verbosity(logging.INFO)
+
+        if not FLAGS.training_file_pattern or not FLAGS.anchor_target_cache:
+            raise ValueError("--training_file_pattern and --anchor_target_cache are required")
+
+        # The parameters of the training run, as built by mask_rcnn_main.py
+        params = params_io.override_hparams(mask_rcnn_params.default_config(), FLAGS.flag_values_dict()).values()
+
+        num_images, num_skipped = write_anchor_target_cache(
+            FLAGS.anchor_target_cache,
+            params,
+            anchor_matchings(FLAGS.training_file_pattern, params)
+        )
+
+        logging.info("Cached the anchor matchings of %d images in %s" % (num_images, FLAGS.anchor_target_cache))
+        if num_skipped:
+            logging.warning("Skipped %d source ids missing or shared by several images" % num_skipped)
+
+    app.run(main)
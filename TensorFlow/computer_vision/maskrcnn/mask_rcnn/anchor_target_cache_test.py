@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Tests for mask_rcnn.anchor_target_cache."""
+
+import numpy as np
+import tensorflow as tf
+
+from mask_rcnn import anchor_target_cache
+from mask_rcnn.hyperparameters import mask_rcnn_params
+
+
+class AnchorTargetCacheTest(tf.test.TestCase):
+
+    def setUp(self):
+        super(AnchorTargetCacheTest, self).setUp()
+        self.params = mask_rcnn_params.default_config().values()
+        self.cache_dir = self.get_temp_dir()
+        rng = np.random.RandomState(1234)
+        num_anchors = 1000
+        # Mostly negative anchors, as the matchings of the training images.
+        self.matchings = [
+            (source_id, np.where(rng.uniform(size=[2, num_anchors]) < 0.9, -1,
+                                 rng.randint(-2, 20, size=[2, num_anchors])).astype(np.int32))
+            for source_id in [42, 7, 123456789012, 3]
+        ]
+        self.matchings[1][1][1] = -1
+
+    def write_cache(self, matchings):
+        return anchor_target_cache.write_anchor_target_cache(self.cache_dir, self.params, matchings)
+
+    def test_get(self):
+        self.assertEqual(self.write_cache(self.matchings), (4, 0))
+        cache = anchor_target_cache.AnchorTargetCache(self.cache_dir)
+        self.assertLen(cache, 4)
+        for source_id, match_results in self.matchings:
+            for flip in (False, True):
+                anchor_indices, anchor_matches = cache.get(source_id, flip)
+                cached_match_results = np.full_like(match_results[int(flip)], -1)
+                cached_match_results[anchor_indices] = anchor_matches
+                self.assertAllEqual(cached_match_results, match_results[int(flip)])
+        self.assertEqual((cache.hits, cache.misses), (8, 0))
+
+    def test_get_missing_source_ids(self):
+        matchings = self.matchings + [(-1, self.matchings[0][1]), (7, self.matchings[0][1])]
+        self.assertEqual(self.write_cache(matchings), (3, 2))
+        cache = anchor_target_cache.AnchorTargetCache(self.cache_dir)
+        for source_id in [-1, 7, 0, 5, 2 ** 40]:
+            self.assertIsNone(cache.get(source_id, False))
+        self.assertIsNotNone(cache.get(3, True))
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+    def test_empty_matchings(self):
+        self.write_cache([(5, np.full([2, 10], -1, dtype=np.int32))])
+        anchor_indices, anchor_matches = anchor_target_cache.AnchorTargetCache(self.cache_dir).get(5, True)
+        self.assertEmpty(anchor_indices)
+        self.assertEmpty(anchor_matches)
+
+    def test_check_params(self):
+        self.write_cache(self.matchings)
+        cache = anchor_target_cache.AnchorTargetCache(self.cache_dir)
+        cache.check_params(dict(self.params))
+        with self.assertRaises(ValueError):
+            cache.check_params(dict(self.params, image_size=(1024, 1024)))
+
+    def test_missing_cache(self):
+        with self.assertRaises(FileNotFoundError):
+            anchor_target_cache.AnchorTargetCache(self.cache_dir)
+
+
+if __name__ == '__main__':
+    tf.test.main()
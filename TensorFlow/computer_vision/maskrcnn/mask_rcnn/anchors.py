@@ -15,6 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added AnchorLabeler.match_anchors, and label_anchors accepts its results
+
 """Mask-RCNN anchor definition."""
 
 from __future__ import absolute_import
@@ -30,6 +37,7 @@ from mask_rcnn.object_detection import argmax_matcher
 from mask_rcnn.object_detection import balanced_positive_negative_sampler
 from mask_rcnn.object_detection import box_list
 from mask_rcnn.object_detection import faster_rcnn_box_coder
+from mask_rcnn.object_detection import matcher
 from mask_rcnn.object_detection import region_similarity_calculator
 from mask_rcnn.object_detection import target_assigner
 
@@ -253,7 +261,25 @@ class AnchorLabeler(object):
     return (ignore_labels + positive_labels + negative_labels,
             positive_labels, negative_labels)
 
-  def label_anchors(self, gt_boxes, gt_labels):
+  def match_anchors(self, gt_boxes):
+    """Matches anchors with ground truth boxes.
+
+    The matching only depends on the anchors and the boxes, unlike the score
+    targets of label_anchors which subsample the matched anchors at random.
+    Args:
+      gt_boxes: A float tensor with shape [N, 4] representing groundtruth boxes.
+        For each row, it stores [y0, x0, y1, x1] for four corners of a box.
+    Returns:
+      match_results: A integer tensor with shape [num_anchors]. (1)
+        match_results[i]>=0, meaning that anchor i is matched with box
+        match_results[i]. (2) match_results[i]=-1, meaning that anchor i is not
+        matched. (3) match_results[i]=-2, meaning that anchor i is ignored.
+    """
+    match = self._target_assigner.match(
+        box_list.BoxList(self._anchors.boxes), box_list.BoxList(gt_boxes))
+    return match.match_results
+
+  def label_anchors(self, gt_boxes, gt_labels, match_results=None):
     """Labels anchors with ground truth inputs.
 
     Args:
@@ -261,6 +287,8 @@ class AnchorLabeler(object):
         For each row, it stores [y0, x0, y1, x1] for four corners of a box.
       gt_labels: A integer tensor with shape [N, 1] representing groundtruth
         classes.
+      match_results: (Optional) the results of match_anchors for gt_boxes, the
+        anchors are matched with gt_boxes if None.
     Returns:
       score_targets_dict: ordered dictionary with keys
         [min_level, min_level+1, ..., max_level]. The values are tensor with
@@ -275,9 +303,13 @@ class AnchorLabeler(object):
     gt_box_list = box_list.BoxList(gt_boxes)
     anchor_box_list = box_list.BoxList(self._anchors.boxes)
 
+    match = None
+    if match_results is not None:
+      match = matcher.Match(match_results)
+
     # cls_targets, cls_weights, box_weights are not used
     _, _, box_targets, _, matches = self._target_assigner.assign(
-        anchor_box_list, gt_box_list, gt_labels)
+        anchor_box_list, gt_box_list, gt_labels, match=match)
 
     # score_targets contains the subsampled positive and negative anchors.
     score_targets, _, _ = self._get_rpn_samples(matches.match_results)
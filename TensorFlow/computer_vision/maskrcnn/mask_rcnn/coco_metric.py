@@ -15,6 +15,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added detection_results_to_coco_records and loadRes of its records
+# - added the COCO evaluation of chunks of images in parallel processes
+# - added encode_masks_in_boxes, RLE-encoding the box masks without pasting
+#   them on image canvases
+
 """COCO-style evaluation metrics.
 
 Implements the interface of COCO API and metric_fn in tf.TPUEstimator.
@@ -26,7 +36,10 @@ from __future__ import division
 from __future__ import print_function
 import atexit
 
+import contextlib
 import copy
+import io
+import multiprocessing
 import tempfile
 import numpy as np
 
@@ -86,10 +99,15 @@ class MaskCOCO(COCO):
     res = MaskCOCO()
     res.dataset['images'] = [img for img in self.dataset['images']]
     logging.info('Loading and preparing results...')
-    predictions = self.load_predictions(
-        detection_results,
-        include_mask=include_mask,
-        is_image_mask=is_image_mask)
+    if isinstance(detection_results, list):
+      # Records of detection_results_to_coco_records(), copied since the ids
+      # and areas are added to them below.
+      predictions = [dict(pred) for pred in detection_results]
+    else:
+      predictions = self.load_predictions(
+          detection_results,
+          include_mask=include_mask,
+          is_image_mask=is_image_mask)
     assert isinstance(predictions, list), 'results in not an array of objects'
     if predictions:
       image_ids = [pred['image_id'] for pred in predictions]
@@ -137,18 +155,47 @@ class MaskCOCO(COCO):
       a list of dictionary including different prediction results from the model
         in numpy form.
     """
-    predictions = []
-    num_detections = detection_results['detection_scores'].size
-    current_index = 0
-    for i, image_id in enumerate(detection_results['source_id']):
+    return detection_results_to_coco_records(
+        detection_results, include_mask, is_image_mask=is_image_mask)
 
-      if include_mask:
-        box_coorindates_in_image = detection_results['detection_boxes'][i]
+
+def detection_results_to_coco_records(detection_results,
+                                      include_mask,
+                                      is_image_mask=False):
+  """Converts detection results to COCO result records.
+
+  The records are compact, with the masks RLE-encoded, so the detections of a
+  batch can be converted as soon as they are predicted and the records sent to
+  the process running the evaluation.
+
+  Args:
+    detection_results: a dictionary containing numpy arrays which corresponds
+      to prediction results.
+    include_mask: a boolean, whether to include mask in detection results.
+    is_image_mask: a boolean, where the predict mask is a whole image mask.
+
+  Returns:
+    a list of dictionary including different prediction results from the model
+      in numpy form.
+  """
+  predictions = []
+  num_detections = detection_results['detection_scores'].size
+  current_index = 0
+  for i, image_id in enumerate(detection_results['source_id']):
+
+    if include_mask:
+      image_num_detections = int(detection_results['num_detections'][i])
+      masks = detection_results['detection_masks'][i][:image_num_detections]
+      box_coorindates_in_image = (
+          detection_results['detection_boxes'][i][:image_num_detections])
+      image_height = int(detection_results['image_info'][i][3])
+      image_width = int(detection_results['image_info'][i][4])
+      if is_image_mask:
         segments = generate_segmentation_from_masks(
-            detection_results['detection_masks'][i],
+            masks,
             box_coorindates_in_image,
-            int(detection_results['image_info'][i][3]),
-            int(detection_results['image_info'][i][4]),
+            image_height,
+            image_width,
             is_image_mask=is_image_mask
         )
 
@@ -157,27 +204,103 @@ class MaskCOCO(COCO):
             maskUtils.encode(np.asfortranarray(instance_mask.astype(np.uint8)))
             for instance_mask in segments
         ]
+      else:
+        encoded_masks = encode_masks_in_boxes(
+            masks, box_coorindates_in_image, image_height, image_width)
+
+    for box_index in range(int(detection_results['num_detections'][i])):
+      if current_index % 1000 == 0:
+        logging.info('{}/{}'.format(current_index, num_detections))
+
+      current_index += 1
+
+      prediction = {
+          'image_id': int(image_id),
+          'bbox': detection_results['detection_boxes'][i][box_index].tolist(),
+          'score': detection_results['detection_scores'][i][box_index],
+          'category_id': int(
+              detection_results['detection_classes'][i][box_index]),
+      }
+
+      if include_mask:
+        prediction['segmentation'] = encoded_masks[box_index]
+
+      predictions.append(prediction)
+
+  return predictions
 
-      for box_index in range(int(detection_results['num_detections'][i])):
-        if current_index % 1000 == 0:
-          logging.info('{}/{}'.format(current_index, num_detections))
 
-        current_index += 1
+def _expand_boxes(boxes, scale):
+  """Expands an array of boxes by a given scale."""
+  # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/utils/boxes.py#L227
+  # The `boxes` in the reference implementation is in [x1, y1, x2, y2] form,
+  # whereas `boxes` here is in [x1, y1, w, h] form
+  w_half = boxes[:, 2] * .5
+  h_half = boxes[:, 3] * .5
+  x_c = boxes[:, 0] + w_half
+  y_c = boxes[:, 1] + h_half
 
-        prediction = {
-            'image_id': int(image_id),
-            'bbox': detection_results['detection_boxes'][i][box_index].tolist(),
-            'score': detection_results['detection_scores'][i][box_index],
-            'category_id': int(
-                detection_results['detection_classes'][i][box_index]),
-        }
+  w_half *= scale
+  h_half *= scale
 
-        if include_mask:
-          prediction['segmentation'] = encoded_masks[box_index]
+  boxes_exp = np.zeros(boxes.shape)
+  boxes_exp[:, 0] = x_c - w_half
+  boxes_exp[:, 2] = x_c + w_half
+  boxes_exp[:, 1] = y_c - h_half
+  boxes_exp[:, 3] = y_c + h_half
 
-        predictions.append(prediction)
+  return boxes_exp
 
-    return predictions
+
+def _paste_masks_in_boxes(masks, detected_boxes, image_height, image_width):
+  """Yields the part of every mask inside the image, resized to its box.
+
+  Args:
+    masks: a numpy array of shape [N, mask_height, mask_width] representing the
+      instance masks w.r.t. the `detected_boxes`.
+    detected_boxes: a numpy array of shape [N, 4] representing the reference
+      bounding boxes.
+    image_height: an integer representing the height of the image.
+    image_width: an integer representing the width of the image.
+
+  Yields:
+    (mask, y_0, x_0) tuples, where mask is the binary uint8 mask of the image
+      region starting at row y_0 and column x_0.
+  """
+  # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/core/test.py#L812
+  # To work around an issue with cv2.resize (it seems to automatically pad
+  # with repeated border values), we manually zero-pad the masks by 1 pixel
+  # prior to resizing back to the original image resolution. This prevents
+  # "top hat" artifacts. We therefore need to expand the reference boxes by an
+  # appropriate factor.
+
+  _, mask_height, mask_width = masks.shape
+  scale = max((mask_width + 2.0) / mask_width,
+              (mask_height + 2.0) / mask_height)
+
+  ref_boxes = _expand_boxes(detected_boxes, scale)
+  ref_boxes = ref_boxes.astype(np.int32)
+  padded_masks = np.zeros((masks.shape[0], mask_height + 2, mask_width + 2),
+                          dtype=np.float32)
+  padded_masks[:, 1:-1, 1:-1] = masks
+  widths = np.maximum(ref_boxes[:, 2] - ref_boxes[:, 0] + 1, 1)
+  heights = np.maximum(ref_boxes[:, 3] - ref_boxes[:, 1] + 1, 1)
+  x_0s = np.maximum(ref_boxes[:, 0], 0)
+  x_1s = np.minimum(ref_boxes[:, 2] + 1, image_width)
+  y_0s = np.maximum(ref_boxes[:, 1], 0)
+  y_1s = np.minimum(ref_boxes[:, 3] + 1, image_height)
+
+  for mask_ind, padded_mask in enumerate(padded_masks):
+    ref_box = ref_boxes[mask_ind, :]
+    x_0, x_1, y_0, y_1 = x_0s[mask_ind], x_1s[mask_ind], y_0s[mask_ind], y_1s[mask_ind]
+    if x_1 <= x_0 or y_1 <= y_0:
+      yield np.zeros((0, 0), dtype=np.uint8), 0, 0
+      continue
+
+    mask = cv2.resize(padded_mask, (widths[mask_ind], heights[mask_ind]))
+    mask = mask[(y_0 - ref_box[1]):(y_1 - ref_box[1]),
+                (x_0 - ref_box[0]):(x_1 - ref_box[0])]
+    yield np.array(mask > 0.5, dtype=np.uint8), y_0, x_0
 
 
 def generate_segmentation_from_masks(masks,
@@ -201,79 +324,154 @@ def generate_segmentation_from_masks(masks,
     segms: a numpy array of shape [N, image_height, image_width] representing
       the instance masks *pasted* on the image canvas.
   """
+  segms = np.zeros((masks.shape[0], image_height, image_width), dtype=np.uint8)
+  if is_image_mask:
+    # Process whole-image masks.
+    segms[:, :, :] = masks
+  else:
+    # Process mask inside bounding boxes.
+    pasted_masks = _paste_masks_in_boxes(masks, detected_boxes, image_height,
+                                         image_width)
+    for segm, (mask, y_0, x_0) in zip(segms, pasted_masks):
+      segm[y_0:y_0 + mask.shape[0], x_0:x_0 + mask.shape[1]] = mask
 
-  def expand_boxes(boxes, scale):
-    """Expands an array of boxes by a given scale."""
-    # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/utils/boxes.py#L227
-    # The `boxes` in the reference implementation is in [x1, y1, x2, y2] form,
-    # whereas `boxes` here is in [x1, y1, w, h] form
-    w_half = boxes[:, 2] * .5
-    h_half = boxes[:, 3] * .5
-    x_c = boxes[:, 0] + w_half
-    y_c = boxes[:, 1] + h_half
-
-    w_half *= scale
-    h_half *= scale
+  assert masks.shape[0] == segms.shape[0]
+  return segms
 
-    boxes_exp = np.zeros(boxes.shape)
-    boxes_exp[:, 0] = x_c - w_half
-    boxes_exp[:, 2] = x_c + w_half
-    boxes_exp[:, 1] = y_c - h_half
-    boxes_exp[:, 3] = y_c + h_half
 
-    return boxes_exp
+def encode_masks_in_boxes(masks, detected_boxes, image_height, image_width):
+  """RLE-encodes instance masks pasted on the image, without the image canvas.
 
-  # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/core/test.py#L812
-  # To work around an issue with cv2.resize (it seems to automatically pad
-  # with repeated border values), we manually zero-pad the masks by 1 pixel
-  # prior to resizing back to the original image resolution. This prevents
-  # "top hat" artifacts. We therefore need to expand the reference boxes by an
-  # appropriate factor.
+  Equivalent to encoding every mask of generate_segmentation_from_masks() with
+  maskUtils.encode(), but only the region of every box is pasted, and the
+  runs of the image in column-major order are found from the transitions of
+  that region, offset by its position.
 
-  _, mask_height, mask_width = masks.shape
-  scale = max((mask_width + 2.0) / mask_width,
-              (mask_height + 2.0) / mask_height)
+  Args:
+    masks: a numpy array of shape [N, mask_height, mask_width] representing the
+      instance masks w.r.t. the `detected_boxes`.
+    detected_boxes: a numpy array of shape [N, 4] representing the reference
+      bounding boxes.
+    image_height: an integer representing the height of the image.
+    image_width: an integer representing the width of the image.
 
-  ref_boxes = expand_boxes(detected_boxes, scale)
-  ref_boxes = ref_boxes.astype(np.int32)
-  padded_mask = np.zeros((mask_height + 2, mask_width + 2), dtype=np.float32)
-  segms = []
-  for mask_ind, mask in enumerate(masks):
-    im_mask = np.zeros((image_height, image_width), dtype=np.uint8)
-    if is_image_mask:
-      # Process whole-image masks.
-      im_mask[:, :] = mask[:, :]
-    else:
-      # Process mask inside bounding boxes.
-      padded_mask[1:-1, 1:-1] = mask[:, :]
+  Returns:
+    a list of N compressed RLEs.
+  """
+  num_pixels = image_height * image_width
+  uncompressed_rles = []
+  for mask, y_0, x_0 in _paste_masks_in_boxes(masks, detected_boxes,
+                                              image_height, image_width):
+    # The columns of the box, each padded with a zero at both ends, so that
+    # every run starts and ends in its column.
+    box_height = mask.shape[0]
+    columns = np.zeros((mask.shape[1], box_height + 2), dtype=np.int8)
+    columns[:, 1:-1] = mask.T
+    transitions = np.flatnonzero(np.diff(columns.ravel())) + 1
+    # Offsets of the run starts and ends in the column-major image.
+    column, row = np.divmod(transitions, box_height + 2)
+    offsets = (column + x_0) * image_height + (row - 1 + y_0)
+    # Merge the runs going on in the next column of full height boxes.
+    contiguous = np.flatnonzero(offsets[2::2] == offsets[1:-1:2])
+    if contiguous.size:
+      offsets = np.delete(offsets, np.concatenate(
+          (2 * contiguous + 1, 2 * contiguous + 2)))
+    # Alternating background and foreground run lengths.
+    counts = np.diff(np.concatenate(([0], offsets, [num_pixels])))
+    if offsets.size and not counts[-1]:
+      counts = counts[:-1]
+    uncompressed_rles.append({'counts': counts.tolist(),
+                              'size': [image_height, image_width]})
+  if not uncompressed_rles:
+    return []
+  return maskUtils.frPyObjects(uncompressed_rles, image_height, image_width)
+
+
+# COCOeval object evaluated by the processes of _evaluate_in_parallel(), which
+# inherit it when forked.
+_forked_coco_eval = None
+
+
+def _evaluate_images(image_ids):
+  """Returns the evalImgs of _forked_coco_eval restricted to image_ids."""
+  coco_eval = _forked_coco_eval
+  coco_eval.params.imgIds = list(image_ids)
+  with contextlib.redirect_stdout(io.StringIO()):
+    coco_eval.evaluate()
+  return coco_eval.evalImgs
 
-      ref_box = ref_boxes[mask_ind, :]
-      w = ref_box[2] - ref_box[0] + 1
-      h = ref_box[3] - ref_box[1] + 1
-      w = np.maximum(w, 1)
-      h = np.maximum(h, 1)
 
-      mask = cv2.resize(padded_mask, (w, h))
-      mask = np.array(mask > 0.5, dtype=np.uint8)
+def _evaluate_in_parallel(coco_eval, num_processes):
+  """Runs COCOeval.evaluate() on chunks of the images in parallel processes.
 
-      x_0 = max(ref_box[0], 0)
-      x_1 = min(ref_box[2] + 1, image_width)
-      y_0 = max(ref_box[1], 0)
-      y_1 = min(ref_box[3] + 1, image_height)
+  Every (image, category) pair is evaluated independently of the others, so
+  the per image results of the chunks are put together in the order of
+  COCOeval.evaluate(), category major, then area range, then image, and
+  accumulate() gives the same metrics as after a single evaluate().
+  """
+  global _forked_coco_eval
+  params = coco_eval.params
+  params.imgIds = list(np.unique(params.imgIds))
+  if params.useCats:
+    params.catIds = list(np.unique(params.catIds))
+  params.maxDets = sorted(params.maxDets)
+  image_chunks = [chunk for chunk in np.array_split(
+      params.imgIds, num_processes * 4) if chunk.size]
+
+  logging.info('Running per image {} evaluation in {} processes...'.format(
+      params.iouType, num_processes))
+  _forked_coco_eval = copy.copy(coco_eval)
+  _forked_coco_eval.params = copy.deepcopy(params)
+  try:
+    with multiprocessing.get_context('fork').Pool(num_processes) as pool:
+      chunk_eval_imgs = pool.map(_evaluate_images, image_chunks, chunksize=1)
+  finally:
+    _forked_coco_eval = None
+
+  num_images = len(params.imgIds)
+  num_cat_areas = (len(params.catIds) if params.useCats else 1) * len(
+      params.areaRng)
+  eval_imgs = [None] * (num_cat_areas * num_images)
+  offset = 0
+  for chunk, chunk_eval in zip(image_chunks, chunk_eval_imgs):
+    for cat_area in range(num_cat_areas):
+      start = cat_area * num_images + offset
+      eval_imgs[start:start + chunk.size] = (
+          chunk_eval[cat_area * chunk.size:(cat_area + 1) * chunk.size])
+    offset += chunk.size
+
+  coco_eval.evalImgs = eval_imgs
+  coco_eval._paramsEval = copy.deepcopy(params)
+
+
+def evaluate_coco(coco_gt, coco_dt, iou_type, image_ids, num_processes=1):
+  """Runs the COCO evaluation of coco_dt on image_ids.
 
-      im_mask[y_0:y_1, x_0:x_1] = mask[(y_0 - ref_box[1]):(y_1 - ref_box[1]), (
-          x_0 - ref_box[0]):(x_1 - ref_box[0])]
-    segms.append(im_mask)
+  Args:
+    coco_gt: COCO object of the groundtruth.
+    coco_dt: COCO object of the detections.
+    iou_type: 'bbox' or 'segm'.
+    image_ids: list of the evaluated image ids.
+    num_processes: number of processes evaluating the images.
 
-  segms = np.array(segms)
-  assert masks.shape[0] == segms.shape[0]
-  return segms
+  Returns:
+    a numpy array of the 12 COCO metrics.
+  """
+  coco_eval = COCOeval(coco_gt, coco_dt, iouType=iou_type)
+  coco_eval.params.imgIds = image_ids
+  if num_processes > 1 and len(image_ids) > 1:
+    _evaluate_in_parallel(coco_eval, num_processes)
+  else:
+    coco_eval.evaluate()
+  coco_eval.accumulate()
+  coco_eval.summarize()
+  return coco_eval.stats
 
 
 class EvaluationMetric(object):
   """COCO evaluation metric class."""
 
-  def __init__(self, filename, include_mask):
+  def __init__(self, filename, include_mask, num_processes=1):
     """Constructs COCO evaluation class.
 
     The class provides the interface to metrics_fn in TPUEstimator. The
@@ -284,7 +482,9 @@ class EvaluationMetric(object):
       filename: Ground truth JSON file name. If filename is None, use
         groundtruth data passed from the dataloader for evaluation.
       include_mask: boolean to indicate whether or not to include mask eval.
+      num_processes: number of processes running the per image evaluation.
     """
+    self._num_processes = num_processes
     if filename:
       if filename.startswith('gs://'):
         _, local_val_json = tempfile.mkstemp(suffix='.json')
@@ -317,25 +517,39 @@ class EvaluationMetric(object):
                         groundtruth_data=None):
     """Generates COCO metrics."""
     image_ids = list(set(predictions['source_id']))
+    return self._evaluate(predictions, image_ids, is_predict_image_mask,
+                          groundtruth_data)
+
+  def predict_records_metric_fn(self, records, image_ids):
+    """Generates COCO metrics of records of detection_results_to_coco_records.
+
+    Args:
+      records: list of the COCO result records of the detections.
+      image_ids: list of the ids of all the evaluated images, including the
+        ones without detections.
+
+    Returns:
+      the same metrics as predict_metric_fn() on the detection results the
+        records were converted from.
+    """
+    return self._evaluate(records, list(set(image_ids)))
+
+  def _evaluate(self,
+                predictions,
+                image_ids,
+                is_predict_image_mask=False,
+                groundtruth_data=None):
     if groundtruth_data is not None:
       self.coco_gt.reset(groundtruth_data)
     coco_dt = self.coco_gt.loadRes(
         predictions, self._include_mask, is_image_mask=is_predict_image_mask)
-    coco_eval = COCOeval(self.coco_gt, coco_dt, iouType='bbox')
-    coco_eval.params.imgIds = image_ids
-    coco_eval.evaluate()
-    coco_eval.accumulate()
-    coco_eval.summarize()
-    coco_metrics = coco_eval.stats
+    coco_metrics = evaluate_coco(self.coco_gt, coco_dt, 'bbox', image_ids,
+                                 self._num_processes)
 
     if self._include_mask:
       # Create another object for instance segmentation metric evaluation.
-      mcoco_eval = COCOeval(self.coco_gt, coco_dt, iouType='segm')
-      mcoco_eval.params.imgIds = image_ids
-      mcoco_eval.evaluate()
-      mcoco_eval.accumulate()
-      mcoco_eval.summarize()
-      mask_coco_metrics = mcoco_eval.stats
+      mask_coco_metrics = evaluate_coco(self.coco_gt, coco_dt, 'segm',
+                                        image_ids, self._num_processes)
 
     if self._include_mask:
       metrics = np.hstack((coco_metrics, mask_coco_metrics))
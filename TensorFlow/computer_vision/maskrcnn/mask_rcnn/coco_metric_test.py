@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Tests for mask_rcnn.coco_metric mask pasting and encoding."""
+
+import cv2
+import numpy as np
+import pycocotools.mask as maskUtils
+import tensorflow as tf
+
+from mask_rcnn import coco_metric
+
+
+def reference_segmentation_from_masks(masks, detected_boxes, image_height, image_width):
+  """Pastes the masks on image canvases, one mask at a time."""
+  _, mask_height, mask_width = masks.shape
+  scale = max((mask_width + 2.0) / mask_width, (mask_height + 2.0) / mask_height)
+
+  w_half = detected_boxes[:, 2] * .5
+  h_half = detected_boxes[:, 3] * .5
+  x_c = detected_boxes[:, 0] + w_half
+  y_c = detected_boxes[:, 1] + h_half
+  w_half *= scale
+  h_half *= scale
+  ref_boxes = np.zeros(detected_boxes.shape)
+  ref_boxes[:, 0] = x_c - w_half
+  ref_boxes[:, 2] = x_c + w_half
+  ref_boxes[:, 1] = y_c - h_half
+  ref_boxes[:, 3] = y_c + h_half
+  ref_boxes = ref_boxes.astype(np.int32)
+
+  padded_mask = np.zeros((mask_height + 2, mask_width + 2), dtype=np.float32)
+  segms = []
+  for mask_ind, mask in enumerate(masks):
+    im_mask = np.zeros((image_height, image_width), dtype=np.uint8)
+    padded_mask[1:-1, 1:-1] = mask[:, :]
+
+    ref_box = ref_boxes[mask_ind, :]
+    w = np.maximum(ref_box[2] - ref_box[0] + 1, 1)
+    h = np.maximum(ref_box[3] - ref_box[1] + 1, 1)
+
+    mask = cv2.resize(padded_mask, (w, h))
+    mask = np.array(mask > 0.5, dtype=np.uint8)
+
+    x_0 = max(ref_box[0], 0)
+    x_1 = min(ref_box[2] + 1, image_width)
+    y_0 = max(ref_box[1], 0)
+    y_1 = min(ref_box[3] + 1, image_height)
+
+    im_mask[y_0:y_1, x_0:x_1] = mask[(y_0 - ref_box[1]):(y_1 - ref_box[1]), (x_0 - ref_box[0]):(x_1 - ref_box[0])]
+    segms.append(im_mask)
+  return np.array(segms)
+
+
+class MaskEncodingTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(MaskEncodingTest, self).setUp()
+    rng = np.random.RandomState(1234)
+    self.image_height, self.image_width = 37, 53
+    num_masks = 60
+    # Boxes overlapping the image, possibly crossing its borders.
+    x = rng.uniform(-10, self.image_width - 5, num_masks)
+    y = rng.uniform(-10, self.image_height - 5, num_masks)
+    w = rng.uniform(12, 40, num_masks)
+    h = rng.uniform(12, 30, num_masks)
+    boxes = np.stack([x, y, w, h], axis=1)
+    # Full height boxes, with runs going on in the next column.
+    boxes[:5] = [[3, -5, 20, self.image_height + 10]] * 5
+    boxes[5] = [0.2, 0.3, 0.5, 0.5]
+    self.boxes = boxes.astype(np.float32)
+    self.masks = rng.uniform(0, 1, (num_masks, 28, 28)).astype(np.float32)
+    self.masks[1] = 1.
+    self.masks[2] = 0.
+    self.masks[3, :, 10:] = 1.
+
+  def test_generate_segmentation_from_masks(self):
+    segms = coco_metric.generate_segmentation_from_masks(self.masks, self.boxes, self.image_height, self.image_width)
+    expected = reference_segmentation_from_masks(self.masks, self.boxes, self.image_height, self.image_width)
+    self.assertAllEqual(segms, expected)
+
+  def test_encode_masks_in_boxes(self):
+    rles = coco_metric.encode_masks_in_boxes(self.masks, self.boxes, self.image_height, self.image_width)
+    segms = reference_segmentation_from_masks(self.masks, self.boxes, self.image_height, self.image_width)
+    self.assertLen(rles, len(segms))
+    for rle, segm in zip(rles, segms):
+      self.assertEqual(rle, maskUtils.encode(np.asfortranarray(segm)))
+
+  def test_encode_masks_outside_image(self):
+    boxes = np.array([[self.image_width + 5, 3, 10, 10], [-30, -30, 5, 5]], dtype=np.float32)
+    rles = coco_metric.encode_masks_in_boxes(self.masks[:2], boxes, self.image_height, self.image_width)
+    empty = maskUtils.encode(np.zeros((self.image_height, self.image_width), dtype=np.uint8, order='F'))
+    self.assertEqual(rles, [empty, empty])
+
+  def test_encode_no_masks(self):
+    rles = coco_metric.encode_masks_in_boxes(self.masks[:0], self.boxes[:0], self.image_height, self.image_width)
+    self.assertEmpty(rles)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -15,6 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - the training parser looks up the anchor matchings in the anchor target cache
+#   of params['anchor_target_cache'], if set
+
 """Data loader and processing.
 
 Defines input_fn of Mask-RCNN for TF Estimator. The input_fn includes training
@@ -38,6 +45,8 @@ from mask_rcnn.utils.distributed_utils import MPI_size
 # common functions
 from mask_rcnn.dataloader_utils import dataset_parser
 
+from mask_rcnn.anchor_target_cache import AnchorTargetCache
+
 from distutils.version import LooseVersion
 
 
@@ -60,6 +69,7 @@ class InputReader(object):
         self._use_fake_data = use_fake_data
         self._use_instance_mask = use_instance_mask
         self._seed = seed
+        self._anchor_target_cache = None
 
     def _create_dataset_parser_fn(self, params):
         """Create parser for parsing input data (dictionary)."""
@@ -69,13 +79,21 @@ class InputReader(object):
             mode=self._mode,
             params=params,
             use_instance_mask=self._use_instance_mask,
-            seed=self._seed
+            seed=self._seed,
+            anchor_target_cache=self._anchor_target_cache
         )
 
     def __call__(self, params, input_context=None):
 
         batch_size = params['batch_size'] if 'batch_size' in params else 1
 
+        if self._mode == tf.estimator.ModeKeys.TRAIN and params.get('anchor_target_cache'):
+            self._anchor_target_cache = AnchorTargetCache(params['anchor_target_cache'])
+            self._anchor_target_cache.check_params(params)
+            logging.info("Using the anchor matchings of %d images cached in %s" % (
+                len(self._anchor_target_cache), params['anchor_target_cache']
+            ))
+
         try:
             seed = params['seed'] if not MPI_is_distributed() else params['seed'] * MPI_rank()
         except (KeyError, TypeError):
@@ -15,6 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - the training parser looks up the anchor matchings in an anchor target cache
+# - added anchor_matches_parser to build the cache
+
 """Data loader and processing.
 
 Defines input_fn of Mask-RCNN for TF Estimator. The input_fn includes training
@@ -39,6 +47,7 @@ POLYGON_PAD_VALUE = coco_utils.POLYGON_PAD_VALUE
 __all__ = [
     # dataset parser
     "dataset_parser",
+    "anchor_matches_parser",
     # common functions
     "preprocess_image",
     "process_groundtruth_is_crowd",
@@ -50,13 +59,15 @@ __all__ = [
     "process_boxes_classes_indices_for_training",
     "process_gt_masks_for_training",
     "process_labels_for_training",
+    "process_anchor_matches_for_training",
     "process_targets_for_training"
 ]
 
 
 ###############################################################################################################
 
-def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate_source_id=False):
+def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate_source_id=False,
+                   anchor_target_cache=None):
     """Parse data to a fixed dimension input image and learning targets.
 
     Args:
@@ -94,6 +105,9 @@ def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate
         resized to a fixed size determined by params['gt_mask_size']
       regenerate_source_id: `bool`, if True TFExampleParser will use hashed
         value of `image/encoded` for `image/source_id`.
+      anchor_target_cache: (Optional) an AnchorTargetCache of the anchor
+        matchings of the training images, the anchors are matched on the fly
+        if None.
     """
     if mode not in [tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.PREDICT, tf.estimator.ModeKeys.EVAL]:
         raise ValueError("Unknown execution mode received: %s" % mode)
@@ -163,6 +177,14 @@ def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate
                     use_instance_mask=use_instance_mask
                 )
 
+                # The cached anchor matching depends on whether the image is flipped.
+                do_flip = None
+                if anchor_target_cache is not None:
+                    if params['augment_input_data']:
+                        do_flip = tf.greater(tf.random.uniform([], seed=seed), 0.5)
+                    else:
+                        do_flip = tf.constant(False)
+
                 image, image_info, boxes, instance_masks = preprocess_image(
                     image,
                     boxes=boxes,
@@ -170,7 +192,8 @@ def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate
                     image_size=params['image_size'],
                     max_level=params['max_level'],
                     augment_input_data=params['augment_input_data'],
-                    seed=seed
+                    seed=seed,
+                    do_flip=do_flip
                 )
 
                 features.update({
@@ -196,7 +219,10 @@ def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate
                         padded_image_size=padded_image_size,
                         boxes=boxes,
                         classes=classes,
-                        params=params
+                        params=params,
+                        anchor_target_cache=anchor_target_cache,
+                        source_id=source_id,
+                        do_flip=do_flip
                     )
 
                 additional_labels = process_labels_for_training(
@@ -256,16 +282,69 @@ def dataset_parser(value, mode, params, use_instance_mask, seed=None, regenerate
 
                 return features, labels
 
+
+def anchor_matches_parser(value, params):
+    """Parse data to the source id and the anchor matchings of a training image.
+
+    Returns:
+    source_id: Source image id, as in dataset_parser.
+    match_results: an int32 tensor with shape [2, num_anchors], the match results
+      of the anchors of the image and of the flipped image, as returned by
+      AnchorLabeler.match_anchors.
+    """
+    example_decoder = tf_example_decoder.TfExampleDecoder(use_instance_mask=False)
+
+    with tf.name_scope('parser'):
+
+        data = example_decoder.decode(value)
+
+        data['groundtruth_is_crowd'] = process_groundtruth_is_crowd(data)
+
+        image = tf.image.convert_image_dtype(data['image'], dtype=tf.float32)
+
+        source_id = process_source_id(data['source_id'])
+
+        boxes, _, _, _ = process_boxes_classes_indices_for_training(
+            data,
+            skip_crowd_during_training=params['skip_crowd_during_training'],
+            use_category=params['use_category'],
+            use_instance_mask=False
+        )
+
+        match_results = []
+
+        for do_flip in (False, True):
+            flipped_image, _, flipped_boxes, _ = preprocess_image(
+                image,
+                boxes=boxes,
+                instance_masks=None,
+                image_size=params['image_size'],
+                max_level=params['max_level'],
+                augment_input_data=True,
+                do_flip=tf.constant(do_flip)
+            )
+
+            match_results.append(process_anchor_matches_for_training(
+                padded_image_size=flipped_image.get_shape().as_list()[:2],
+                boxes=flipped_boxes,
+                params=params
+            ))
+
+        return source_id, tf.stack(match_results)
+
 ###############################################################################################################
 
 # common functions
 
 
-def preprocess_image(image, boxes, instance_masks, image_size, max_level, augment_input_data=False, seed=None):
+def preprocess_image(image, boxes, instance_masks, image_size, max_level, augment_input_data=False, seed=None,
+                     do_flip=None):
     image = preprocess_ops.normalize_image(image)
 
     if augment_input_data:
-        image, boxes, instance_masks = augment_image(image=image, boxes=boxes, instance_masks=instance_masks, seed=seed)
+        image, boxes, instance_masks = augment_image(
+            image=image, boxes=boxes, instance_masks=instance_masks, seed=seed, do_flip=do_flip
+        )
 
     # Scaling and padding.
     image, image_info, boxes, instance_masks = preprocess_ops.resize_and_pad(
@@ -359,12 +438,13 @@ def prepare_labels_for_eval(
 
 
 # training
-def augment_image(image, boxes, instance_masks, seed):
+def augment_image(image, boxes, instance_masks, seed, do_flip=None):
     flipped_results = preprocess_ops.random_horizontal_flip(
         image,
         boxes=boxes,
         masks=instance_masks,
-        seed=seed
+        seed=seed,
+        do_flip=do_flip
     )
 
     if instance_masks is not None:
@@ -444,7 +524,7 @@ def process_labels_for_training(
     return labels
 
 
-def process_targets_for_training(padded_image_size, boxes, classes, params):
+def _create_anchor_labeler(padded_image_size, params):
     input_anchors = anchors.Anchors(
         params['min_level'],
         params['max_level'],
@@ -463,4 +543,27 @@ def process_targets_for_training(padded_image_size, boxes, classes, params):
         params['rpn_fg_fraction']
     )
 
-    return anchor_labeler.label_anchors(boxes, classes), input_anchors
+    return input_anchors, anchor_labeler
+
+
+def process_anchor_matches_for_training(padded_image_size, boxes, params):
+    _, anchor_labeler = _create_anchor_labeler(padded_image_size, params)
+
+    return anchor_labeler.match_anchors(boxes)
+
+
+def process_targets_for_training(padded_image_size, boxes, classes, params,
+                                 anchor_target_cache=None, source_id=None, do_flip=None):
+    input_anchors, anchor_labeler = _create_anchor_labeler(padded_image_size, params)
+
+    match_results = None
+
+    if anchor_target_cache is not None:
+        match_results = anchor_target_cache.match_results(
+            source_id,
+            do_flip,
+            num_anchors=input_anchors.boxes.get_shape().as_list()[0],
+            match_fn=lambda: anchor_labeler.match_anchors(boxes)
+        )
+
+    return anchor_labeler.label_anchors(boxes, classes, match_results=match_results), input_anchors
@@ -15,6 +15,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - passed eval_processes to the evaluation
+
 """Interface to run mask rcnn model in different distributed strategies."""
 
 from __future__ import absolute_import
@@ -359,7 +365,8 @@ class BaseExecuter(object):
         self._runtime_config.include_mask,
         self._runtime_config.val_json_file,
         report_frequency=self._runtime_config.report_frequency,
-        checkpoint_path=last_ckpt
+        checkpoint_path=last_ckpt,
+        num_eval_processes=self._runtime_config.eval_processes
     )
 
     output_dir = os.path.join(self._runtime_config.model_dir, 'eval')
@@ -465,7 +472,8 @@ class BaseExecuter(object):
               self._runtime_config.include_mask,
               self._runtime_config.val_json_file,
               report_frequency=self._runtime_config.report_frequency,
-              checkpoint_path=last_ckpt
+              checkpoint_path=last_ckpt,
+              num_eval_processes=self._runtime_config.eval_processes
           )
           self._write_summary(output_dir, eval_results, predictions, max_cycle_step)
 
@@ -504,7 +512,8 @@ class BaseExecuter(object):
         self._runtime_config.eval_batch_size,
         self._runtime_config.include_mask,
         self._runtime_config.val_json_file,
-        checkpoint_path=last_ckpt
+        checkpoint_path=last_ckpt,
+        num_eval_processes=self._runtime_config.eval_processes
     )
 
     self._write_summary(output_dir, eval_results, predictions, current_step)
@@ -15,6 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - with a groundtruth json file, every worker converts its predictions to COCO
+# -   result records as the batches arrive, only the records are gathered and the
+# -   first worker evaluates them in parallel processes
+
 """Functions to perform COCO evaluation."""
 
 from __future__ import absolute_import
@@ -25,12 +33,14 @@ from mask_rcnn.utils.distributed_utils import MPI_rank
 from mask_rcnn.utils.distributed_utils import MPI_size
 
 import copy
+import multiprocessing
 import operator
 import pprint
 import six
 import time
 import collections
 import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import io
 from PIL import Image
@@ -70,14 +80,27 @@ def process_prediction_for_eval(prediction):
     return prediction
 
 
+# Number of images of which the predictions are kept for the image summary
+# when the predictions are streamed.
+MAX_SUMMARY_IMAGES = 10
+
+
 def compute_coco_eval_metric(predictor,
                              num_batches=-1,
                              include_mask=True,
                              annotation_json_file="",
                              eval_batch_size=-1,
-                             report_frequency=None):
+                             report_frequency=None,
+                             num_eval_processes=None):
     """Compute COCO eval metric given a prediction generator.
 
+    With a groundtruth json file, the predictions of every batch are converted
+    to COCO result records, with RLE-encoded masks, in a background thread as
+    the batches arrive. With MPI, every rank converts its own batches, only the
+    records are gathered on rank 0, which evaluates them in
+    `num_eval_processes` processes, and the results are broadcast to all the
+    ranks. Only the predictions of the first images are kept for the summary.
+
     Args:
     predictor: a generator that iteratively pops a dictionary of predictions
       with the format compatible with COCO eval tool.
@@ -85,6 +108,8 @@ def compute_coco_eval_metric(predictor,
       many times that the predictor gets pulled.
     include_mask: a boolean that indicates whether we include the mask eval.
     annotation_json_file: the annotation json file of the eval dataset.
+    num_eval_processes: the number of processes of the COCO evaluation, the
+      number of CPUs if None.
 
     Returns:
     eval_results: the aggregated COCO metric eval results.
@@ -94,15 +119,28 @@ def compute_coco_eval_metric(predictor,
         annotation_json_file = None
 
     use_groundtruth_from_json = (annotation_json_file is not None)
+    stream_predictions = use_groundtruth_from_json
+
+    if num_eval_processes is None:
+        num_eval_processes = multiprocessing.cpu_count()
 
     predictions = dict()
     batch_idx = 0
 
+    # Futures of the COCO result records of every batch and the ids of all the
+    # images, when the predictions are streamed.
+    records_futures = []
+    source_ids = []
+    records_converter = ThreadPoolExecutor(max_workers=1) if stream_predictions else None
+    num_summary_images = 0
+
     if use_groundtruth_from_json:
-        eval_metric = coco_metric.EvaluationMetric(annotation_json_file, include_mask=include_mask)
+        eval_metric = coco_metric.EvaluationMetric(annotation_json_file, include_mask=include_mask,
+                                                   num_processes=num_eval_processes)
 
     else:
-        eval_metric = coco_metric.EvaluationMetric(filename=None, include_mask=include_mask)
+        eval_metric = coco_metric.EvaluationMetric(filename=None, include_mask=include_mask,
+                                                   num_processes=num_eval_processes)
 
     def evaluation_preds(preds):
 
@@ -126,6 +164,12 @@ def compute_coco_eval_metric(predictor,
 
         return eval_results
 
+    def evaluation_records(records, image_ids):
+        return eval_metric.predict_records_metric_fn(records, image_ids)
+
+    def collect_records():
+        return [record for future in records_futures for record in future.result()]
+
     # Take into account cuDNN & Tensorflow warmup
     # Drop N first steps for avg throughput calculation
     BURNIN_STEPS = 100
@@ -163,37 +207,70 @@ def compute_coco_eval_metric(predictor,
 
         step_predictions = process_prediction_for_eval(step_predictions)
 
-        for k, v in step_predictions.items():
+        if stream_predictions:
+            source_ids.extend(int(source_id) for source_id in step_predictions['source_id'])
+            records_futures.append(records_converter.submit(
+                coco_metric.detection_results_to_coco_records, step_predictions, include_mask))
 
-            if k not in predictions:
-                predictions[k] = [v]
+        if not stream_predictions or num_summary_images < MAX_SUMMARY_IMAGES:
+            num_summary_images += len(step_predictions['source_id'])
 
-            else:
-                predictions[k].append(v)
+            for k, v in step_predictions.items():
+
+                if k not in predictions:
+                    predictions[k] = [v]
+
+                else:
+                    predictions[k].append(v)
 
         batch_idx = batch_idx + 1
 
         # If you want the report to happen each report_frequency to happen each report_frequency batches.
         # Thus, each report is of eval_batch_size * report_frequency
         if report_frequency and batch_idx % report_frequency == 0:
-            eval_results = evaluation_preds(preds=predictions)
+            if stream_predictions:
+                eval_results = evaluation_records(collect_records(), source_ids)
+            else:
+                eval_results = evaluation_preds(preds=predictions)
             logging.info('Eval results: %s' % pprint.pformat(eval_results, indent=4))
 
-    if MPI_is_distributed():
-        from mpi4py import MPI
-        all_predictions = MPI.COMM_WORLD.gather(predictions, root=0)
-        MPI.COMM_WORLD.Barrier()  # FIXME: first gather is calling MPI_FINALIZE causing crash
-        if MPI_rank() == 0:
-            predictions.clear()
-            for pred in all_predictions:
-               for k in pred.keys():
-                   if k not in predictions:
-                       predictions[k] = pred[k]
-                   else:
-                       predictions[k].extend(pred[k])
+    if stream_predictions:
+        records = collect_records()
+        records_converter.shutdown()
+
+        if MPI_is_distributed():
+            from mpi4py import MPI
+            all_records = MPI.COMM_WORLD.gather((records, source_ids), root=0)
+            if MPI_rank() == 0:
+                records = [record for rank_records, _ in all_records for record in rank_records]
+                source_ids = [source_id for _, rank_source_ids in all_records for source_id in rank_source_ids]
+                logging.info('Gathered %d detections of %d images' % (len(records), len(source_ids)))
+
+        if not MPI_is_distributed() or MPI_rank() == 0:
+            eval_results = evaluation_records(records, source_ids)
+        else:
+            eval_results = None
+
+        if MPI_is_distributed():
+            eval_results = MPI.COMM_WORLD.bcast(eval_results, root=0)
+
+    else:
+        if MPI_is_distributed():
+            from mpi4py import MPI
+            all_predictions = MPI.COMM_WORLD.gather(predictions, root=0)
+            MPI.COMM_WORLD.Barrier()  # FIXME: first gather is calling MPI_FINALIZE causing crash
+            if MPI_rank() == 0:
+                predictions.clear()
+                for pred in all_predictions:
+                   for k in pred.keys():
+                       if k not in predictions:
+                           predictions[k] = pred[k]
+                       else:
+                           predictions[k].extend(pred[k])
+
+        eval_results = evaluation_preds(preds=predictions)
 
     inference_time_list.sort()
-    eval_results = evaluation_preds(preds=predictions)
 
     if not MPI_is_distributed() or MPI_rank() == 0:
 
@@ -257,7 +334,8 @@ def evaluate(eval_estimator,
              include_mask=True,
              validation_json_file="",
              report_frequency=None,
-             checkpoint_path=None):
+             checkpoint_path=None,
+             num_eval_processes=None):
 
     """Runs COCO evaluation once."""
     predictor = eval_estimator.predict(
@@ -276,7 +354,8 @@ def evaluate(eval_estimator,
         include_mask,
         validation_json_file,
         eval_batch_size=eval_batch_size,
-        report_frequency=report_frequency
+        report_frequency=report_frequency,
+        num_eval_processes=num_eval_processes
     )
 
     return eval_results, predictions
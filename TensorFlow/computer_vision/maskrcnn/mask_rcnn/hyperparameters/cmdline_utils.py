@@ -15,6 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added eval_processes
+# - added anchor_target_cache
+
 """Defining common model params used across all the models."""
 
 from absl import flags
@@ -63,6 +70,12 @@ def define_hparams_flags():
 
     flags.DEFINE_integer('eval_samples', default=5000, help='Number of training steps')
 
+    flags.DEFINE_integer(
+        'eval_processes',
+        default=None,
+        help='Number of processes of the COCO evaluation on the first worker, the number of CPUs if not set'
+    )
+
     flags.DEFINE_bool(
         'include_groundtruth_in_features',
         default=False,
@@ -188,6 +201,15 @@ def define_hparams_flags():
 
     flags.DEFINE_string('training_file_pattern', default="", help='TFRecords file pattern for the training files')
 
+    flags.DEFINE_string(
+        'anchor_target_cache',
+        default="",
+        help=(
+            'Directory of the anchor matchings of the training files, built with'
+            ' `python -m mask_rcnn.anchor_target_cache`. The anchors are matched on the fly if empty.'
+        )
+    )
+
     flags.DEFINE_string('validation_file_pattern', default="", help='TFRecords file pattern for the validation files')
 
     flags.DEFINE_string('val_json_file', default="", help='Filepath for the validation json file')
@@ -15,6 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - random_horizontal_flip accepts the flip decision
+
 """Preprocess images and bounding boxes for detection.
 
 We perform two sets of operations in preprocessing stage:
@@ -118,7 +125,8 @@ def random_horizontal_flip(image,
                            masks=None,
                            keypoints=None,
                            keypoint_flip_permutation=None,
-                           seed=None):
+                           seed=None,
+                           do_flip=None):
   """Randomly flips the image and detections horizontally.
 
   The probability of flipping the image is 50%.
@@ -139,6 +147,8 @@ def random_horizontal_flip(image,
     keypoint_flip_permutation: rank 1 int32 tensor containing the keypoint flip
                                permutation.
     seed: random seed
+    do_flip: (optional) boolean scalar tensor deciding whether to flip, drawn
+             at random if None.
 
   Returns:
     image: image which is the same shape as input image.
@@ -170,7 +180,10 @@ def random_horizontal_flip(image,
 
   result = []
   # random variable defining whether to do flip or not
-  do_a_flip_random = tf.greater(tf.random.uniform([], seed=seed), 0.5)
+  if do_flip is None:
+    do_a_flip_random = tf.greater(tf.random.uniform([], seed=seed), 0.5)
+  else:
+    do_a_flip_random = do_flip
 
   # flip image
   image = tf.cond(pred=do_a_flip_random, true_fn=lambda: _flip_image(image), false_fn=lambda: image)
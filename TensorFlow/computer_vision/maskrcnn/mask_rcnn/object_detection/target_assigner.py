@@ -16,6 +16,12 @@
 # limitations under the License.
 # ==============================================================================
 
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added TargetAssigner.match, and assign accepts a precomputed match
+
 """Base target assigner module.
 
 The job of a TargetAssigner is, for a given set of anchors (bounding boxes) and
@@ -80,8 +86,25 @@ class TargetAssigner(object):
     def box_coder(self):
         return self._box_coder
 
+    def match(self, anchors, groundtruth_boxes, **params):
+        """Matches anchors to groundtruth_boxes.
+
+        Args:
+          anchors: a BoxList representing N anchors
+          groundtruth_boxes: a BoxList representing M groundtruth boxes
+          **params: Additional keyword arguments for specific implementations of
+                  the Matcher.
+
+        Returns:
+          match: a matcher.Match object encoding the match between anchors and
+            groundtruth boxes, with rows corresponding to groundtruth boxes
+            and columns corresponding to anchors.
+        """
+        match_quality_matrix = self._similarity_calc.compare(groundtruth_boxes, anchors)
+        return self._matcher.match(match_quality_matrix, **params)
+
     def assign(self, anchors, groundtruth_boxes, groundtruth_labels=None,
-               groundtruth_weights=None, **params):
+               groundtruth_weights=None, match=None, **params):
         """Assign classification and regression targets to each anchor.
 
         For a given set of anchors and groundtruth detections, match anchors
@@ -103,6 +126,9 @@ class TargetAssigner(object):
           groundtruth_weights: a float tensor of shape [M] indicating the weight to
             assign to all anchors match to a particular groundtruth box. The weights
             must be in [0., 1.]. If None, all weights are set to 1.
+          match: (optional) a matcher.Match object of the anchors and
+            groundtruth_boxes, e.g. computed beforehand with `match`. When set
+            to None, the anchors are matched to groundtruth_boxes.
           **params: Additional keyword arguments for specific implementations of
                   the Matcher.
 
@@ -140,8 +166,8 @@ class TargetAssigner(object):
 
             groundtruth_weights = tf.ones([num_gt_boxes], dtype=tf.float32)
 
-        match_quality_matrix = self._similarity_calc.compare(groundtruth_boxes, anchors)
-        match = self._matcher.match(match_quality_matrix, **params)
+        if match is None:
+            match = self.match(anchors, groundtruth_boxes, **params)
 
         reg_targets = self._create_regression_targets(anchors, groundtruth_boxes, match)
         cls_targets = self._create_classification_targets(groundtruth_labels, match)
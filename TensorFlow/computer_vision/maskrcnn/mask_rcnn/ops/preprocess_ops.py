@@ -15,6 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - random_horizontal_flip accepts the flip decision
+
 """Preprocessing ops."""
 import math
 import tensorflow as tf
@@ -43,7 +50,7 @@ def normalize_image(image):
     return normalized_image
 
 
-def random_horizontal_flip(image, boxes=None, masks=None, seed=None):
+def random_horizontal_flip(image, boxes=None, masks=None, seed=None, do_flip=None):
     """Random horizontal flip the image, boxes, and masks.
 
     Args:
@@ -53,13 +60,15 @@ def random_horizontal_flip(image, boxes=None, masks=None, seed=None):
     masks: (Optional) a tensor of shape [num_masks, height, width]
       representing the object masks. Note that the size of the mask is the
       same as the image.
+    do_flip: (Optional) a boolean scalar tensor deciding whether to flip, drawn
+      at random if None.
 
     Returns:
     image: the processed image tensor after being randomly flipped.
     boxes: None or the processed box tensor after being randomly flipped.
     masks: None or the processed mask tensor after being randomly flipped.
     """
-    return preprocessor.random_horizontal_flip(image, boxes, masks, seed=seed)
+    return preprocessor.random_horizontal_flip(image, boxes, masks, seed=seed, do_flip=do_flip)
 
 
 def resize_and_pad(image, target_size, stride, boxes=None, masks=None):
@@ -0,0 +1,165 @@
+###############################################################################
+# Copyright (C) 2021 Habana Labs, Ltd. an Intel Company
+###############################################################################
+"""Benchmark of the SQuAD n-best postprocessing of run_squad.write_predictions.
+
+Runs write_predictions on synthetic SQuAD v1.1 dev sized examples, features and
+logits, once with the batched NumPy selection of the span candidates and once
+with the previous per-feature Python loops, checks that the predictions and
+n-best JSON files are identical and prints both times.
+
+    python3 benchmark_squad_postprocessing.py --num_examples 10570
+"""
+
+import argparse
+import functools
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import TensorFlow.nlp.bert.run_squad as run_squad
+
+
+def reference_prelim_predictions(features, unique_id_to_result, unique_id_to_best,
+                                 max_answer_length, version_2_with_negative,
+                                 n_best_size=20):
+  """The per-feature selection of write_predictions before the batched version."""
+  prelim_predictions = []
+  score_null = 1000000  # large and positive
+  min_null_feature_index = 0
+  null_start_logit = 0
+  null_end_logit = 0
+  for (feature_index, feature) in enumerate(features):
+    result = unique_id_to_result[feature.unique_id]
+    start_indexes = run_squad._get_best_indexes(result.start_logits, n_best_size)
+    end_indexes = run_squad._get_best_indexes(result.end_logits, n_best_size)
+    if version_2_with_negative:
+      feature_null_score = result.start_logits[0] + result.end_logits[0]
+      if feature_null_score < score_null:
+        score_null = feature_null_score
+        min_null_feature_index = feature_index
+        null_start_logit = result.start_logits[0]
+        null_end_logit = result.end_logits[0]
+    for start_index in start_indexes:
+      for end_index in end_indexes:
+        if start_index >= len(feature.tokens):
+          continue
+        if end_index >= len(feature.tokens):
+          continue
+        if start_index not in feature.token_to_orig_map:
+          continue
+        if end_index not in feature.token_to_orig_map:
+          continue
+        if not feature.token_is_max_context.get(start_index, False):
+          continue
+        if end_index < start_index:
+          continue
+        length = end_index - start_index + 1
+        if length > max_answer_length:
+          continue
+        prelim_predictions.append(
+            run_squad._PrelimPrediction(
+                feature_index=feature_index,
+                start_index=start_index,
+                end_index=end_index,
+                start_logit=result.start_logits[start_index],
+                end_logit=result.end_logits[end_index]))
+
+  if version_2_with_negative:
+    prelim_predictions.append(
+        run_squad._PrelimPrediction(
+            feature_index=min_null_feature_index,
+            start_index=0,
+            end_index=0,
+            start_logit=null_start_logit,
+            end_logit=null_end_logit))
+  prelim_predictions = sorted(
+      prelim_predictions,
+      key=lambda x: (x.start_logit + x.end_logit),
+      reverse=True)
+  return prelim_predictions, score_null, null_start_logit, null_end_logit
+
+
+def make_synthetic_data(num_examples, max_seq_length, seed):
+  rng = random.Random(seed)
+  words = ["word%d" % i for i in range(5000)]
+  examples, features, results = [], [], []
+  unique_id = 1000000000
+  for example_index in range(num_examples):
+    doc_tokens = [rng.choice(words) for _ in range(rng.randint(50, 400))]
+    examples.append(run_squad.SquadExample(
+        qas_id="q%d" % example_index, question_text="", doc_tokens=doc_tokens))
+    for doc_span_index in range(rng.choice([1, 1, 1, 2])):
+      query_length = rng.randint(5, 20)
+      num_tokens = rng.randint(query_length + 10, max_seq_length)
+      tokens = (["[CLS]"] + ["query"] * query_length + ["[SEP]"] +
+                [rng.choice(doc_tokens) for _ in range(num_tokens - query_length - 3)] + ["[SEP]"])
+      token_to_orig_map = {i: min(len(doc_tokens) - 1, i - query_length - 2)
+                           for i in range(query_length + 2, num_tokens - 1)}
+      token_is_max_context = {i: rng.random() < 0.9 for i in token_to_orig_map}
+      features.append(run_squad.InputFeatures(
+          unique_id=unique_id, example_index=example_index, doc_span_index=doc_span_index,
+          tokens=tokens, token_to_orig_map=token_to_orig_map,
+          token_is_max_context=token_is_max_context, input_ids=None, input_mask=None,
+          segment_ids=None))
+      # float32 logits like the model outputs, padding gets low scores
+      logits = np.random.RandomState(unique_id).normal(0., 3., size=(2, max_seq_length)).astype(np.float32)
+      logits[:, num_tokens:] = -20.
+      results.append(run_squad.RawResult(unique_id=unique_id,
+                                         start_logits=[float(x) for x in logits[0]],
+                                         end_logits=[float(x) for x in logits[1]]))
+      unique_id += 1
+  return examples, features, results
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark of run_squad.write_predictions")
+  parser.add_argument("--num_examples", type=int, default=10570)
+  parser.add_argument("--max_seq_length", type=int, default=384)
+  parser.add_argument("--n_best_size", type=int, default=20)
+  parser.add_argument("--max_answer_length", type=int, default=30)
+  parser.add_argument("--version_2_with_negative", action="store_true")
+  parser.add_argument("--seed", type=int, default=12345)
+  args = parser.parse_args()
+
+  run_squad.init_squad_flags()
+  run_squad.FLAGS(["benchmark_squad_postprocessing"])
+  examples, features, results = make_synthetic_data(args.num_examples, args.max_seq_length, args.seed)
+
+  batched_prelim_predictions = run_squad._get_prelim_predictions
+  work_dir = tempfile.mkdtemp()
+  try:
+    times = {}
+    outputs = {}
+    reference = functools.partial(reference_prelim_predictions, n_best_size=args.n_best_size)
+    for name, prelim_fn in (("reference", reference),
+                            ("batched", batched_prelim_predictions)):
+      run_squad._get_prelim_predictions = prelim_fn
+      files = [os.path.join(work_dir, "%s_%s.json" % (name, kind))
+               for kind in ("predictions", "nbest_predictions", "null_odds")]
+      start = time.time()
+      run_squad.write_predictions(examples, features, results, args.n_best_size,
+                                  args.max_answer_length, True, files[0], files[1], files[2],
+                                  args.version_2_with_negative, False)
+      times[name] = time.time() - start
+      outputs[name] = [open(f).read() if os.path.exists(f) else None for f in files]
+    run_squad._get_prelim_predictions = batched_prelim_predictions
+
+    print("examples: %d, features: %d" % (len(examples), len(features)))
+    for name, elapsed in times.items():
+      print("%10s: %7.2f s" % (name, elapsed))
+    print("speed-up: %.2fx" % (times["reference"] / times["batched"]))
+    identical = outputs["reference"] == outputs["batched"]
+    print("identical predictions: %s" % identical)
+    if not identical:
+      raise SystemExit(1)
+  finally:
+    shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+  main()
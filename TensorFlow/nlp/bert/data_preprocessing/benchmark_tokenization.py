@@ -0,0 +1,111 @@
+# coding=utf-8
+# Copyright (c) 2021, Habana Labs Ltd.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares FullTokenizer with the character-by-character reference tokenization.
+
+Tokenizes the lines of a text sample (e.g. a formatted Wikipedia shard written by
+bertPrep.py) with both, checks that the outputs are identical and prints the speed-up.
+
+        python3 benchmark_tokenization.py --vocab_file vocab.txt --input_file wikicorpus_en_one_article_per_line.txt
+"""
+
+import argparse
+import time
+
+import tokenization
+
+
+class ReferenceTokenizer(object):
+    """FullTokenizer without the translate tables, the word piece tries and the cache."""
+
+    def __init__(self, vocab_file, do_lower_case=True):
+        self.vocab = tokenization.load_vocab(vocab_file)
+        self.basic_tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+        self.unk_token = "[UNK]"
+        self.max_input_chars_per_word = 100
+
+    def basic_tokenize(self, text):
+        basic = self.basic_tokenizer
+        text = basic._tokenize_chinese_chars(basic._clean_text(tokenization.convert_to_unicode(text)))
+        split_tokens = []
+        for token in tokenization.whitespace_tokenize(text):
+            if basic.do_lower_case:
+                token = basic._run_strip_accents(token.lower())
+            split_tokens.extend(basic._run_split_on_punc(token))
+        return tokenization.whitespace_tokenize(" ".join(split_tokens))
+
+    def wordpiece_tokenize(self, token):
+        chars = list(token)
+        if len(chars) > self.max_input_chars_per_word:
+            return [self.unk_token]
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in self.vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                return [self.unk_token]
+            sub_tokens.append(cur_substr)
+            start = end
+        return sub_tokens
+
+    def tokenize(self, text):
+        return [sub_token for token in self.basic_tokenize(text) for sub_token in self.wordpiece_tokenize(token)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the BERT FullTokenizer")
+    parser.add_argument("--vocab_file", type=str, required=True)
+    parser.add_argument("--input_file", type=str, required=True,
+                        help="Text sample, tokenized line by line")
+    parser.add_argument("--max_lines", type=int, default=20000)
+    parser.add_argument("--do_lower_case", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.input_file, "r", encoding="utf-8") as f:
+        lines = [line for _, line in zip(range(args.max_lines), f)]
+    num_chars = sum(len(line) for line in lines)
+
+    reference = ReferenceTokenizer(args.vocab_file, bool(args.do_lower_case))
+    start = time.time()
+    expected = [reference.tokenize(line) for line in lines]
+    reference_time = time.time() - start
+
+    tokenizer = tokenization.FullTokenizer(args.vocab_file, bool(args.do_lower_case))
+    start = time.time()
+    output = tokenizer.tokenize_many(lines)
+    full_time = time.time() - start
+
+    mismatches = sum(1 for a, b in zip(expected, output) if a != b)
+    print("lines: {}, characters: {}, tokens: {}".format(len(lines), num_chars, sum(len(t) for t in output)))
+    print("reference:     {:8.2f} s {:10.0f} chars/s".format(reference_time, num_chars / reference_time))
+    print("FullTokenizer: {:8.2f} s {:10.0f} chars/s".format(full_time, num_chars / full_time))
+    print("speed-up: {:.2f}x, word piece cache: {}".format(reference_time / full_time,
+                                                           tokenizer.wordpiece_tokenizer._tokenize_word.cache_info()))
+    print("mismatching lines: {}".format(mismatches))
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -260,7 +260,7 @@ def create_multi_sequence_example(multi_sequence, max_predictions_per_sequence,
         # Padding sequences are donoted with None
         if sequence is not None:
             example = tf.train.Example()
-            example.ParseFromString(sequence.numpy())
+            example.ParseFromString(sequence if isinstance(sequence, bytes) else sequence.numpy())
 
             input_ids = np.array(example.features.feature['input_ids'].int64_list.value)
             input_mask = np.array(example.features.feature['input_mask'].int64_list.value)
@@ -414,30 +414,152 @@ def parallel_data_loader(path,filename):
             del example
     return sequence_lengths_part,examples_by_length_part
 
+def index_tfrecord_file(path):
+    # Pass one of the two-pass mode: byte offset and sequence length of every record of an
+    # uncompressed TFRecord file, without keeping the records
+    offsets = []
+    sequence_lengths = []
+    with open(path, "rb") as f:
+        while True:
+            offset = f.tell()
+            header = f.read(12)
+            if len(header) < 12:
+                break
+            length, = struct.unpack("<Q", header[:8])
+            record = f.read(length)
+            f.read(4)
+            example = tf.train.Example()
+            example.ParseFromString(record)
+            offsets.append(offset)
+            sequence_lengths.append(sum(example.features.feature['input_mask'].int64_list.value))
+    return np.array(offsets, dtype=np.int64), np.array(sequence_lengths, dtype=np.int16), os.path.getsize(path)
+
+
+def read_records(input_files, file_ids, offsets):
+    # Reads the records at the given (file, offset) pairs in file and offset order; -1 is padding
+    records = [None] * len(offsets)
+    f, open_id = None, None
+    try:
+        for i in np.lexsort((offsets, file_ids)):
+            if file_ids[i] < 0:
+                continue
+            if file_ids[i] != open_id:
+                if f is not None:
+                    f.close()
+                open_id = file_ids[i]
+                f = open(input_files[open_id], "rb")
+            f.seek(offsets[i])
+            length, = struct.unpack("<Q", f.read(12)[:8])
+            records[i] = f.read(length)
+    finally:
+        if f is not None:
+            f.close()
+    return records
+
+
+def parallel_pack_from_index(args, part_idx, strategy, input_files, locations):
+    # Pass two of the two-pass mode: locations holds one (file_ids, offsets) pair per sequence
+    # of the strategy, only the records of this part are read into memory
+    examples = [read_records(input_files, file_ids, offsets) for file_ids, offsets in locations]
+    parallel_pack_according_to_strategy(args, part_idx, strategy, examples)
+
+
+def build_index(input_files, num_workers):
+    offsets = []
+    sequence_lengths = []
+    total_bytes = 0
+    with ProcessPoolExecutor(num_workers) as executor:
+        for offsets_part, sequence_lengths_part, num_bytes in executor.map(index_tfrecord_file, input_files):
+            offsets.append(offsets_part)
+            sequence_lengths.append(sequence_lengths_part)
+            total_bytes += num_bytes
+    file_ids = np.concatenate([np.full(len(part), i, dtype=np.int32) for i, part in enumerate(offsets)])
+    return file_ids, np.concatenate(offsets), np.concatenate(sequence_lengths), total_bytes
+
+
+def two_pass_packing(args, input_files):
+    print("Pass one: indexing sequence lengths and record offsets...")
+    file_ids, offsets, sequence_lengths, total_bytes = build_index(input_files, args.num_workers)
+    print(f"Indexed {len(sequence_lengths)} sequences in {len(input_files)} files.")
+
+    strategy_set, mixture, padding, slicing = get_packing_recipe(sequence_lengths.astype(np.int64),
+                                                                 args.max_sequence_length,
+                                                                 args.max_sequences_per_pack)
+
+    # Same shuffled assignment as the in-memory mode, but over record indices (-1 for padding)
+    order = np.argsort(sequence_lengths, kind="stable")
+    boundaries = np.searchsorted(sequence_lengths[order], np.arange(1, args.max_sequence_length + 2))
+    indices_by_length = {}
+    for i in range(1, args.max_sequence_length + 1):
+        indices = np.concatenate([order[boundaries[i - 1]:boundaries[i]],
+                                  np.full(int(padding[i - 1]), -1, dtype=order.dtype)])
+        np.random.shuffle(indices)
+        indices_by_length[i] = indices
+    index_slices, strategies, part_idx = slice_examples(indices_by_length, slicing, strategy_set, mixture)
+
+    # Each running part holds its records in memory, so the budget caps the number of workers
+    record_bytes = total_bytes / max(1, len(sequence_lengths))
+    part_bytes = max(len(indices) for slices in index_slices for indices in slices) * \
+        args.max_sequences_per_pack * record_bytes
+    num_workers = int(max(1, min(args.num_workers, args.memory_budget_gb * 2**30 // max(1, 2 * part_bytes))))
+    print(f"\nPass two: packing and writing {len(part_idx)} parts to {args.output_dir} "
+          f"with {num_workers} workers (~{part_bytes / 2**20:.0f} MB of records per part).")
+
+    def tasks():
+        for part, strategy, slices in zip(part_idx, strategies, index_slices):
+            locations = [(np.where(indices >= 0, file_ids[indices], -1), offsets[indices]) for indices in slices]
+            yield part, strategy, locations
+
+    start = time.time()
+    with ProcessPoolExecutor(num_workers) as executor:
+        pending = deque()
+        for part, strategy, locations in tasks():
+            # bound the number of queued parts too, not only the running ones
+            if len(pending) >= 2 * num_workers:
+                pending.popleft().result()
+            pending.append(executor.submit(parallel_pack_from_index, args, part, strategy, input_files, locations))
+        for future in pending:
+            future.result()
+    print(f"\nDone. Took: {time.time() - start:3.2f} seconds to pack and write dataset.")
+
+
 if __name__ == "__main__":
     tf.compat.v1.enable_eager_execution()
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-glob", help="A glob expression for the input files to read in and pack", required=True, type=str)
     parser.add_argument("--output-dir", help="The destination folder for the output files", required=True)
-    parser.add_argument("--max-files", help="At most how many files to process (limited by RAM)", default=100,type=int)
+    parser.add_argument("--max-files", help="At most how many files to process (limited by RAM unless --two-pass is set, "
+                        "0 or less for all files)", default=100,type=int)
     parser.add_argument("--duplication-factor", help="Same as the one passed to create input data", default=1, type=int)
     parser.add_argument("--max-sequence-length", help="The maximum number of tokens in an example", default=512, type=int)
     parser.add_argument("--max-predictions-per-sequence", help="The maximum number of masked tokens in an un-packed example", default=76, type=int)
     parser.add_argument("--max-sequences-per-pack", help="The maximum number of sequences per packed example.", choices=[2, 3], default=3, type=int)
+    parser.add_argument("--two-pass", help="Index the sequence lengths and record offsets first, then stream the records "
+                        "into the packed files, instead of holding all the records in memory", action="store_true")
+    parser.add_argument("--memory-budget-gb", help="Memory for records held by the packing workers in the two-pass mode",
+                        default=16, type=float)
+    parser.add_argument("--num-workers", help="Number of worker processes", default=25, type=int)
     args = parser.parse_args()
 
     # Input files
+    all_input_files = sorted(os.listdir(args.input_glob))
+    num_files = len(all_input_files) if args.max_files <= 0 else args.max_files
+    input_files = np.random.choice(all_input_files, size=num_files, replace=False)
+    if args.two_pass:
+        os.makedirs(args.output_dir, exist_ok=True)
+        two_pass_packing(args, [os.path.join(args.input_glob, f) for f in input_files])
+        exit(0)
+
     print("Looping through dataset to collect sequence length information...")
-    input_files = np.random.choice(os.listdir(args.input_glob), size=args.max_files, replace=False)
     sequence_lengths = []
     examples_by_length = defaultdict(list)
 
-    with ProcessPoolExecutor(25) as executor:
+    with ProcessPoolExecutor(args.num_workers) as executor:
         work = repeat(args.input_glob), input_files.tolist()
         for sequence_lengths_part,examples_by_length_part  in executor.map(parallel_data_loader, *work):
-            pass
             sequence_lengths += sequence_lengths_part
-            examples_by_length = { key:examples_by_length.get(key,[])+examples_by_length_part.get(key,[]) for key in set(list(examples_by_length.keys())+list(examples_by_length_part.keys())) }
+            for key, examples in examples_by_length_part.items():
+                examples_by_length[key].extend(examples)
             del examples_by_length_part
             sequence_lengths_part=None; examples_by_length_part=None
     sequence_lengths = np.array(sequence_lengths)
@@ -471,7 +593,7 @@ if __name__ == "__main__":
     for rr in range(1+len(strategies)//500):
         str_idx,stp_idx=rr*500,min((rr+1)*500,len(strategies))
         part_idx_prt, strategies_prt, example_slices_prt = part_idx[str_idx:stp_idx], strategies[str_idx:stp_idx], example_slices[str_idx:stp_idx]
-        with ProcessPoolExecutor(25) as executor:
+        with ProcessPoolExecutor(args.num_workers) as executor:
             work = repeat(args), part_idx_prt, strategies_prt, example_slices_prt
             for partial_result in executor.map(parallel_pack_according_to_strategy, *work):
                 pass
@@ -21,6 +21,7 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import functools
 import unicodedata
 import six
 import tensorflow as tf
@@ -156,11 +157,14 @@ class FullTokenizer(object):
   def tokenize(self, text):
     split_tokens = []
     for token in self.basic_tokenizer.tokenize(text):
-      for sub_token in self.wordpiece_tokenizer.tokenize(token):
-        split_tokens.append(sub_token)
+      split_tokens.extend(self.wordpiece_tokenizer.tokenize_word(token))
 
     return split_tokens
 
+  def tokenize_many(self, texts):
+    """Tokenizes a batch of texts, sharing the word piece cache."""
+    return [self.tokenize(text) for text in texts]
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -185,10 +189,13 @@ class BertTokenizer(object):
     def tokenize(self, text):
         split_tokens = []
         for token in self.basic_tokenizer.tokenize(text):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token)
+            split_tokens.extend(self.wordpiece_tokenizer.tokenize_word(token))
         return split_tokens
 
+    def tokenize_many(self, texts):
+        """Tokenizes a batch of texts, sharing the word piece cache."""
+        return [self.tokenize(text) for text in texts]
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -239,6 +246,9 @@ class BertTokenizer(object):
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
+    # Shared by all instances, as _clean_char does not depend on the instance.
+    _clean_text_table = None
+
     def __init__(self, do_lower_case=True):
         """Constructs a BasicTokenizer.
 
@@ -246,31 +256,39 @@ class BasicTokenizer(object):
       do_lower_case: Whether to lower case the input.
     """
         self.do_lower_case = do_lower_case
+        if BasicTokenizer._clean_text_table is None:
+            BasicTokenizer._clean_text_table = _CharTable(self._clean_char)
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
         text = convert_to_unicode(text)
-        text = self._clean_text(text)
-        # This was added on November 1st, 2018 for the multilingual and Chinese
-        # models. This is also applied to the English models now, but it doesn't
-        # matter since the English models were not trained on any Chinese data
-        # and generally don't have any Chinese data in them (there are Chinese
-        # characters in the vocabulary because Wikipedia does have some Chinese
-        # words in the English Wikipedia.).
-        text = self._tokenize_chinese_chars(text)
+        # _clean_text and _tokenize_chinese_chars in a single pass, with the
+        # per-character decisions memoized in a translate table.
+        # The Chinese character handling was added on November 1st, 2018 for
+        # the multilingual and Chinese models. This is also applied to the
+        # English models now, but it doesn't matter since the English models
+        # were not trained on any Chinese data and generally don't have any
+        # Chinese data in them (there are Chinese characters in the vocabulary
+        # because Wikipedia does have some Chinese words in the English
+        # Wikipedia.).
+        text = text.translate(self._clean_text_table)
         orig_tokens = whitespace_tokenize(text)
         split_tokens = []
         for token in orig_tokens:
             if self.do_lower_case:
                 token = token.lower()
                 token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
+            # same as _run_split_on_punc followed by the join and split below
+            split_tokens.append(token.translate(_SPLIT_ON_PUNC_TABLE))
 
         output_tokens = whitespace_tokenize(" ".join(split_tokens))
         return output_tokens
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
+        if text.isascii():
+            # NFD does not change ASCII and there are no nonspacing marks
+            return text
         text = unicodedata.normalize("NFD", text)
         output = []
         for char in text:
@@ -335,6 +353,17 @@ class BasicTokenizer(object):
 
         return False
 
+    def _clean_char(self, char):
+        """Maps a character as _clean_text and then _tokenize_chinese_chars would."""
+        cp = ord(char)
+        if cp == 0 or cp == 0xfffd or _is_control(char):
+            return None
+        if _is_whitespace(char):
+            return " "
+        if self._is_chinese_char(cp):
+            return " " + char + " "
+        return char
+
     def _clean_text(self, text):
         """Performs invalid character removal and whitespace cleanup on text."""
         output = []
@@ -352,10 +381,70 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, cache_size=2**16):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.cache_size = cache_size
+        self._build()
+
+    def _build(self):
+        # Prefix tries of the word-initial pieces and of the "##" continuation
+        # pieces. A node is a dict of the next characters, _TRIE_END marks the
+        # end of a piece and holds the piece itself.
+        self._start_trie = {}
+        self._continuation_trie = {}
+        for piece in self.vocab:
+            if piece.startswith("##"):
+                node, chars = self._continuation_trie, piece[2:]
+            else:
+                node, chars = self._start_trie, piece
+            if not chars:
+                continue
+            for char in chars:
+                node = node.setdefault(char, {})
+            node[_TRIE_END] = piece
+        self._tokenize_word = functools.lru_cache(maxsize=self.cache_size)(self._wordpiece)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_start_trie", "_continuation_trie", "_tokenize_word"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build()
+
+    def _wordpiece(self, token):
+        """Greedy longest-match-first split of a single token, walking the tries."""
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+
+        sub_tokens = []
+        start = 0
+        trie = self._start_trie
+        while start < len(token):
+            node = trie
+            cur_substr = None
+            end = start
+            for i in range(start, len(token)):
+                node = node.get(token[i])
+                if node is None:
+                    break
+                if _TRIE_END in node:
+                    cur_substr = node[_TRIE_END]
+                    end = i + 1
+            if cur_substr is None:
+                return (self.unk_token,)
+            sub_tokens.append(cur_substr)
+            start = end
+            trie = self._continuation_trie
+        return tuple(sub_tokens)
+
+    def tokenize_word(self, token):
+        """Returns the word pieces of a single token (without whitespace)."""
+        return self._tokenize_word(token)
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -379,35 +468,7 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
-
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
+            output_tokens.extend(self._tokenize_word(token))
         return output_tokens
 
 
@@ -449,3 +510,26 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+_TRIE_END = ""
+
+
+class _CharTable(dict):
+    """str.translate table that computes the mapping of a character on first use."""
+
+    def __init__(self, map_char):
+        super(_CharTable, self).__init__()
+        self._map_char = map_char
+
+    def __missing__(self, cp):
+        value = self._map_char(chr(cp))
+        self[cp] = value
+        return value
+
+
+def _space_punctuation_char(char):
+    return " " + char + " " if _is_punctuation(char) else char
+
+
+_SPLIT_ON_PUNC_TABLE = _CharTable(_space_punctuation_char)
@@ -29,6 +29,8 @@
 #   - deterministic_run
 #   - deterministic_seed
 # - Added prefetch of dataset
+# - Added command-line flags features_cache_dir and num_feature_workers for
+#   cached and parallel conversion of examples to features
 ###############################################################################
 
 """Run BERT on SQuAD 1.1 and SQuAD 2.0."""
@@ -57,6 +59,9 @@ import random
 import math
 import json
 import collections
+import hashlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from TensorFlow.common.tb_utils import write_hparams_v1, TBSummary
 from TensorFlow.common.debug import dump_callback
 from habana_frameworks.tensorflow import load_habana_module
@@ -212,6 +217,16 @@ def init_squad_flags():
 
   flags.DEFINE_bool('enable_scoped_allocator', False, "Enable scoped allocator optimization")
 
+  flags.DEFINE_string(
+      "features_cache_dir", None,
+      "[Optional] Directory for features reused across runs. The features are "
+      "keyed by the content of the input and vocab files and by the "
+      "tokenization parameters.")
+
+  flags.DEFINE_integer(
+      "num_feature_workers", 1,
+      "Number of processes converting SQuAD examples to features.")
+
 def set_random_seed(seed):
   tf.compat.v1.set_random_seed(seed)
   tf.random.set_seed(seed)
@@ -372,12 +387,12 @@ def read_squad_examples(input_file, is_training, version_2_with_negative):
 
 def convert_examples_to_features(examples, tokenizer, max_seq_length,
                                  doc_stride, max_query_length, is_training,
-                                 output_fn):
+                                 output_fn, example_index_offset=0):
   """Loads a data file into a list of `InputBatch`s."""
 
   unique_id = 1000000000
 
-  for (example_index, example) in enumerate(examples):
+  for (example_index, example) in enumerate(examples, example_index_offset):
     query_tokens = tokenizer.tokenize(example.question_text)
 
     if len(query_tokens) > max_query_length:
@@ -537,6 +552,171 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
       unique_id += 1
 
 
+_feature_worker_tokenizer = None
+
+
+def _init_feature_worker(tokenizer):
+  global _feature_worker_tokenizer
+  _feature_worker_tokenizer = tokenizer
+
+
+def _convert_examples_chunk(args):
+  examples, example_index_offset, max_seq_length, doc_stride, max_query_length, is_training = args
+  features = []
+  convert_examples_to_features(examples, _feature_worker_tokenizer, max_seq_length,
+                               doc_stride, max_query_length, is_training,
+                               features.append, example_index_offset)
+  return features
+
+
+def convert_examples_to_features_parallel(examples, tokenizer, max_seq_length,
+                                          doc_stride, max_query_length,
+                                          is_training, output_fn, num_workers):
+  """Same as `convert_examples_to_features`, with a pool of processes.
+
+  The examples are split into contiguous chunks and the features are passed to
+  `output_fn` in example order, with the unique ids the serial conversion gives.
+  """
+  if num_workers <= 1 or len(examples) < 2:
+    convert_examples_to_features(examples, tokenizer, max_seq_length,
+                                 doc_stride, max_query_length, is_training,
+                                 output_fn)
+    return
+
+  num_chunks = min(len(examples), 4 * num_workers)
+  bounds = [len(examples) * i // num_chunks for i in range(num_chunks + 1)]
+  chunks = [(examples[bounds[i]:bounds[i + 1]], bounds[i], max_seq_length,
+             doc_stride, max_query_length, is_training)
+            for i in range(num_chunks)]
+  unique_id = 1000000000
+  with ProcessPoolExecutor(num_workers, initializer=_init_feature_worker,
+                           initargs=(tokenizer,)) as executor:
+    for features in executor.map(_convert_examples_chunk, chunks):
+      for feature in features:
+        feature.unique_id = unique_id
+        unique_id += 1
+        output_fn(feature)
+
+
+_FEATURE_CACHE_VERSION = 1
+
+# Seed of the pre-shuffle of the training examples, part of the cache key of
+# the training features.
+_TRAIN_SHUFFLE_SEED = 12345
+
+
+def _file_sha256(filename):
+  sha = hashlib.sha256()
+  with tf.io.gfile.GFile(filename, "rb") as reader:
+    while True:
+      block = reader.read(1 << 20)
+      if not block:
+        break
+      sha.update(block)
+  return sha.hexdigest()
+
+
+def feature_cache_key(input_file, is_training, **params):
+  """Returns the cache key of the features of `input_file`.
+
+  The key covers the content of the input and vocab files, the tokenization
+  parameters and any extra `params` the features depend on.
+  """
+  key = {
+      "version": _FEATURE_CACHE_VERSION,
+      "input_file": _file_sha256(input_file),
+      "vocab_file": _file_sha256(FLAGS.vocab_file),
+      "do_lower_case": FLAGS.do_lower_case,
+      "max_seq_length": FLAGS.max_seq_length,
+      "doc_stride": FLAGS.doc_stride,
+      "max_query_length": FLAGS.max_query_length,
+      "is_training": is_training,
+  }
+  key.update(params)
+  return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def write_features(examples, tokenizer, output_file, is_training, cache_key=None,
+                   keep_features=False):
+  """Converts `examples` and writes the features to the TFRecord `output_file`.
+
+  With FLAGS.features_cache_dir and a `cache_key`, the features are taken from
+  the cache when present and added to it otherwise.
+
+  Returns:
+    The number of features and, with `keep_features`, the list of features.
+  """
+  cache_dir = None
+  if FLAGS.features_cache_dir and cache_key is not None:
+    cache_dir = os.path.join(FLAGS.features_cache_dir, cache_key)
+    meta_file = os.path.join(cache_dir, "meta.json")
+    if tf.io.gfile.exists(meta_file) and (
+        not keep_features or
+        tf.io.gfile.exists(os.path.join(cache_dir, "features.pkl"))):
+      with tf.io.gfile.GFile(meta_file, "r") as reader:
+        num_features = json.load(reader)["num_features"]
+      features = None
+      if keep_features:
+        with tf.io.gfile.GFile(os.path.join(cache_dir, "features.pkl"), "rb") as reader:
+          features = pickle.load(reader)
+      tf.io.gfile.copy(os.path.join(cache_dir, "features.tf_record"),
+                       output_file, overwrite=True)
+      tf.compat.v1.logging.info("Loaded %d cached features from %s",
+                                num_features, cache_dir)
+      return num_features, features
+
+  writer = FeatureWriter(filename=output_file, is_training=is_training)
+  features = [] if keep_features else None
+
+  def output_fn(feature):
+    writer.process_feature(feature)
+    if keep_features:
+      features.append(feature)
+
+  convert_examples_to_features_parallel(
+      examples=examples,
+      tokenizer=tokenizer,
+      max_seq_length=FLAGS.max_seq_length,
+      doc_stride=FLAGS.doc_stride,
+      max_query_length=FLAGS.max_query_length,
+      is_training=is_training,
+      output_fn=output_fn,
+      num_workers=FLAGS.num_feature_workers)
+  writer.close()
+
+  if cache_dir is not None:
+    # Build the entry next to its final place and publish it with a rename,
+    # meta.json is written last and marks a complete entry.
+    tmp_dir = "%s.tmp-%s-%d" % (cache_dir, socket.gethostname(), os.getpid())
+    tf.io.gfile.makedirs(tmp_dir)
+    tf.io.gfile.copy(output_file, os.path.join(tmp_dir, "features.tf_record"),
+                     overwrite=True)
+    if keep_features:
+      with tf.io.gfile.GFile(os.path.join(tmp_dir, "features.pkl"), "wb") as f:
+        pickle.dump(features, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with tf.io.gfile.GFile(os.path.join(tmp_dir, "meta.json"), "w") as f:
+      json.dump({"num_features": writer.num_features}, f)
+    try:
+      if tf.io.gfile.exists(cache_dir):
+        # A published entry is never replaced, other processes may be reading
+        # it. Only the missing features.pkl is added, with a rename of its own.
+        pkl_file = os.path.join(cache_dir, "features.pkl")
+        if keep_features and not tf.io.gfile.exists(pkl_file):
+          tf.io.gfile.rename(os.path.join(tmp_dir, "features.pkl"), pkl_file)
+        tf.compat.v1.logging.info("Using the features published in %s", cache_dir)
+      else:
+        tf.io.gfile.rename(tmp_dir, cache_dir)
+        tf.compat.v1.logging.info("Cached %d features in %s", writer.num_features,
+                                  cache_dir)
+    except tf.errors.OpError:
+      # another process published the same entry or features.pkl first
+      pass
+    if tf.io.gfile.exists(tmp_dir):
+      tf.io.gfile.rmtree(tmp_dir)
+
+  return writer.num_features, features
+
+
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
   """Returns tokenized answer spans that better match the annotated answer."""
@@ -834,9 +1014,15 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
   for result in all_results:
     unique_id_to_result[result.unique_id] = result
 
-  _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-      "PrelimPrediction",
-      ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
+  # n-best start and end indexes of all the features at once
+  unique_id_to_best = {}
+  if all_results:
+    best_start_indexes = _get_best_indexes_batched(
+        np.array([result.start_logits for result in all_results], dtype=np.float64), n_best_size)
+    best_end_indexes = _get_best_indexes_batched(
+        np.array([result.end_logits for result in all_results], dtype=np.float64), n_best_size)
+    for (i, result) in enumerate(all_results):
+      unique_id_to_best[result.unique_id] = (best_start_indexes[i], best_end_indexes[i])
 
   all_predictions = collections.OrderedDict()
   all_nbest_json = collections.OrderedDict()
@@ -845,67 +1031,9 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
   for (example_index, example) in enumerate(all_examples):
     features = example_index_to_features[example_index]
 
-    prelim_predictions = []
-    # keep track of the minimum score of null start+end of position 0
-    score_null = 1000000  # large and positive
-    min_null_feature_index = 0  # the paragraph slice with min mull score
-    null_start_logit = 0  # the start logit at the slice with min null score
-    null_end_logit = 0  # the end logit at the slice with min null score
-    for (feature_index, feature) in enumerate(features):
-      result = unique_id_to_result[feature.unique_id]
-      start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-      end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-      # if we could have irrelevant answers, get the min score of irrelevant
-      if version_2_with_negative:
-        feature_null_score = result.start_logits[0] + result.end_logits[0]
-        if feature_null_score < score_null:
-          score_null = feature_null_score
-          min_null_feature_index = feature_index
-          null_start_logit = result.start_logits[0]
-          null_end_logit = result.end_logits[0]
-      for start_index in start_indexes:
-        for end_index in end_indexes:
-          # We could hypothetically create invalid predictions, e.g., predict
-          # that the start of the span is in the question. We throw out all
-          # invalid predictions.
-          if start_index >= len(feature.tokens):
-            continue
-          if end_index >= len(feature.tokens):
-            continue
-          if start_index not in feature.token_to_orig_map:
-            continue
-          if end_index not in feature.token_to_orig_map:
-            continue
-          if not feature.token_is_max_context.get(start_index, False):
-            continue
-          if end_index < start_index:
-            continue
-          length = end_index - start_index + 1
-          if length > max_answer_length:
-            continue
-          prelim_predictions.append(
-              _PrelimPrediction(
-                  feature_index=feature_index,
-                  start_index=start_index,
-                  end_index=end_index,
-                  start_logit=result.start_logits[start_index],
-                  end_logit=result.end_logits[end_index]))
-
-    if version_2_with_negative:
-      prelim_predictions.append(
-          _PrelimPrediction(
-              feature_index=min_null_feature_index,
-              start_index=0,
-              end_index=0,
-              start_logit=null_start_logit,
-              end_logit=null_end_logit))
-    prelim_predictions = sorted(
-        prelim_predictions,
-        key=lambda x: (x.start_logit + x.end_logit),
-        reverse=True)
-
-    _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "NbestPrediction", ["text", "start_logit", "end_logit"])
+    (prelim_predictions, score_null, null_start_logit, null_end_logit) = _get_prelim_predictions(
+        features, unique_id_to_result, unique_id_to_best, max_answer_length,
+        version_2_with_negative)
 
     seen_predictions = {}
     nbest = []
@@ -1007,6 +1135,94 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
   return [all_predictions, all_nbest_json, scores_diff_json]
 
 
+_PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+    "PrelimPrediction",
+    ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
+
+
+_NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+    "NbestPrediction", ["text", "start_logit", "end_logit"])
+
+
+def _get_prelim_predictions(features, unique_id_to_result, unique_id_to_best,
+                            max_answer_length, version_2_with_negative):
+  """Valid spans of the n-best start and end indexes of an example's features.
+
+  Returns the spans as `_PrelimPrediction`s ordered by decreasing score, in the
+  order the pairwise enumeration of the indexes followed by a stable sort gives,
+  together with the minimum null score and its start and end logits.
+  """
+  feature_indexes = []
+  start_indexes = []
+  end_indexes = []
+  start_logits = []
+  end_logits = []
+  # keep track of the minimum score of null start+end of position 0
+  score_null = 1000000  # large and positive
+  min_null_feature_index = 0  # the paragraph slice with min mull score
+  null_start_logit = 0  # the start logit at the slice with min null score
+  null_end_logit = 0  # the end logit at the slice with min null score
+  for (feature_index, feature) in enumerate(features):
+    result = unique_id_to_result[feature.unique_id]
+    best_start, best_end = unique_id_to_best[feature.unique_id]
+    # if we could have irrelevant answers, get the min score of irrelevant
+    if version_2_with_negative:
+      feature_null_score = result.start_logits[0] + result.end_logits[0]
+      if feature_null_score < score_null:
+        score_null = feature_null_score
+        min_null_feature_index = feature_index
+        null_start_logit = result.start_logits[0]
+        null_end_logit = result.end_logits[0]
+
+    # We could hypothetically create invalid predictions, e.g., predict
+    # that the start of the span is in the question. We throw out all
+    # invalid predictions.
+    num_tokens = len(feature.tokens)
+    start_ok = np.array([i < num_tokens and i in feature.token_to_orig_map and
+                         feature.token_is_max_context.get(i, False)
+                         for i in best_start.tolist()], dtype=bool)
+    end_ok = np.array([i < num_tokens and i in feature.token_to_orig_map
+                       for i in best_end.tolist()], dtype=bool)
+    lengths = best_end[np.newaxis, :] - best_start[:, np.newaxis] + 1
+    valid = (start_ok[:, np.newaxis] & end_ok[np.newaxis, :] &
+             (lengths >= 1) & (lengths <= max_answer_length))
+    # row-major order is the order of the start/end double loop
+    start_rows, end_rows = np.nonzero(valid)
+    feature_indexes.append(np.full(len(start_rows), feature_index))
+    start_indexes.append(best_start[start_rows])
+    end_indexes.append(best_end[end_rows])
+    start_logits.append(np.asarray(result.start_logits, dtype=np.float64)[best_start[start_rows]])
+    end_logits.append(np.asarray(result.end_logits, dtype=np.float64)[best_end[end_rows]])
+
+  if version_2_with_negative:
+    feature_indexes.append([min_null_feature_index])
+    start_indexes.append([0])
+    end_indexes.append([0])
+    start_logits.append([null_start_logit])
+    end_logits.append([null_end_logit])
+
+  if not feature_indexes:
+    return [], score_null, null_start_logit, null_end_logit
+  feature_indexes = np.concatenate(feature_indexes)
+  start_indexes = np.concatenate(start_indexes)
+  end_indexes = np.concatenate(end_indexes)
+  start_logits = np.concatenate(start_logits).astype(np.float64)
+  end_logits = np.concatenate(end_logits).astype(np.float64)
+  # a stable sort on the negated scores keeps ties in enumeration order, like
+  # sorted(..., reverse=True)
+  order = np.argsort(-(start_logits + end_logits), kind="stable")
+
+  prelim_predictions = (
+      _PrelimPrediction(
+          feature_index=int(feature_indexes[i]),
+          start_index=int(start_indexes[i]),
+          end_index=int(end_indexes[i]),
+          start_logit=float(start_logits[i]),
+          end_logit=float(end_logits[i]))
+      for i in order)
+  return prelim_predictions, score_null, null_start_logit, null_end_logit
+
+
 def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging):
   """Project the tokenized prediction back to the original text."""
 
@@ -1115,6 +1331,30 @@ def _get_best_indexes(logits, n_best_size):
   return best_indexes
 
 
+def _get_best_indexes_batched(logits, n_best_size):
+  """`_get_best_indexes` of every row of the 2-D `logits` array.
+
+  Uses a partial sort and returns the same indexes in the same order, i.e. the
+  lower index first among equal logits.
+  """
+  num_best = min(n_best_size, logits.shape[1])
+  if num_best <= 0:
+    return np.zeros((logits.shape[0], 0), dtype=np.int64)
+  candidates = np.argpartition(-logits, num_best - 1, axis=1)[:, :num_best]
+  values = np.take_along_axis(logits, candidates, axis=1)
+  order = np.lexsort((candidates, -values), axis=1)
+  best = np.take_along_axis(candidates, order, axis=1)
+
+  # argpartition keeps an arbitrary subset of the logits equal to the last
+  # kept one, sort the rows where some of those were left out exactly
+  threshold = np.take_along_axis(logits, best[:, -1:], axis=1)
+  num_tied = np.sum(logits == threshold, axis=1)
+  num_tied_kept = np.sum(np.take_along_axis(logits, best, axis=1) == threshold, axis=1)
+  for row in np.flatnonzero(num_tied > num_tied_kept):
+    best[row] = np.lexsort((np.arange(logits.shape[1]), -logits[row]))[:num_best]
+  return best
+
+
 def _compute_softmax(scores):
   """Compute softmax probability over raw logits."""
   if not scores:
@@ -1276,7 +1516,7 @@ def main(_):
 
     # Pre-shuffle the input to avoid having to make a very large shuffle
     # buffer in in the `input_fn`.
-    rng = random.Random(12345)
+    rng = random.Random(_TRAIN_SHUFFLE_SEED)
     rng.shuffle(train_examples)
 
   start_index = 0
@@ -1328,19 +1568,17 @@ def main(_):
     # We write to a temporary file to avoid storing very large constant tensors
     # in memory.
 
-    train_writer = FeatureWriter(
-        filename=per_worker_filenames[hvd.local_rank() if horovod_enabled() else worker_id],
-        is_training=True)
-    convert_examples_to_features(
-        examples=train_examples[start_index:end_index],
-        tokenizer=tokenizer,
-        max_seq_length=FLAGS.max_seq_length,
-        doc_stride=FLAGS.doc_stride,
-        max_query_length=FLAGS.max_query_length,
-        is_training=True,
-        output_fn=train_writer.process_feature)
-    train_writer.close()
-    num_features = train_writer.num_features
+    cache_key = None
+    if FLAGS.features_cache_dir:
+      # the examples of this worker depend on the shuffle and the worker's slice
+      cache_key = feature_cache_key(
+          FLAGS.train_file, is_training=True,
+          version_2_with_negative=FLAGS.version_2_with_negative,
+          shuffle_seed=_TRAIN_SHUFFLE_SEED, start_index=start_index, end_index=end_index)
+    num_features, _ = write_features(
+        train_examples[start_index:end_index], tokenizer,
+        output_file=per_worker_filenames[hvd.local_rank() if horovod_enabled() else worker_id],
+        is_training=True, cache_key=cache_key)
 
     tf.compat.v1.logging.info("***** Running training *****")
     tf.compat.v1.logging.info("  Num orig examples = %d", len(train_examples))
@@ -1375,24 +1613,15 @@ def main(_):
     eval_examples = read_squad_examples(
         input_file=FLAGS.predict_file, is_training=False, version_2_with_negative=FLAGS.version_2_with_negative)
 
-    eval_writer = FeatureWriter(
-        filename=os.path.join(model_dir, "eval.tf_record"),
-        is_training=False)
-    eval_features = []
-
-    def append_feature(feature):
-      eval_features.append(feature)
-      eval_writer.process_feature(feature)
-
-    convert_examples_to_features(
-        examples=eval_examples,
-        tokenizer=tokenizer,
-        max_seq_length=FLAGS.max_seq_length,
-        doc_stride=FLAGS.doc_stride,
-        max_query_length=FLAGS.max_query_length,
-        is_training=False,
-        output_fn=append_feature)
-    eval_writer.close()
+    eval_file = os.path.join(model_dir, "eval.tf_record")
+    cache_key = None
+    if FLAGS.features_cache_dir:
+      cache_key = feature_cache_key(
+          FLAGS.predict_file, is_training=False,
+          version_2_with_negative=FLAGS.version_2_with_negative)
+    _, eval_features = write_features(
+        eval_examples, tokenizer, output_file=eval_file, is_training=False,
+        cache_key=cache_key, keep_features=True)
 
     tf.compat.v1.logging.info("***** Running predictions *****")
     tf.compat.v1.logging.info("  Num orig examples = %d", len(eval_examples))
@@ -1402,7 +1631,7 @@ def main(_):
     all_results = []
 
     predict_input_fn = input_fn_builder(
-        input_file=eval_writer.filename,
+        input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
         drop_remainder=False)
@@ -0,0 +1,115 @@
+# coding=utf-8
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+r"""Benchmark of the example packing methods of generator_utils.
+
+Packs the same examples with pack_examples (greedy) and pack_examples_best_fit
+(best fit decreasing) and reports the packing efficiency, tokens / (packed
+examples * packed_length). The examples are read from unpacked TFRecords, e.g.
+the shards of translate_ende_wmt32k, or drawn with WMT-like lengths. With
+--output_dir, the packed examples of every method are written as TFRecords.
+
+python data_generators/benchmark_packing.py \
+    --input_filepattern=$DATA_DIR/translate_ende_wmt32k-train-0000[0-9]*
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+import time
+
+import numpy as np
+
+from TensorFlow.nlp.transformer.data_generators import generator_utils
+
+import tensorflow.compat.v1 as tf
+
+tf.flags.DEFINE_string('input_filepattern', '',
+                       'Unpacked TFRecords, synthetic examples if empty')
+tf.flags.DEFINE_integer('max_examples', 500000,
+                        'How many examples to read or draw')
+tf.flags.DEFINE_bool('has_inputs', True,
+                     'Pack inputs and targets, or only targets')
+tf.flags.DEFINE_integer('packed_length', 256, 'Length of the packed examples')
+tf.flags.DEFINE_integer('spacing', 0, 'Padding between packed sequences')
+tf.flags.DEFINE_integer('queue_size', 10,
+                        'Queue size of the greedy packing')
+tf.flags.DEFINE_integer('window_size', 2**17,
+                        'Window size of the best fit decreasing packing')
+tf.flags.DEFINE_bool('with_padding', False,
+                     'Pad the packed examples, as in datagen.py')
+tf.flags.DEFINE_string('output_dir', '',
+                       'Directory of the packed TFRecords, not written if '
+                       'empty')
+tf.flags.DEFINE_integer('seed', 429459, 'Random seed')
+FLAGS = tf.flags.FLAGS
+
+
+def read_examples(filepattern, has_inputs, max_examples):
+  examples = []
+  for filename in sorted(tf.gfile.Glob(filepattern)):
+    for record in tf.python_io.tf_record_iterator(filename):
+      x = tf.train.Example()
+      x.ParseFromString(record)
+      example = {'targets': list(x.features.feature['targets'].int64_list.value)}
+      if has_inputs:
+        example['inputs'] = list(x.features.feature['inputs'].int64_list.value)
+      examples.append(example)
+      if len(examples) == max_examples:
+        return examples
+  return examples
+
+
+def synthetic_examples(has_inputs, max_examples, rng):
+  """Lognormal sentence lengths, roughly those of WMT en-de subtokens."""
+  def sequence():
+    return [1] * int(min(400, max(2, rng.lognormal(3.2, 0.6))))
+  return [dict(targets=sequence(), **({'inputs': sequence()}
+                                      if has_inputs else {}))
+          for _ in range(max_examples)]
+
+
+def main(unused_argv):
+  random.seed(FLAGS.seed)
+  if FLAGS.input_filepattern:
+    examples = read_examples(FLAGS.input_filepattern, FLAGS.has_inputs,
+                             FLAGS.max_examples)
+  else:
+    examples = synthetic_examples(FLAGS.has_inputs, FLAGS.max_examples,
+                                  np.random.RandomState(FLAGS.seed))
+  print('%d examples' % len(examples))
+
+  methods = [
+      ('greedy', lambda: generator_utils.pack_examples(
+          examples, FLAGS.has_inputs, FLAGS.packed_length,
+          spacing=FLAGS.spacing, queue_size=FLAGS.queue_size,
+          chop_long_sequences=not FLAGS.has_inputs)),
+      ('best_fit_decreasing', lambda: generator_utils.pack_examples_best_fit(
+          examples, FLAGS.has_inputs, FLAGS.packed_length,
+          spacing=FLAGS.spacing, window_size=FLAGS.window_size,
+          chop_long_sequences=not FLAGS.has_inputs)),
+  ]
+  print('%20s %10s %10s %12s %12s' % ('method', 'time (s)', 'examples',
+                                      'inputs eff', 'targets eff'))
+  for name, pack in methods:
+    start = time.time()
+    packed = list(pack())
+    elapsed = time.time() - start
+    efficiency = generator_utils.packing_efficiency(packed,
+                                                    FLAGS.packed_length)
+    print('%20s %10.1f %10d %12s %12s' % (
+        name, elapsed, len(packed),
+        '%.4f' % efficiency['inputs'] if 'inputs' in efficiency else '-',
+        '%.4f' % efficiency['targets']))
+    if FLAGS.output_dir:
+      tf.gfile.MakeDirs(FLAGS.output_dir)
+      generator_utils.write_records(
+          [generator_utils.to_example(x).SerializeToString() for x in packed],
+          os.path.join(FLAGS.output_dir, 'packed-%s.tfrecord' % name))
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,101 @@
+# coding=utf-8
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+r"""Benchmark of SubwordTextEncoder.build_to_target_size.
+
+Compares the vocabulary builder against a reference bisection that calls
+build_from_token_counts from scratch on every probe, as the builder did before
+the subtoken counts were shared between probes, and checks that all of them
+produce the same vocabulary.
+
+python data_generators/benchmark_subword_build.py \
+    --corpus_filepattern=$TMP_DIR/training/news-commentary-v13.de-en.en \
+    --corpus_max_lines=200000 --target_size=32768 --num_processes=1,8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+from TensorFlow.nlp.transformer.data_generators import text_encoder
+from TensorFlow.nlp.transformer.data_generators import tokenizer
+
+import tensorflow.compat.v1 as tf
+
+tf.flags.DEFINE_string('corpus_filepattern', '',
+                       'Corpus of one or more text files')
+tf.flags.DEFINE_integer('corpus_max_lines', 100000,
+                        'How many lines of corpus to read')
+tf.flags.DEFINE_integer('target_size', 2**15, 'Target vocabulary size')
+tf.flags.DEFINE_integer('max_subtoken_length', 200,
+                        'Maximum subtoken length, as in Text2TextProblem')
+tf.flags.DEFINE_string('num_processes', '1,8',
+                       'Comma separated numbers of counting processes')
+tf.flags.DEFINE_bool('reference', True,
+                     'Also time the reference bisection')
+FLAGS = tf.flags.FLAGS
+
+
+def reference_build_to_target_size(target_size, token_counts, min_val, max_val,
+                                   max_subtoken_length):
+  """The bisection of build_to_target_size, rebuilding from scratch."""
+
+  def bisect(min_val, max_val):
+    present_count = (max_val + min_val) // 2
+    subtokenizer = text_encoder.SubwordTextEncoder()
+    subtokenizer.build_from_token_counts(
+        token_counts, present_count, max_subtoken_length=max_subtoken_length)
+
+    is_ok = abs(subtokenizer.vocab_size - target_size) * 100 < target_size
+    if is_ok or min_val >= max_val or present_count < 2:
+      return subtokenizer
+
+    if subtokenizer.vocab_size > target_size:
+      other_subtokenizer = bisect(present_count + 1, max_val)
+    else:
+      other_subtokenizer = bisect(min_val, present_count - 1)
+
+    if other_subtokenizer is None:
+      return subtokenizer
+
+    if (abs(other_subtokenizer.vocab_size - target_size) <
+        abs(subtokenizer.vocab_size - target_size)):
+      return other_subtokenizer
+    return subtokenizer
+
+  return bisect(min_val, max_val)
+
+
+def main(unused_argv):
+  token_counts = tokenizer.corpus_token_counts(FLAGS.corpus_filepattern,
+                                              FLAGS.corpus_max_lines)
+  print('%d distinct tokens' % len(token_counts))
+
+  results = []
+  if FLAGS.reference:
+    start = time.time()
+    encoder = reference_build_to_target_size(
+        FLAGS.target_size, token_counts, 1, 1e3, FLAGS.max_subtoken_length)
+    results.append(('reference', time.time() - start, encoder))
+
+  for num_processes in [int(n) for n in FLAGS.num_processes.split(',')]:
+    start = time.time()
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        FLAGS.target_size, token_counts, 1, 1e3,
+        max_subtoken_length=FLAGS.max_subtoken_length,
+        num_processes=num_processes)
+    results.append(('%d processes' % num_processes, time.time() - start,
+                    encoder))
+
+  expected = results[0][2].all_subtoken_strings
+  print('%14s %10s %10s %10s' % ('builder', 'time (s)', 'vocab', 'identical'))
+  for name, elapsed, encoder in results:
+    print('%14s %10.1f %10d %10s' % (
+        name, elapsed, encoder.vocab_size,
+        encoder.all_subtoken_strings == expected))
+
+
+if __name__ == '__main__':
+  tf.app.run()
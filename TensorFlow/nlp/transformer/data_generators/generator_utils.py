@@ -12,6 +12,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added num_processes to get_or_generate_vocab_inner
+# - generate_files and generate_files_distributed flush the subtoken caches
+# - added pack_examples_best_fit and packing_efficiency
 
 """Utilities for data generators."""
 
@@ -19,6 +26,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import functools
 import gzip
 import math
@@ -95,6 +103,7 @@ def generate_files_distributed(generator,
     writer.write(example.SerializeToString())
 
   writer.close()
+  text_encoder.flush_subtoken_caches()
   return output_file
 
 
@@ -187,6 +196,7 @@ def generate_files(generator, output_filenames,
 
   for writer in writers:
     writer.close()
+  text_encoder.flush_subtoken_caches()
 
   for tmp_name, final_name in zip(tmp_filenames, output_filenames):
     tf.gfile.Rename(tmp_name, final_name)
@@ -321,7 +331,7 @@ def gunzip_file(gz_path, new_path):
 
 def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
                                 generator, max_subtoken_length=None,
-                                reserved_tokens=None):
+                                reserved_tokens=None, num_processes=1):
   """Inner implementation for vocab generators.
 
   Args:
@@ -335,6 +345,8 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
     reserved_tokens: List of reserved tokens. `text_encoder.RESERVED_TOKENS`
       should be a prefix of `reserved_tokens`. If `None`, defaults to
       `RESERVED_TOKENS`.
+    num_processes: Number of processes counting subtokens while building the
+      vocabulary.
 
   Returns:
     A SubwordTextEncoder vocabulary object.
@@ -350,7 +362,7 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
   tf.logging.info("Generating vocab file: %s", vocab_filepath)
   vocab = text_encoder.SubwordTextEncoder.build_from_generator(
       generator, vocab_size, max_subtoken_length=max_subtoken_length,
-      reserved_tokens=reserved_tokens)
+      reserved_tokens=reserved_tokens, num_processes=num_processes)
 
   if vocab_filepath:
     tf.gfile.MakeDirs(data_dir)
@@ -674,6 +686,139 @@ def pack_examples(examples,
     yield c.to_dict()
 
 
+PACKING_METHODS = ["greedy", "best_fit_decreasing"]
+
+
+def pack_examples_best_fit(examples,
+                           has_inputs,
+                           packed_length=256,
+                           spacing=2,
+                           window_size=2**17,
+                           chop_long_sequences=False):
+  """Pack examples into longer examples, best fit decreasing.
+
+  Produces the same packed examples as pack_examples(), but packs every window
+  of `window_size` examples offline instead of in arrival order: the examples
+  are sorted by decreasing length and each one is added to the packed example
+  where it leaves the least free space, or starts a new one if it fits in
+  none. The open packed examples are bucketed by their free space, so finding
+  the best fit does not scan them. The packed examples of a window are yielded
+  in random order.
+
+  Args:
+    examples: a generator returning feature dictionaries.
+    has_inputs: a boolean
+    packed_length: an integer
+    spacing: an integer
+    window_size: an integer, number of examples packed together.
+    chop_long_sequences: a boolean
+
+  Yields:
+    feature dictionaries.
+  """
+  window = []
+  for example in examples:
+    x = ((example["inputs"], example["targets"])
+         if has_inputs else example["targets"])
+    if chop_long_sequences and len(x) > packed_length:
+      assert not has_inputs
+      num_fragments = len(x) // packed_length
+      for i in range(num_fragments):
+        yield SequencePacker(
+            x[packed_length * i:packed_length * (i + 1)], spacing).to_dict()
+      x = x[packed_length * num_fragments:]
+    window.append(x)
+    if len(window) == window_size:
+      for packed in _pack_window_best_fit(window, has_inputs, packed_length,
+                                          spacing):
+        yield packed
+      window = []
+  for packed in _pack_window_best_fit(window, has_inputs, packed_length,
+                                      spacing):
+    yield packed
+
+
+def _pack_window_best_fit(window, has_inputs, packed_length, spacing):
+  """Best fit decreasing packing of a list of sequences or sequence pairs."""
+  if has_inputs:
+    lengths = [(len(x[0]), len(x[1])) for x in window]
+    packer = SequencePairPacker
+  else:
+    lengths = [(0, len(x)) for x in window]
+    packer = SequencePacker
+  order = sorted(range(len(window)),
+                 key=lambda i: (-max(lengths[i]), -sum(lengths[i])))
+
+  # fit[r_inputs, r_targets] is the free space r_inputs + r_targets if there
+  # are open packed examples with that much free space in inputs and targets,
+  # else no_fit. open_packers[(r_inputs, r_targets)] are their indices in
+  # packers. The inputs axis has size 1 without inputs.
+  num_inputs_free = packed_length + 1 if has_inputs else 1
+  free_space = np.add.outer(np.arange(num_inputs_free),
+                            np.arange(packed_length + 1))
+  no_fit = free_space.max() + 1
+  fit = np.full(free_space.shape, no_fit, dtype=np.int32)
+  open_packers = collections.defaultdict(list)
+  packers = []
+  for i in order:
+    inputs_length, targets_length = lengths[i]
+    if max(inputs_length, targets_length) > packed_length:
+      packers.append(packer(window[i], spacing))
+      continue
+    inputs_needed = inputs_length + spacing if has_inputs else 0
+    targets_needed = targets_length + spacing
+    best = None
+    if inputs_needed <= packed_length and targets_needed <= packed_length:
+      candidates = fit[inputs_needed:, targets_needed:]
+      best = np.unravel_index(np.argmin(candidates), candidates.shape)
+      if candidates[best] == no_fit:
+        best = None
+    if best is None:
+      index = len(packers)
+      packers.append(packer(window[i], spacing))
+      free = ((packed_length - inputs_length if has_inputs else 0),
+              packed_length - targets_length)
+    else:
+      free = (best[0] + inputs_needed, best[1] + targets_needed)
+      index = open_packers[free].pop()
+      if not open_packers[free]:
+        fit[free] = no_fit
+      packers[index].add(window[i])
+      free = (free[0] - inputs_needed if has_inputs else 0,
+              free[1] - targets_needed)
+    open_packers[free].append(index)
+    fit[free] = free_space[free]
+
+  random.shuffle(packers)
+  for c in packers:
+    if FLAGS.with_padding:
+      c.pad(packed_length)
+    yield c.to_dict()
+
+
+def packing_efficiency(packed_examples, packed_length):
+  """Fraction of the packed example positions holding tokens.
+
+  Args:
+    packed_examples: a list of feature dictionaries, as produced by
+      pack_examples() or pack_examples_best_fit().
+    packed_length: an integer
+
+  Returns:
+    a dictionary from "inputs" and "targets" to
+    tokens / (number of packed examples * packed_length).
+  """
+  efficiency = {}
+  for key in ["inputs", "targets"]:
+    segmentation_key = key + "_segmentation"
+    if not packed_examples or segmentation_key not in packed_examples[0]:
+      continue
+    num_tokens = sum(len(x[segmentation_key]) - x[segmentation_key].count(0)
+                     for x in packed_examples)
+    efficiency[key] = num_tokens / (len(packed_examples) * packed_length)
+  return efficiency
+
+
 def pack_dataset(dataset, length, keys=None, use_custom_ops=False):
   """Creates a 'packed' version of a dataset on-the-fly.
 
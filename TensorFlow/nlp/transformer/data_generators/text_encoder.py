@@ -12,6 +12,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - SubwordTextEncoder vocabulary building reuses the escaped tokens and the
+#   first iteration's subtoken counts across the bisection probes and can
+#   count the subtokens in parallel processes
+# - added SubtokenCache, a persistent token to subtoken ids cache shared by
+#   the processes using the same vocabulary
 
 """Encoders for text data.
 
@@ -24,10 +33,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
 import collections
+import fcntl
+import hashlib
 from itertools import chain
 import math
+import mmap
+import multiprocessing
+import os
 import re
+import struct
 import tempfile
 import time
 import numpy as np
@@ -445,6 +461,413 @@ def _unescape_token(escaped_token):
   return _UNESCAPE_REGEX.sub(match, trimmed)
 
 
+# Minimum number of tokens per process for the subtoken counting to be sharded.
+_MIN_TOKENS_PER_COUNT_PROCESS = 10000
+
+
+def _count_subtokens(encoder, escaped_token_counts, max_subtoken_length,
+                     first_chars=None):
+  """Counts the substrings of the tokens that start on a subtoken boundary.
+
+  Args:
+    encoder: a SubwordTextEncoder whose vocabulary segments the tokens.
+    escaped_token_counts: a list of (escaped token, count) pairs.
+    max_subtoken_length: Maximum length of a counted substring, or None.
+    first_chars: if set, only substrings starting with one of these characters
+      are counted.
+
+  Returns:
+    A defaultdict(int) from substrings to the sum of the counts of the tokens
+    they occur in.
+  """
+  subtoken_counts = collections.defaultdict(int)
+  for escaped_token, count in escaped_token_counts:
+    iter_start_time = time.time()
+    subtokens = encoder._escaped_token_to_subtoken_strings(escaped_token)  # pylint: disable=protected-access
+    start = 0
+    for subtoken in subtokens:
+      if first_chars is None or escaped_token[start] in first_chars:
+        last_position = len(escaped_token) + 1
+        if max_subtoken_length is not None:
+          last_position = min(last_position, start + max_subtoken_length)
+
+        for end in range(start + 1, last_position):
+          new_subtoken = escaped_token[start:end]
+          subtoken_counts[new_subtoken] += count
+      start += len(subtoken)
+    iter_time_secs = time.time() - iter_start_time
+    if iter_time_secs > 0.1:
+      tf.logging.info(u"Processing token [{0}] took {1} seconds, consider "
+                      "setting Text2TextProblem.max_subtoken_length to a "
+                      "smaller value.".format(escaped_token, iter_time_secs))
+  return subtoken_counts
+
+
+def _select_subtokens(subtoken_counts, min_count, alphabet):
+  """Selects the candidate subtokens with at least `min_count` occurrences.
+
+  Args:
+    subtoken_counts: a dictionary of substring counts from _count_subtokens,
+      modified in place.
+    min_count: an integer - discard subtokens with lower counts.
+    alphabet: the set of characters of the vocabulary.
+
+  Returns:
+    A list of (count, subtoken) pairs of the selected subtokens that are not in
+    the alphabet, and a dictionary of the counts of the alphabet characters.
+  """
+  # Array of sets of candidate subtoken strings, by length.
+  len_to_subtoken_strings = []
+  for subtoken_string, count in six.iteritems(subtoken_counts):
+    lsub = len(subtoken_string)
+    if count >= min_count:
+      while len(len_to_subtoken_strings) <= lsub:
+        len_to_subtoken_strings.append(set())
+      len_to_subtoken_strings[lsub].add(subtoken_string)
+
+  # Consider the candidates longest to shortest, so that if we accept
+  # a longer subtoken string, we can decrement the counts of its prefixes.
+  new_subtoken_strings = []
+  for lsub in range(len(len_to_subtoken_strings) - 1, 0, -1):
+    subtoken_strings = len_to_subtoken_strings[lsub]
+    for subtoken_string in subtoken_strings:
+      count = subtoken_counts[subtoken_string]
+      if count >= min_count:
+        # Exclude alphabet tokens here, as they must be included later,
+        # explicitly, regardless of count.
+        if subtoken_string not in alphabet:
+          new_subtoken_strings.append((count, subtoken_string))
+        for l in range(1, lsub):
+          subtoken_counts[subtoken_string[:l]] -= count
+
+  alphabet_counts = {
+      a: subtoken_counts[a] for a in alphabet if a in subtoken_counts}
+  return new_subtoken_strings, alphabet_counts
+
+
+def _subtoken_count_worker(conn, escaped_token_counts, alphabet, first_chars,
+                           max_subtoken_length):
+  """Process serving the subtoken selection for the substrings that start
+  with one of `first_chars`.
+
+  All occurrences of such a substring and of its prefixes are counted by the
+  same process, so the selection can be done on the partial counts.
+  """
+  escaped_token_counts = [(escaped_token, count)
+                          for escaped_token, count in escaped_token_counts
+                          if not first_chars.isdisjoint(escaped_token)]
+  encoder = SubwordTextEncoder()
+  initial_counts = None
+  while True:
+    message = conn.recv()
+    if message is None:
+      break
+    subtoken_strings, min_count = message
+    if subtoken_strings is None:
+      if initial_counts is None:
+        encoder._init_subtokens_from_list(list(alphabet))  # pylint: disable=protected-access
+        initial_counts = _count_subtokens(encoder, escaped_token_counts,
+                                          max_subtoken_length, first_chars)
+      subtoken_counts = collections.defaultdict(int, initial_counts)
+    else:
+      encoder._init_subtokens_from_list(subtoken_strings)  # pylint: disable=protected-access
+      subtoken_counts = _count_subtokens(encoder, escaped_token_counts,
+                                         max_subtoken_length, first_chars)
+    conn.send(_select_subtokens(subtoken_counts, min_count, first_chars))
+  conn.close()
+
+
+class _SubtokenCounter(object):
+  """Selects candidate subtokens of fixed token counts for changing vocabularies.
+
+  The tokens are escaped once. The counts for the initial vocabulary of single
+  characters do not depend on min_count, so they are computed once and reused
+  by every build.
+
+  With several processes, every process owns the substrings starting with some
+  of the characters, balanced by the number of substrings. A substring and its
+  prefixes start with the same character, so each process selects its
+  candidates independently and only the selected subtokens are sent back.
+  """
+
+  def __init__(self, token_counts, alphabet, max_subtoken_length,
+               num_processes=1):
+    self._escaped_token_counts = [
+        (_escape_token(token, alphabet), count)
+        for token, count in six.iteritems(token_counts)]
+    self._alphabet = alphabet
+    self._max_subtoken_length = max_subtoken_length
+    self._num_processes = max(1, min(
+        num_processes,
+        len(self._escaped_token_counts) // _MIN_TOKENS_PER_COUNT_PROCESS))
+    self._initial_counts = None
+    self._workers = None
+
+  def _start_workers(self):
+    # Number of substrings starting with every character.
+    char_weights = collections.defaultdict(int)
+    for escaped_token, _ in self._escaped_token_counts:
+      token_len = len(escaped_token)
+      for position, c in enumerate(escaped_token):
+        num_ends = token_len - position
+        if self._max_subtoken_length is not None:
+          num_ends = min(num_ends, self._max_subtoken_length - 1)
+        char_weights[c] += num_ends
+
+    # Longest processing time first: the heaviest character goes to the least
+    # loaded process.
+    first_chars = [set() for _ in range(self._num_processes)]
+    loads = [0] * self._num_processes
+    for c in sorted(self._alphabet, key=lambda c: (-char_weights[c], c)):
+      i = loads.index(min(loads))
+      first_chars[i].add(c)
+      loads[i] += char_weights[c]
+
+    self._workers = []
+    for chars in first_chars:
+      parent_conn, child_conn = multiprocessing.Pipe()
+      process = multiprocessing.Process(
+          target=_subtoken_count_worker,
+          args=(child_conn, self._escaped_token_counts, self._alphabet, chars,
+                self._max_subtoken_length))
+      process.daemon = True
+      process.start()
+      child_conn.close()
+      self._workers.append((process, parent_conn))
+
+  def select(self, encoder, min_count):
+    """Selects the candidate subtokens for the next vocabulary.
+
+    Args:
+      encoder: a SubwordTextEncoder whose vocabulary segments the tokens, or
+        None for the initial vocabulary of single characters.
+      min_count: an integer - discard subtokens with lower counts.
+
+    Returns:
+      The (count, subtoken) pairs and the alphabet counts of _select_subtokens.
+    """
+    if self._num_processes == 1:
+      if encoder is None:
+        if self._initial_counts is None:
+          encoder = SubwordTextEncoder()
+          encoder._init_subtokens_from_list(list(self._alphabet))  # pylint: disable=protected-access
+          self._initial_counts = _count_subtokens(
+              encoder, self._escaped_token_counts, self._max_subtoken_length)
+        subtoken_counts = collections.defaultdict(int, self._initial_counts)
+      else:
+        subtoken_counts = _count_subtokens(
+            encoder, self._escaped_token_counts, self._max_subtoken_length)
+      return _select_subtokens(subtoken_counts, min_count, self._alphabet)
+
+    if self._workers is None:
+      self._start_workers()
+    subtoken_strings = None
+    if encoder is not None:
+      subtoken_strings = list(encoder._subtoken_string_to_id)  # pylint: disable=protected-access
+    for _, conn in self._workers:
+      conn.send((subtoken_strings, min_count))
+    new_subtoken_strings = []
+    alphabet_counts = {}
+    for _, conn in self._workers:
+      worker_subtoken_strings, worker_alphabet_counts = conn.recv()
+      new_subtoken_strings.extend(worker_subtoken_strings)
+      alphabet_counts.update(worker_alphabet_counts)
+    return new_subtoken_strings, alphabet_counts
+
+  def close(self):
+    if self._workers is not None:
+      for process, conn in self._workers:
+        conn.send(None)
+        conn.close()
+        process.join()
+      self._workers = None
+
+
+# Directory of the persistent subtoken caches, see set_subtoken_cache_dir().
+SUBTOKEN_CACHE_DIR_ENV = "T2T_SUBTOKEN_CACHE_DIR"
+_subtoken_cache_dir = os.environ.get(SUBTOKEN_CACHE_DIR_ENV) or None
+# Open SubtokenCaches of this process, by path.
+_subtoken_caches = {}
+
+
+def set_subtoken_cache_dir(cache_dir):
+  """Enables the persistent subtoken cache of SubwordTextEncoders.
+
+  The cache directory is also exported in the T2T_SUBTOKEN_CACHE_DIR
+  environment variable, so that child processes use the same caches.
+
+  Args:
+    cache_dir: a local directory, or None to disable the cache.
+  """
+  global _subtoken_cache_dir
+  _subtoken_cache_dir = cache_dir or None
+  if _subtoken_cache_dir:
+    os.environ[SUBTOKEN_CACHE_DIR_ENV] = _subtoken_cache_dir
+  else:
+    os.environ.pop(SUBTOKEN_CACHE_DIR_ENV, None)
+
+
+def flush_subtoken_caches():
+  """Writes the new entries of all subtoken caches of this process to disk."""
+  for subtoken_cache in list(_subtoken_caches.values()):
+    subtoken_cache.flush()
+
+
+atexit.register(flush_subtoken_caches)
+
+
+def _get_subtoken_cache(cache_dir, vocab_hash):
+  path = os.path.join(cache_dir, "subtoken_ids-%s.cache" % vocab_hash)
+  if path not in _subtoken_caches:
+    _subtoken_caches[path] = SubtokenCache(path)
+  return _subtoken_caches[path]
+
+
+class SubtokenCache(object):
+  """Persistent token to subtoken ids cache of one SubwordTextEncoder vocabulary.
+
+  The cache is a memory-mapped, open-addressing hash table shared by all the
+  processes using the same file. Lookups compare the full token, so hash
+  collisions never return wrong ids. New entries are kept in memory and merged
+  into the file by flush(), under a file lock, by writing a new table and
+  renaming it over the old one; the other processes keep reading their mapping
+  of the previous table until they flush themselves.
+
+  File layout, little-endian: the header (magic, number of slots, number of
+  entries), the slots as (token hash, entry offset) uint64 pairs, with offset 0
+  for an empty slot, then the entries as (token size, number of ids) uint32
+  pairs followed by the UTF-8 token and the int32 ids.
+  """
+
+  _MAGIC = b"T2TSUBC1"
+  _HEADER = struct.Struct("<8sQQ")
+  _SLOT = struct.Struct("<QQ")
+  _ENTRY = struct.Struct("<II")
+  # Minimum number of new entries that triggers a flush. A flush rewrites the
+  # whole file, so it also waits for as many new entries as the file has.
+  FLUSH_SIZE = 2**16
+
+  def __init__(self, path):
+    self._path = path
+    self._mmap = None
+    self._num_slots = 0
+    self._num_entries = 0
+    self._pending = {}
+    self._open()
+
+  @staticmethod
+  def _hash(token_bytes):
+    return struct.unpack(
+        "<Q", hashlib.blake2b(token_bytes, digest_size=8).digest())[0]
+
+  def _open(self):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+    self._num_slots = 0
+    self._num_entries = 0
+    try:
+      with open(self._path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+      return
+    magic, num_slots, num_entries = self._HEADER.unpack_from(mapped, 0)
+    if magic != self._MAGIC:
+      mapped.close()
+      raise ValueError("%s is not a subtoken cache" % self._path)
+    self._mmap = mapped
+    self._num_slots = num_slots
+    self._num_entries = num_entries
+
+  def _lookup(self, token_bytes):
+    if not self._num_slots:
+      return None
+    mask = self._num_slots - 1
+    token_hash = self._hash(token_bytes)
+    slot = token_hash & mask
+    while True:
+      key, offset = self._SLOT.unpack_from(
+          self._mmap, self._HEADER.size + slot * self._SLOT.size)
+      if not offset:
+        return None
+      if key == token_hash:
+        token_size, num_ids = self._ENTRY.unpack_from(self._mmap, offset)
+        start = offset + self._ENTRY.size
+        if self._mmap[start:start + token_size] == token_bytes:
+          return list(struct.unpack_from("<%di" % num_ids, self._mmap,
+                                         start + token_size))
+      slot = (slot + 1) & mask
+
+  def get(self, token):
+    """Returns the subtoken ids of `token`, or None if it is not cached."""
+    ret = self._pending.get(token)
+    if ret is None:
+      ret = self._lookup(token.encode("utf-8", "surrogatepass"))
+    return ret
+
+  def add(self, token, subtoken_ids):
+    self._pending[token] = subtoken_ids
+    if len(self._pending) >= max(self.FLUSH_SIZE, self._num_entries):
+      self.flush()
+
+  def _entries(self):
+    """Yields the (token bytes, ids) of the mapped table."""
+    for slot in range(self._num_slots):
+      _, offset = self._SLOT.unpack_from(
+          self._mmap, self._HEADER.size + slot * self._SLOT.size)
+      if offset:
+        token_size, num_ids = self._ENTRY.unpack_from(self._mmap, offset)
+        start = offset + self._ENTRY.size
+        yield (self._mmap[start:start + token_size],
+               struct.unpack_from("<%di" % num_ids, self._mmap,
+                                  start + token_size))
+
+  def flush(self):
+    """Merges the new entries into the cache file."""
+    if not self._pending:
+      return
+    cache_dir = os.path.dirname(self._path)
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    with open(self._path + ".lock", "a") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        # Reread the file, other processes may have added entries.
+        self._open()
+        entries = dict(self._entries())
+        for token, subtoken_ids in six.iteritems(self._pending):
+          entries[token.encode("utf-8", "surrogatepass")] = subtoken_ids
+        self._write(entries)
+        self._open()
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    self._pending = {}
+
+  def _write(self, entries):
+    num_slots = 1
+    while num_slots < 2 * len(entries):
+      num_slots *= 2
+    slots = np.zeros((num_slots, 2), dtype=np.uint64)
+    data = bytearray()
+    data_offset = self._HEADER.size + num_slots * self._SLOT.size
+    mask = num_slots - 1
+    for token_bytes, subtoken_ids in six.iteritems(entries):
+      slot = self._hash(token_bytes) & mask
+      while slots[slot, 1]:
+        slot = (slot + 1) & mask
+      slots[slot] = (self._hash(token_bytes), data_offset + len(data))
+      data += self._ENTRY.pack(len(token_bytes), len(subtoken_ids))
+      data += token_bytes
+      data += struct.pack("<%di" % len(subtoken_ids), *subtoken_ids)
+
+    tmp_path = "%s.tmp%d" % (self._path, os.getpid())
+    with open(tmp_path, "wb") as f:
+      f.write(self._HEADER.pack(self._MAGIC, num_slots, len(entries)))
+      f.write(slots.astype("<u8").tobytes())
+      f.write(data)
+    os.rename(tmp_path, self._path)
+
+
 class SubwordTextEncoder(TextEncoder):
   """Class for invertibly encoding text using a limited vocabulary.
 
@@ -486,6 +909,7 @@ class SubwordTextEncoder(TextEncoder):
         vocab
     """
     self._alphabet = set()
+    self._subtoken_cache_hash = None
     self.filename = filename
     if filename is not None:
       self._load_from_file(filename)
@@ -568,11 +992,28 @@ class SubwordTextEncoder(TextEncoder):
     cache_key, cache_value = self._cache[cache_location]
     if cache_key == token:
       return cache_value
-    ret = self._escaped_token_to_subtoken_ids(
-        _escape_token(token, self._alphabet))
+    subtoken_cache = self._get_subtoken_cache()
+    ret = subtoken_cache.get(token) if subtoken_cache else None
+    if ret is None:
+      ret = self._escaped_token_to_subtoken_ids(
+          _escape_token(token, self._alphabet))
+      if subtoken_cache:
+        subtoken_cache.add(token, ret)
     self._cache[cache_location] = (token, ret)
     return ret
 
+  def _get_subtoken_cache(self):
+    """Returns the SubtokenCache of this vocabulary, None if it is disabled."""
+    if _subtoken_cache_dir is None:
+      return None
+    if self._subtoken_cache_hash is None:
+      vocab_hash = hashlib.sha1()
+      for s in chain(self._all_subtoken_strings, [u""],
+                     sorted(self._alphabet)):
+        vocab_hash.update(s.encode("utf-8", "surrogatepass") + b"\0")
+      self._subtoken_cache_hash = vocab_hash.hexdigest()[:16]
+    return _get_subtoken_cache(_subtoken_cache_dir, self._subtoken_cache_hash)
+
   def _subtoken_ids_to_tokens(self, subtokens):
     """Converts a list of subtoken ids to a list of tokens.
 
@@ -646,7 +1087,8 @@ class SubwordTextEncoder(TextEncoder):
                            generator,
                            target_size,
                            max_subtoken_length=None,
-                           reserved_tokens=None):
+                           reserved_tokens=None,
+                           num_processes=1):
     """Builds a SubwordTextEncoder from the generated text.
 
     Args:
@@ -659,6 +1101,7 @@ class SubwordTextEncoder(TextEncoder):
       reserved_tokens: List of reserved tokens. The global variable
         `RESERVED_TOKENS` must be a prefix of `reserved_tokens`. If this
         argument is `None`, it will use `RESERVED_TOKENS`.
+      num_processes: Number of processes counting the subtokens.
 
     Returns:
       SubwordTextEncoder with `vocab_size` approximately `target_size`.
@@ -670,7 +1113,8 @@ class SubwordTextEncoder(TextEncoder):
     encoder = cls.build_to_target_size(
         target_size, token_counts, 1, 1e3,
         max_subtoken_length=max_subtoken_length,
-        reserved_tokens=reserved_tokens)
+        reserved_tokens=reserved_tokens,
+        num_processes=num_processes)
     return encoder
 
   @classmethod
@@ -681,7 +1125,8 @@ class SubwordTextEncoder(TextEncoder):
                            max_val,
                            max_subtoken_length=None,
                            reserved_tokens=None,
-                           num_iterations=4):
+                           num_iterations=4,
+                           num_processes=1):
     """Builds a SubwordTextEncoder that has `vocab_size` near `target_size`.
 
     Uses simple recursive binary search to find a minimum token count that most
@@ -700,6 +1145,7 @@ class SubwordTextEncoder(TextEncoder):
         `RESERVED_TOKENS` must be a prefix of `reserved_tokens`. If this
         argument is `None`, it will use `RESERVED_TOKENS`.
       num_iterations: An integer; how many iterations of refinement.
+      num_processes: Number of processes counting the subtokens.
 
     Returns:
       A SubwordTextEncoder instance.
@@ -716,15 +1162,23 @@ class SubwordTextEncoder(TextEncoder):
     if reserved_tokens is None:
       reserved_tokens = RESERVED_TOKENS
 
+    # The alphabet, the escaped tokens and the first iteration's subtoken
+    # counts are the same for every probe of the bisection.
+    alphabet_encoder = cls()
+    alphabet_encoder._init_alphabet_from_token_counts(token_counts,
+                                                      reserved_tokens)
+    alphabet = alphabet_encoder._alphabet
+    subtoken_counter = _SubtokenCounter(token_counts, alphabet,
+                                        max_subtoken_length, num_processes)
+
     def bisect(min_val, max_val):
       """Bisection to find the right size."""
       present_count = (max_val + min_val) // 2
       tf.logging.info("Trying min_count %d" % present_count)
       subtokenizer = cls()
-      subtokenizer.build_from_token_counts(
-          token_counts, present_count, num_iterations,
-          max_subtoken_length=max_subtoken_length,
-          reserved_tokens=reserved_tokens)
+      subtokenizer._alphabet = set(alphabet)
+      subtokenizer._build_from_subtoken_counter(
+          subtoken_counter, present_count, num_iterations, reserved_tokens)
 
       # Being within 1% of the target size is ok.
       is_ok = abs(subtokenizer.vocab_size - target_size) * 100 < target_size
@@ -745,14 +1199,18 @@ class SubwordTextEncoder(TextEncoder):
         return other_subtokenizer
       return subtokenizer
 
-    return bisect(min_val, max_val)
+    try:
+      return bisect(min_val, max_val)
+    finally:
+      subtoken_counter.close()
 
   def build_from_token_counts(self,
                               token_counts,
                               min_count,
                               num_iterations=4,
                               reserved_tokens=None,
-                              max_subtoken_length=None):
+                              max_subtoken_length=None,
+                              num_processes=1):
     """Train a SubwordTextEncoder based on a dictionary of word counts.
 
     Args:
@@ -766,6 +1224,7 @@ class SubwordTextEncoder(TextEncoder):
         then the runtime and memory use of creating the vocab is quadratic in
         the length of the longest token. If this is set, then it is instead
         O(max_subtoken_length * length of longest token).
+      num_processes: Number of processes counting the subtokens.
 
     Raises:
       ValueError: if reserved is not 0 or len(RESERVED_TOKENS). In this case, it
@@ -774,12 +1233,27 @@ class SubwordTextEncoder(TextEncoder):
     """
     if reserved_tokens is None:
       reserved_tokens = RESERVED_TOKENS
-    else:
-      # There is not complete freedom in replacing RESERVED_TOKENS.
-      for default, proposed in zip(RESERVED_TOKENS, reserved_tokens):
-        if default != proposed:
-          raise ValueError("RESERVED_TOKENS must be a prefix of "
-                           "reserved_tokens.")
+    self._init_alphabet_from_token_counts(token_counts, reserved_tokens)
+
+    subtoken_counter = _SubtokenCounter(token_counts, self._alphabet,
+                                        max_subtoken_length, num_processes)
+    try:
+      self._build_from_subtoken_counter(subtoken_counter, min_count,
+                                        num_iterations, reserved_tokens)
+    finally:
+      subtoken_counter.close()
+
+  def _init_alphabet_from_token_counts(self, token_counts, reserved_tokens):
+    """Initialize the alphabet from the tokens and the reserved tokens.
+
+    Raises:
+      ValueError: if `RESERVED_TOKENS` is not a prefix of `reserved_tokens`.
+    """
+    # There is not complete freedom in replacing RESERVED_TOKENS.
+    for default, proposed in zip(RESERVED_TOKENS, reserved_tokens):
+      if default != proposed:
+        raise ValueError("RESERVED_TOKENS must be a prefix of "
+                         "reserved_tokens.")
 
     # Initialize the alphabet. Note, this must include reserved tokens or it can
     # result in encoding failures.
@@ -788,6 +1262,17 @@ class SubwordTextEncoder(TextEncoder):
 
     self._init_alphabet_from_tokens(alphabet_tokens)
 
+  def _build_from_subtoken_counter(self, subtoken_counter, min_count,
+                                   num_iterations, reserved_tokens):
+    """Runs the refinement iterations of build_from_token_counts.
+
+    Args:
+      subtoken_counter: a _SubtokenCounter of the token counts, escaped with
+        the current alphabet.
+      min_count: an integer - discard subtokens with lower counts.
+      num_iterations: an integer.  how many iterations of refinement.
+      reserved_tokens: List of reserved tokens.
+    """
     # Bootstrap the initial list of subtokens with the characters from the
     # alphabet plus the escaping characters.
     self._init_subtokens_from_list(list(self._alphabet),
@@ -802,54 +1287,14 @@ class SubwordTextEncoder(TextEncoder):
       tf.logging.info("Iteration {0}".format(i))
 
       # Collect all substrings of the encoded token that break along current
-      # subtoken boundaries.
-      subtoken_counts = collections.defaultdict(int)
-      for token, count in six.iteritems(token_counts):
-        iter_start_time = time.time()
-        escaped_token = _escape_token(token, self._alphabet)
-        subtokens = self._escaped_token_to_subtoken_strings(escaped_token)
-        start = 0
-        for subtoken in subtokens:
-          last_position = len(escaped_token) + 1
-          if max_subtoken_length is not None:
-            last_position = min(last_position, start + max_subtoken_length)
-
-          for end in range(start + 1, last_position):
-            new_subtoken = escaped_token[start:end]
-            subtoken_counts[new_subtoken] += count
-          start += len(subtoken)
-        iter_time_secs = time.time() - iter_start_time
-        if iter_time_secs > 0.1:
-          tf.logging.info(u"Processing token [{0}] took {1} seconds, consider "
-                          "setting Text2TextProblem.max_subtoken_length to a "
-                          "smaller value.".format(token, iter_time_secs))
-
-      # Array of sets of candidate subtoken strings, by length.
-      len_to_subtoken_strings = []
-      for subtoken_string, count in six.iteritems(subtoken_counts):
-        lsub = len(subtoken_string)
-        if count >= min_count:
-          while len(len_to_subtoken_strings) <= lsub:
-            len_to_subtoken_strings.append(set())
-          len_to_subtoken_strings[lsub].add(subtoken_string)
-
-      # Consider the candidates longest to shortest, so that if we accept
-      # a longer subtoken string, we can decrement the counts of its prefixes.
-      new_subtoken_strings = []
-      for lsub in range(len(len_to_subtoken_strings) - 1, 0, -1):
-        subtoken_strings = len_to_subtoken_strings[lsub]
-        for subtoken_string in subtoken_strings:
-          count = subtoken_counts[subtoken_string]
-          if count >= min_count:
-            # Exclude alphabet tokens here, as they must be included later,
-            # explicitly, regardless of count.
-            if subtoken_string not in self._alphabet:
-              new_subtoken_strings.append((count, subtoken_string))
-            for l in range(1, lsub):
-              subtoken_counts[subtoken_string[:l]] -= count
+      # subtoken boundaries and keep the ones with high enough counts. The
+      # first iteration segments into characters whatever min_count is, so its
+      # counts are shared between builds.
+      new_subtoken_strings, alphabet_counts = subtoken_counter.select(
+          None if i == 0 else self, min_count)
 
       # Include the alphabet explicitly to guarantee all strings are encodable.
-      new_subtoken_strings.extend((subtoken_counts.get(a, 0), a)
+      new_subtoken_strings.extend((alphabet_counts.get(a, 0), a)
                                   for a in self._alphabet)
       new_subtoken_strings.sort(reverse=True)
 
@@ -908,6 +1353,7 @@ class SubwordTextEncoder(TextEncoder):
     # Initialize the cache to empty.
     self._cache_size = 2 ** 20
     self._cache = [(None, None)] * self._cache_size
+    self._subtoken_cache_hash = None
 
   def _init_alphabet_from_tokens(self, tokens):
     """Initialize alphabet from an iterable of token or subtoken strings."""
@@ -915,6 +1361,7 @@ class SubwordTextEncoder(TextEncoder):
     # any token can be encoded. Additionally, include all escaping characters.
     self._alphabet = {c for token in tokens for c in token}
     self._alphabet |= _ESCAPE_CHARS
+    self._subtoken_cache_hash = None
 
   def _load_from_file_object(self, f):
     """Load from a file object.
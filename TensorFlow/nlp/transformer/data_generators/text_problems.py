@@ -12,6 +12,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - vocabulary building counts subtokens in vocab_num_processes processes
+# - packed datasets can be packed with --packing_method=best_fit_decreasing
+#   and log their packing efficiency
 
 """Base classes for text-based Problems.
 
@@ -28,6 +35,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import multiprocessing
 import os
 import re
 
@@ -40,6 +48,8 @@ from TensorFlow.nlp.transformer.utils import registry
 
 import tensorflow.compat.v1 as tf
 
+FLAGS = tf.flags.FLAGS
+
 
 class VocabType(object):
   """Available text vocabularies."""
@@ -250,7 +260,8 @@ class Text2TextProblem(problem.Problem):
             self.generate_text_for_vocab(data_dir, tmp_dir),
             max_subtoken_length=self.max_subtoken_length,
             reserved_tokens=(
-                text_encoder.RESERVED_TOKENS + self.additional_reserved_tokens))
+                text_encoder.RESERVED_TOKENS + self.additional_reserved_tokens),
+            num_processes=self.vocab_num_processes)
     elif self.vocab_type == VocabType.TOKEN:
       vocab_filename = os.path.join(data_dir, self.vocab_filename)
       encoder = text_encoder.TokenTextEncoder(vocab_filename,
@@ -281,7 +292,14 @@ class Text2TextProblem(problem.Problem):
         example_dict["targets"] = [
             int(i) for i in x.features.feature["targets"].int64_list.value]
         examples.append(example_dict)
+      num_examples = len(examples)
       examples = list(self._maybe_pack_examples(examples))
+      efficiency = generator_utils.packing_efficiency(examples,
+                                                      self.packed_length)
+      tf.logging.info(
+          "Packed %d examples into %d with %s, efficiency %s", num_examples,
+          len(examples), FLAGS.packing_method,
+          ", ".join("%s %.4f" % kv for kv in sorted(efficiency.items())))
       return [
           generator_utils.to_example(x).SerializeToString() for x in examples]
     return my_fn
@@ -290,6 +308,14 @@ class Text2TextProblem(problem.Problem):
     """Wraps generator with packer if self.packed_length."""
     if not self.packed_length:
       return generator
+    if FLAGS.packing_method == "best_fit_decreasing":
+      return generator_utils.pack_examples_best_fit(
+          generator,
+          self.has_inputs,
+          self.packed_length,
+          spacing=self.packed_spacing,
+          window_size=FLAGS.packing_window_size,
+          chop_long_sequences=not self.has_inputs)
     return generator_utils.pack_examples(
         generator,
         self.has_inputs,
@@ -317,6 +343,18 @@ class Text2TextProblem(problem.Problem):
     """
     return 200
 
+  @property
+  def vocab_num_processes(self):
+    """Number of processes counting subtokens when generating vocab.
+
+    The vocabulary does not depend on it. Small corpora are counted in fewer
+    processes.
+
+    Returns:
+      an integer
+    """
+    return multiprocessing.cpu_count()
+
   @property
   def batch_size_means_tokens(self):
     return True
@@ -22,6 +22,8 @@
 # - organized imports
 # - removed unsupported problem generators
 # - renamed from t2t_datagen.py to datagen.py
+# - added --subtoken_cache_dir
+# - added --packing_method and --packing_window_size
 
 """Produces the training and dev data for --problem into --data_dir.
 
@@ -48,6 +50,7 @@ import numpy as np
 
 from TensorFlow.nlp.transformer.utils import problems as problems_lib  # pylint: disable=unused-import
 from TensorFlow.nlp.transformer.data_generators import generator_utils
+from TensorFlow.nlp.transformer.data_generators import text_encoder
 from TensorFlow.nlp.transformer.utils import registry
 from TensorFlow.nlp.transformer.utils import usr_dir
 
@@ -92,6 +95,19 @@ flags.DEFINE_string(
     "e.g. @registry.register_problem calls, that will then be "
     "available to t2t-datagen.")
 flags.DEFINE_bool("with_padding", False, "If true dataset features will be padded")
+flags.DEFINE_enum(
+    "packing_method", "greedy", generator_utils.PACKING_METHODS,
+    "How packed problems pack the examples of a shard: greedy packs them in "
+    "arrival order into a small queue of examples, best_fit_decreasing packs "
+    "windows of --packing_window_size examples sorted by length.")
+flags.DEFINE_integer(
+    "packing_window_size", 2**17,
+    "Number of examples packed together by --packing_method="
+    "best_fit_decreasing.")
+flags.DEFINE_string(
+    "subtoken_cache_dir", "",
+    "Directory of the persistent token to subtoken ids caches of the subword "
+    "vocabularies, shared by all the generating processes. Disabled if empty.")
 
 # Mapping from problems that we can generate data for to their generators.
 _SUPPORTED_PROBLEM_GENERATORS = {}
@@ -106,6 +122,9 @@ def set_random_seed():
 
 def main(_):
   usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
+  if FLAGS.subtoken_cache_dir:
+    text_encoder.set_subtoken_cache_dir(
+        os.path.expanduser(FLAGS.subtoken_cache_dir))
 
   # Calculate the list of problems to generate.
   problems = sorted(
@@ -0,0 +1,138 @@
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the examples/sec of the Outbrain input pipelines of data/outbrain/dataloader.py.
+# Without --train_data_pattern/--eval_data_pattern, synthetic files with the layout written by
+# the preprocessing (PREBATCH_SIZE examples per record, every feature of shape [PREBATCH_SIZE, 1])
+# are generated in a temporary directory.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from data.outbrain.dataloader import (LABEL_COLUMN, batched_eval_input_fn, batched_train_input_fn, eval_input_fn,
+                                      train_input_fn)
+from data.outbrain.features import CATEGORICAL_COLUMNS, DISPLAY_ID_COLUMN, HASH_BUCKET_SIZES, NUMERIC_COLUMNS
+
+PIPELINES = {
+    'train': train_input_fn,
+    'batched_train': batched_train_input_fn,
+    'eval': eval_input_fn,
+    'batched_eval': batched_eval_input_fn,
+}
+
+# unused features of the real spec, which the default pipelines parse as well
+NUM_UNUSED_FEATURES = 40
+
+
+def synthetic_feature_spec(prebatch_size):
+    shape = [prebatch_size, 1]
+    spec = {LABEL_COLUMN: tf.io.FixedLenFeature(shape, tf.int64),
+            DISPLAY_ID_COLUMN: tf.io.FixedLenFeature(shape, tf.int64)}
+    spec.update({name: tf.io.FixedLenFeature(shape, tf.int64) for name in CATEGORICAL_COLUMNS})
+    spec.update({name: tf.io.FixedLenFeature(shape, tf.float32) for name in NUMERIC_COLUMNS})
+    spec.update({f'unused_{i}': tf.io.FixedLenFeature(shape, tf.float32) for i in range(NUM_UNUSED_FEATURES)})
+    return spec
+
+
+def write_synthetic_files(output_dir, feature_spec, prebatch_size, num_files, records_per_file, seed):
+    rng = np.random.default_rng(seed)
+    display_id = 0
+    for file_index in range(num_files):
+        with tf.io.TFRecordWriter(os.path.join(output_dir, f'part_{file_index:03d}.tfrecord')) as writer:
+            for _ in range(records_per_file):
+                sizes = rng.integers(2, 13, size=prebatch_size)
+                display_ids = np.repeat(np.arange(display_id, display_id + prebatch_size), sizes)[:prebatch_size]
+                display_id = display_ids[-1] + 1
+                feature = {}
+                for name, spec in feature_spec.items():
+                    if name == DISPLAY_ID_COLUMN:
+                        values = display_ids
+                    elif name == LABEL_COLUMN:
+                        values = rng.integers(0, 2, size=prebatch_size)
+                    elif spec.dtype == tf.int64:
+                        values = rng.integers(0, HASH_BUCKET_SIZES.get(name, 2), size=prebatch_size)
+                    else:
+                        values = rng.random(prebatch_size, dtype=np.float32)
+                    if spec.dtype == tf.int64:
+                        feature[name] = tf.train.Feature(int64_list=tf.train.Int64List(value=values.tolist()))
+                    else:
+                        feature[name] = tf.train.Feature(float_list=tf.train.FloatList(value=values.tolist()))
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writer.write(example.SerializeToString())
+
+
+def run_pipeline(name, filepath_pattern, feature_spec, records_batch_size, warmup_batches, num_batches):
+    kwargs = {'repeat': None} if 'eval' in name else {}
+    dataset = PIPELINES[name](filepath_pattern=filepath_pattern, feature_spec=feature_spec,
+                              records_batch_size=records_batch_size, **kwargs)
+    iterator = iter(dataset)
+    for _ in range(warmup_batches):
+        next(iterator)
+
+    examples = 0
+    start = time.time()
+    for _ in range(num_batches):
+        _, labels = next(iterator)
+        examples += int(labels.shape[0])
+    return examples / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the WideAndDeep input pipelines')
+    parser.add_argument('--train_data_pattern', type=str, default=None, nargs='+')
+    parser.add_argument('--eval_data_pattern', type=str, default=None, nargs='+')
+    parser.add_argument('--transformed_metadata_path', type=str, default=None,
+                        help='Path to transformed_metadata, required with real data')
+    parser.add_argument('--batch_size', type=int, default=131072)
+    parser.add_argument('--prebatch_size', type=int, default=4096,
+                        help='Examples per record, must match the preprocessing for real data')
+    parser.add_argument('--warmup_batches', type=int, default=5)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--pipelines', type=str, default=','.join(PIPELINES))
+    parser.add_argument('--synthetic_files', type=int, default=16)
+    parser.add_argument('--synthetic_records_per_file', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    work_dir = None
+    try:
+        if args.train_data_pattern is None or args.eval_data_pattern is None:
+            work_dir = tempfile.mkdtemp()
+            feature_spec = synthetic_feature_spec(args.prebatch_size)
+            write_synthetic_files(work_dir, feature_spec, args.prebatch_size, args.synthetic_files,
+                                  args.synthetic_records_per_file, args.seed)
+            train_data_pattern = eval_data_pattern = os.path.join(work_dir, 'part_*')
+        else:
+            import tensorflow_transform as tft
+            feature_spec = tft.TFTransformOutput(args.transformed_metadata_path).transformed_feature_spec()
+            train_data_pattern, eval_data_pattern = args.train_data_pattern, args.eval_data_pattern
+
+        records_batch_size = args.batch_size // args.prebatch_size
+        print('{:>14} {:>14}'.format('pipeline', 'examples/sec'))
+        for name in args.pipelines.split(','):
+            filepath_pattern = eval_data_pattern if 'eval' in name else train_data_pattern
+            examples_per_sec = run_pipeline(name, filepath_pattern, feature_spec, records_batch_size,
+                                            args.warmup_batches, args.num_batches)
+            print('{:>14} {:>14.0f}'.format(name, examples_per_sec))
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the deep embedding tables of --embedding_mode dense and hybrid: the memory of the
+# tables with their RMSprop state, and the time of a training step of ScalarDenseFeatures
+# followed by a dense layer. Ids are drawn from a Zipf distribution over the hash buckets of
+# every categorical column, and the row ranking is counted on a separate sample.
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+from data.outbrain.features import CATEGORICAL_COLUMNS, HASH_BUCKET_SIZES, get_feature_columns
+from trainer.model.layers import ScalarDenseFeatures, get_hybrid_embedding_rows
+
+
+def zipf_ids(rng, permutation, size, exponent):
+    # the permutation spreads the frequent ids over the table
+    return permutation[(rng.zipf(exponent, size) - 1) % len(permutation)].astype(np.int32)
+
+
+def build_model(deep_columns, hybrid_embeddings):
+    features = {column: tf.keras.Input(shape=(1,), name=column, dtype=tf.int32) for column in CATEGORICAL_COLUMNS}
+    embedded = ScalarDenseFeatures(deep_columns, name='deep_embedded', hybrid_embeddings=hybrid_embeddings)(features)
+    return tf.keras.Model(inputs=features, outputs=tf.keras.layers.Dense(1)(embedded))
+
+
+def run_mode(deep_columns, hybrid_embeddings, batches, warmup_steps):
+    model = build_model(deep_columns, hybrid_embeddings)
+    optimizer = tf.keras.optimizers.RMSprop(learning_rate=0.00012, rho=0.5)
+    compiled_loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+
+    @tf.function
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            loss = compiled_loss(y, model(x, training=True))
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        return loss
+
+    for x, y in batches[:warmup_steps]:
+        train_step(x, y)
+    start = time.time()
+    for x, y in batches:
+        loss = train_step(x, y)
+    loss.numpy()
+    step_time = (time.time() - start) / len(batches)
+
+    embedding_bytes = sum(v.shape.num_elements() * v.dtype.size for v in model.get_layer('deep_embedded').weights)
+    slot_bytes = sum(v.shape.num_elements() * v.dtype.size for v in optimizer.variables()
+                     if 'embedding_weights' in v.name)
+    return step_time, embedding_bytes + slot_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the WideAndDeep dense and hybrid embeddings')
+    parser.add_argument('--batch_size', type=int, default=16384)
+    parser.add_argument('--num_steps', type=int, default=50)
+    parser.add_argument('--warmup_steps', type=int, default=5)
+    parser.add_argument('--count_samples', type=int, default=2000000,
+                        help='Number of sampled ids per column used to rank the rows')
+    parser.add_argument('--zipf_exponent', type=float, default=1.2)
+    parser.add_argument('--hot_embedding_coverage', type=float, default=0.9)
+    parser.add_argument('--cold_embedding_fraction', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    _, deep_columns = get_feature_columns()
+    deep_columns = [column for column in deep_columns if hasattr(column, 'categorical_column')]
+    permutations = {column: rng.permutation(HASH_BUCKET_SIZES[column]) for column in CATEGORICAL_COLUMNS}
+
+    hybrid_embeddings = {}
+    for column in CATEGORICAL_COLUMNS:
+        counts = np.bincount(zipf_ids(rng, permutations[column], args.count_samples, args.zipf_exponent),
+                             minlength=HASH_BUCKET_SIZES[column])
+        rows = get_hybrid_embedding_rows(counts, args.hot_embedding_coverage, args.cold_embedding_fraction)
+        if rows is not None:
+            hybrid_embeddings[column] = rows
+
+    batches = [
+        ({column: tf.constant(zipf_ids(rng, permutations[column], args.batch_size, args.zipf_exponent).reshape(-1, 1))
+          for column in CATEGORICAL_COLUMNS},
+         tf.constant(rng.integers(0, 2, size=(args.batch_size, 1)).astype(np.float32)))
+        for _ in range(args.num_steps)
+    ]
+
+    results = {}
+    for mode, config in (('dense', None), ('hybrid', hybrid_embeddings)):
+        results[mode] = run_mode(deep_columns, config, batches, args.warmup_steps)
+
+    print('{:>8} {:>14} {:>22}'.format('mode', 'step time (ms)', 'embeddings+slots (MB)'))
+    for mode, (step_time, memory_bytes) in results.items():
+        print('{:>8} {:>14.2f} {:>22.1f}'.format(mode, step_time * 1000, memory_bytes / 2 ** 20))
+    dense_time, dense_bytes = results['dense']
+    hybrid_time, hybrid_bytes = results['hybrid']
+    print(f'memory saved: {(dense_bytes - hybrid_bytes) / 2 ** 20:.1f} MB, '
+          f'step time change: {(hybrid_time / dense_time - 1) * 100:+.1f}%')
+
+
+if __name__ == '__main__':
+    main()
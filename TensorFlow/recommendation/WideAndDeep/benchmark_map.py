@@ -0,0 +1,87 @@
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Times the MAP@12 calculation methods of trainer/utils/metrics.py on synthetic eval batches
+# laid out like the Outbrain eval files: 2 to 12 ads per display_id, contiguous, one click per
+# display, with displays split across batch boundaries. Predictions are quantized so that
+# ties inside a display are common. Only the metric is timed, not the model.
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from trainer.utils.metrics import MAP_CALCULATION_METHODS, get_map_at_k_fn
+
+
+def synthetic_batches(batch_size, num_batches, seed):
+    rng = np.random.default_rng(seed)
+    num_ads = batch_size * num_batches
+    sizes = rng.integers(2, 13, size=num_ads // 2)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), num_ads) + 1]
+    display_ids = np.repeat(np.cumsum(rng.integers(1, 5, size=len(sizes))), sizes)[:num_ads]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    labels = np.zeros(len(display_ids), dtype=np.int64)
+    clicked = starts + (rng.random(len(sizes)) * sizes).astype(np.int64)
+    labels[clicked[clicked < num_ads]] = 1
+    predictions = np.round(rng.random(num_ads), 3).astype(np.float32).astype(np.float64)
+
+    return [(tf.constant(display_ids[i:i + batch_size]), tf.constant(predictions[i:i + batch_size]),
+             tf.constant(labels[i:i + batch_size])) for i in range(0, num_ads, batch_size)]
+
+
+def run_method(method, batches, warmup_batches):
+    map_at_k = tf.function(get_map_at_k_fn(method))
+    for batch in batches[:warmup_batches]:
+        map_at_k(*batch)
+
+    ap_sum, num_displays = 0., 0.
+    start = time.time()
+    for batch in batches:
+        batch_ap_sum, batch_num_displays = map_at_k(*batch)
+        ap_sum += batch_ap_sum.numpy()
+        num_displays += batch_num_displays.numpy()
+    elapsed = time.time() - start
+    return elapsed, ap_sum / num_displays, num_displays
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the WideAndDeep MAP@12 calculation methods')
+    parser.add_argument('--batch_size', type=int, default=131072)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--warmup_batches', type=int, default=2)
+    parser.add_argument('--methods', type=str, default=','.join(MAP_CALCULATION_METHODS))
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    batches = synthetic_batches(args.batch_size, args.num_batches, args.seed)
+    num_ads = sum(int(batch[0].shape[0]) for batch in batches)
+
+    results = {}
+    for method in args.methods.split(','):
+        results[method] = run_method(method, batches, args.warmup_batches)
+
+    print('{:>10} {:>10} {:>14} {:>12} {:>10}'.format('method', 'time (s)', 'examples/sec', 'MAP@12', 'displays'))
+    for method, (elapsed, map_metric, num_displays) in results.items():
+        print('{:>10} {:>10.3f} {:>14.0f} {:>12.8f} {:>10.0f}'.format(method, elapsed, num_ads / elapsed, map_metric,
+                                                                      num_displays))
+
+    reference = next(iter(results.values()))
+    for method, (_, map_metric, num_displays) in results.items():
+        if num_displays != reference[2] or abs(map_metric - reference[1]) > 1e-9:
+            raise ValueError(f'MAP@12 of {method} differs: {map_metric} on {num_displays} displays')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Counts how often every id of the categorical columns occurs in the training set. The counts
+# rank the embedding rows by frequency for --embedding_mode hybrid, for example:
+#   python -m data.outbrain.category_counts --train_data_pattern "/outbrain/tfrecords/train/part*" \
+#       --transformed_metadata_path /outbrain/tfrecords --output /outbrain/tfrecords/category_counts.npz
+
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from data.outbrain.features import CATEGORICAL_COLUMNS, HASH_BUCKET_SIZES
+
+
+def count_categories(filepath_pattern, feature_spec, records_batch_size=32):
+    feature_spec = {column: feature_spec[column] for column in CATEGORICAL_COLUMNS}
+    dataset = tf.data.Dataset.list_files(filepath_pattern, shuffle=False)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(records_batch_size)
+    dataset = dataset.map(lambda serialized: tf.io.parse_example(serialized, feature_spec),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    counts = {column: np.zeros(HASH_BUCKET_SIZES[column], dtype=np.int64) for column in CATEGORICAL_COLUMNS}
+    for batch in dataset:
+        for column in CATEGORICAL_COLUMNS:
+            counts[column] += np.bincount(batch[column].numpy().reshape(-1), minlength=HASH_BUCKET_SIZES[column])
+    return counts
+
+
+def load_category_counts(path):
+    with np.load(path) as counts:
+        return {column: counts[column] for column in counts.files}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Counts the ids of the Outbrain categorical columns')
+    parser.add_argument('--train_data_pattern', type=str, default='/outbrain/tfrecords/train/part*', nargs='+')
+    parser.add_argument('--transformed_metadata_path', type=str, default='/outbrain/tfrecords')
+    parser.add_argument('--output', type=str, required=True, help='Output .npz file')
+    args = parser.parse_args()
+
+    import tensorflow_transform as tft
+    feature_spec = tft.TFTransformOutput(args.transformed_metadata_path).transformed_feature_spec()
+    counts = count_categories(args.train_data_pattern, feature_spec)
+    np.savez(args.output, **counts)
+    for column in CATEGORICAL_COLUMNS:
+        print(f'{column}: {np.count_nonzero(counts[column])} of {len(counts[column])} ids seen')
+
+
+if __name__ == '__main__':
+    main()
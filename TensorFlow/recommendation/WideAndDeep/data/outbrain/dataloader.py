@@ -16,6 +16,7 @@
 ###############################################################################
 # Changes:
 # - 'num_gpus' renamed to 'num_devices' for consistency
+# - added batched_train_input_fn and batched_eval_input_fn, which parse whole batches of records
 
 from functools import partial
 from multiprocessing import cpu_count
@@ -24,6 +25,8 @@ import tensorflow as tf
 
 from data.outbrain.features import get_features_keys
 
+LABEL_COLUMN = 'label'
+
 
 def _consolidate_batch(elem):
     label = elem.pop('label')
@@ -142,3 +145,114 @@ def eval_input_fn(
     )
 
     return dataset
+
+
+def get_used_feature_spec(feature_spec):
+    used_keys = set(get_features_keys() + [LABEL_COLUMN])
+    return {key: spec for key, spec in feature_spec.items() if key in used_keys}
+
+
+def get_batch_parse_function(feature_spec):
+    feature_spec = get_used_feature_spec(feature_spec)
+
+    def _parse_batch_function(serialized):
+        return _consolidate_batch(tf.io.parse_example(serialized, feature_spec))
+
+    return _parse_batch_function
+
+
+def batched_train_input_fn(
+        filepath_pattern,
+        feature_spec,
+        records_batch_size,
+        num_devices=1,
+        id=0):
+    """Like train_input_fn, but shards and shuffles the serialized records and parses
+    every batch with one parse_example call, restricted to the features used by the model.
+    """
+    dataset = tf.data.Dataset.list_files(
+        file_pattern=filepath_pattern
+    )
+
+    dataset = dataset.interleave(
+        lambda x: tf.data.TFRecordDataset(x),
+        cycle_length=max(cpu_count() // num_devices, 1),
+        block_length=1,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+
+    dataset = dataset.shard(num_devices, id)
+
+    dataset = dataset.shuffle(records_batch_size * 8)
+
+    dataset = dataset.repeat(
+        count=None
+    )
+
+    dataset = dataset.batch(
+        batch_size=records_batch_size,
+        drop_remainder=False
+    )
+
+    dataset = dataset.map(
+        map_func=get_batch_parse_function(feature_spec),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+
+    dataset = dataset.prefetch(
+        buffer_size=tf.data.experimental.AUTOTUNE
+    )
+
+    return dataset
+
+
+def batched_eval_input_fn(
+        filepath_pattern,
+        feature_spec,
+        records_batch_size,
+        num_devices=1,
+        repeat=1,
+        id=0):
+    """Like eval_input_fn, but reads the eval files in parallel and parses every batch with
+    one parse_example call, restricted to the features used by the model.
+
+    The interleave reads blocks of records_batch_size consecutive records of a file in a
+    deterministic order. The blocks are batched after the interleave, so that only the last
+    batch can be smaller than records_batch_size and the batch shape does not change at the end
+    of every file. Once a file ends with a partial block, later batches span two blocks, usually
+    of different files; the ads of a display_id are only split where they cross a block boundary.
+    """
+    dataset = tf.data.Dataset.list_files(
+        file_pattern=filepath_pattern,
+        shuffle=False
+    )
+
+    dataset = dataset.interleave(
+        lambda x: tf.data.TFRecordDataset(x),
+        cycle_length=max(cpu_count() // num_devices, 1),
+        block_length=records_batch_size,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=True
+    )
+
+    dataset = dataset.batch(
+        batch_size=records_batch_size,
+        drop_remainder=False
+    )
+
+    dataset = dataset.shard(num_devices, id)
+
+    dataset = dataset.repeat(
+        count=repeat
+    )
+
+    dataset = dataset.map(
+        map_func=get_batch_parse_function(feature_spec),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    )
+
+    dataset = dataset.prefetch(
+        buffer_size=tf.data.experimental.AUTOTUNE
+    )
+
+    return dataset
@@ -11,6 +11,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added hybrid embedding tables with frequency ranked hot rows and a hashed cold table
 
 import numpy as np
 import tensorflow as tf
@@ -95,8 +100,36 @@ def _validate_stack_dimensions(feature_columns):
         )
 
 
+def get_hybrid_embedding_rows(counts, hot_coverage, cold_fraction):
+    """Splits the rows of an embedding table by the frequency of their ids in the training set.
+
+    The most frequent ids that together cover hot_coverage of the lookups get dense hot rows,
+    the remaining ids share a cold table of cold_fraction of their number of rows, indexed by
+    id modulo its size. Returns the hot ids, most frequent first, and the number of cold rows,
+    or None if the two tables would not be smaller than the dense one.
+    """
+    num_buckets = len(counts)
+    order = np.argsort(-counts, kind="stable")
+    cumulative_counts = np.cumsum(counts[order])
+    if cumulative_counts[-1] == 0:
+        return None
+    num_hot = int(np.searchsorted(cumulative_counts, hot_coverage * cumulative_counts[-1])) + 1
+    num_cold = max(1, int(np.ceil((num_buckets - num_hot) * cold_fraction)))
+    if num_hot + num_cold >= num_buckets:
+        return None
+    return order[:num_hot], num_cold
+
+
 class ScalarDenseFeatures(tf.keras.layers.Layer):
-    def __init__(self, feature_columns, aggregation="concat", name=None, **kwargs):
+    """Concatenates or stacks numeric columns and embedding lookups of identity columns.
+
+    hybrid_embeddings maps the key of an embedding column to the (hot_ids, num_cold_rows) of
+    get_hybrid_embedding_rows. Such a column gets a dense table of the hot rows and a smaller
+    cold table for the long tail instead of one row per bucket. Lookups are partitioned between
+    the two tables, so both receive sparse gradients of only the rows they hold.
+    """
+
+    def __init__(self, feature_columns, aggregation="concat", name=None, hybrid_embeddings=None, **kwargs):
         feature_columns = _sort_columns(feature_columns)
         _validate_dense_feature_columns(feature_columns)
 
@@ -106,19 +139,45 @@ class ScalarDenseFeatures(tf.keras.layers.Layer):
 
         self.feature_columns = feature_columns
         self.aggregation = aggregation
+        self.hybrid_embeddings = hybrid_embeddings or {}
         super(ScalarDenseFeatures, self).__init__(name=name, **kwargs)
 
     def build(self, input_shapes):
         assert all(shape[1] == 1 for shape in input_shapes.values())
 
         self.embedding_tables = {}
+        self.cold_embedding_tables = {}
+        self.hot_row_indices = {}
         for feature_column in self.feature_columns:
             if isinstance(feature_column, fc.NumericColumn):
                 continue
 
             feature_name = feature_column.categorical_column.key
             num_buckets = feature_column.categorical_column.num_buckets
-            if isinstance(feature_column, fc.EmbeddingColumn):
+            if isinstance(feature_column, fc.EmbeddingColumn) and feature_name in self.hybrid_embeddings:
+                hot_ids, num_cold_rows = self.hybrid_embeddings[feature_name]
+                hot_row_index = np.full(num_buckets, -1, dtype=np.int32)
+                hot_row_index[hot_ids] = np.arange(len(hot_ids), dtype=np.int32)
+                self.hot_row_indices[feature_name] = self.add_weight(
+                    name="{}/hot_row_index".format(feature_name),
+                    trainable=False,
+                    dtype=tf.int32,
+                    initializer=tf.constant_initializer(hot_row_index),
+                    shape=(num_buckets,),
+                )
+                self.embedding_tables[feature_name] = self.add_weight(
+                    name="{}/hot_embedding_weights".format(feature_name),
+                    trainable=True,
+                    initializer="glorot_normal",
+                    shape=(len(hot_ids), feature_column.dimension),
+                )
+                self.cold_embedding_tables[feature_name] = self.add_weight(
+                    name="{}/cold_embedding_weights".format(feature_name),
+                    trainable=True,
+                    initializer="glorot_normal",
+                    shape=(num_cold_rows, feature_column.dimension),
+                )
+            elif isinstance(feature_column, fc.EmbeddingColumn):
                 self.embedding_tables[feature_name] = self.add_weight(
                     name="{}/embedding_weights".format(feature_name),
                     trainable=True,
@@ -142,13 +201,31 @@ class ScalarDenseFeatures(tf.keras.layers.Layer):
             else:
                 feature_name = feature_column.categorical_column.name
                 table = self.embedding_tables[feature_name]
-                embeddings = tf.gather(table, inputs[feature_name][:, 0])
+                if feature_name in self.cold_embedding_tables:
+                    embeddings = self._hybrid_lookup(feature_name, inputs[feature_name][:, 0])
+                else:
+                    embeddings = tf.gather(table, inputs[feature_name][:, 0])
                 features.append(embeddings)
 
         if self.aggregation == "stack":
             return tf.stack(features, axis=1)
         return tf.concat(features, axis=1)
 
+    def _hybrid_lookup(self, feature_name, ids):
+        hot_table = self.embedding_tables[feature_name]
+        cold_table = self.cold_embedding_tables[feature_name]
+        hot_rows = tf.gather(self.hot_row_indices[feature_name], ids)
+        is_hot = tf.cast(hot_rows >= 0, tf.int32)
+        cold_rows = tf.math.floormod(ids, tf.cast(tf.shape(cold_table)[0], ids.dtype))
+        rows = tf.where(is_hot > 0, tf.cast(hot_rows, ids.dtype), cold_rows)
+
+        cold_rows, hot_rows = tf.dynamic_partition(rows, is_hot, 2)
+        cold_positions, hot_positions = tf.dynamic_partition(tf.range(tf.shape(ids)[0]), is_hot, 2)
+        return tf.dynamic_stitch(
+            [cold_positions, hot_positions],
+            [tf.gather(cold_table, cold_rows), tf.gather(hot_table, hot_rows)],
+        )
+
     def compute_output_shape(self, input_shapes):
         input_shape = [i for i in input_shapes.values()][0]
         if self.aggregation == "concat":
@@ -164,4 +241,5 @@ class ScalarDenseFeatures(tf.keras.layers.Layer):
         return {
             "feature_columns": self.feature_columns,
             "aggregation": self.aggregation,
+            "hybrid_embeddings": self.hybrid_embeddings,
         }
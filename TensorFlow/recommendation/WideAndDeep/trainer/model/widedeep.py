@@ -11,11 +11,46 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+# Changes:
+# - added hybrid embedding mode of the deep part
+
+import logging
 
 import tensorflow as tf
 
+from data.outbrain.category_counts import load_category_counts
 from data.outbrain.features import get_feature_columns, NUMERIC_COLUMNS, EMBEDDING_TABLE_SHAPES
-from trainer.model.layers import ScalarDenseFeatures
+from trainer.model.layers import ScalarDenseFeatures, get_hybrid_embedding_rows
+
+# bytes of a float32 embedding row element, doubled for the RMSprop slot of the deep optimizer
+EMBEDDING_BYTES_PER_ELEMENT = 4 * 2
+
+
+def get_hybrid_embeddings(args):
+    logger = logging.getLogger('tensorflow')
+    counts = load_category_counts(args.category_counts_path)
+
+    hybrid_embeddings = {}
+    dense_bytes, hybrid_bytes = 0, 0
+    for column, (num_buckets, dimension) in EMBEDDING_TABLE_SHAPES.items():
+        dense_bytes += num_buckets * dimension * EMBEDDING_BYTES_PER_ELEMENT
+        rows = get_hybrid_embedding_rows(counts[column], args.hot_embedding_coverage, args.cold_embedding_fraction)
+        if rows is None:
+            hybrid_bytes += num_buckets * dimension * EMBEDDING_BYTES_PER_ELEMENT
+            continue
+        hot_ids, num_cold_rows = rows
+        hybrid_embeddings[column] = rows
+        # the hot row index holds one int32 per bucket
+        hybrid_bytes += (len(hot_ids) + num_cold_rows) * dimension * EMBEDDING_BYTES_PER_ELEMENT + num_buckets * 4
+        logger.warning(f'hybrid embedding {column}: {len(hot_ids)} hot rows, {num_cold_rows} cold rows '
+                       f'instead of {num_buckets}')
+
+    logger.warning(f'deep embeddings with optimizer state: {dense_bytes / 2 ** 20:.1f} MB dense, '
+                   f'{hybrid_bytes / 2 ** 20:.1f} MB hybrid, {(dense_bytes - hybrid_bytes) / 2 ** 20:.1f} MB saved')
+    return hybrid_embeddings
 
 
 def wide_deep_model(args):
@@ -59,7 +94,8 @@ def wide_deep_model(args):
         numeric_dense_inputs, name='numeric_dense')
     deep_columns = list(deep_columns_dict.values())
 
-    dnn = ScalarDenseFeatures(deep_columns, name='deep_embedded')(features)
+    hybrid_embeddings = get_hybrid_embeddings(args) if args.embedding_mode == 'hybrid' else None
+    dnn = ScalarDenseFeatures(deep_columns, name='deep_embedded', hybrid_embeddings=hybrid_embeddings)(features)
     for unit_size in args.deep_hidden_units:
         dnn = tf.keras.layers.Dense(units=unit_size, activation='relu')(dnn)
         dnn = tf.keras.layers.Dropout(rate=args.deep_dropout)(dnn)
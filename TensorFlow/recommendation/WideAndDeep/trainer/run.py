@@ -21,6 +21,7 @@
 # - added cast to output of the model for numerical stability according to www.tensorflow.org/guide/mixed_precision
 # - added tensorboard logging for hyper parameters and benchmark data
 # - added support for changeable frequency of logging during training
+# - moved the MAP@12 calculation to trainer/utils/metrics.py and added the sort-free map_calculation methods
 
 import logging
 import os
@@ -31,6 +32,7 @@ import numpy as np
 import tensorflow as tf
 from data.outbrain.features import DISPLAY_ID_COLUMN
 from tensorflow.python.keras import backend as K
+from trainer.utils.metrics import get_map_at_k_fn
 from trainer.utils.schedulers import get_schedule
 
 from TensorFlow.common.horovod_helpers import hvd
@@ -135,6 +137,8 @@ def train(args, model, config):
             hvd.broadcast_variables(deep_optimizer.variables(), root_rank=0)
         return loss
 
+    map_at_k = get_map_at_k_fn(args.map_calculation)
+
     @tf.function
     def evaluation_step(x, y):
         predictions = model(x, training=False)
@@ -149,32 +153,8 @@ def train(args, model, config):
         display_ids = x[DISPLAY_ID_COLUMN]
         display_ids = tf.reshape(display_ids, [-1])
         labels = tf.reshape(y, [-1])
-        sorted_ids = tf.argsort(display_ids)
-        display_ids = tf.gather(display_ids, indices=sorted_ids)
-        predictions = tf.gather(predictions, indices=sorted_ids)
-        labels = tf.gather(labels, indices=sorted_ids)
-        _, display_ids_idx, display_ids_ads_count = tf.unique_with_counts(display_ids, out_idx=tf.int64)
-        pad_length = 30 - tf.reduce_max(display_ids_ads_count)
-        preds = tf.RaggedTensor.from_value_rowids(predictions, display_ids_idx).to_tensor()
-        labels = tf.RaggedTensor.from_value_rowids(labels, display_ids_idx).to_tensor()
-
-        labels_mask = tf.math.reduce_max(labels, 1)
-        preds_masked = tf.boolean_mask(preds, labels_mask)
-        labels_masked = tf.boolean_mask(labels, labels_mask)
-        labels_masked = tf.argmax(labels_masked, axis=1, output_type=tf.int32)
-        labels_masked = tf.reshape(labels_masked, [-1, 1])
-
-        preds_masked = tf.pad(preds_masked, [(0, 0), (0, pad_length)])
-        _, predictions_idx = tf.math.top_k(preds_masked, 12)
-        indices = tf.math.equal(predictions_idx, labels_masked)
-        indices_mask = tf.math.reduce_any(indices, 1)
-        masked_indices = tf.boolean_mask(indices, indices_mask)
-
-        res = tf.argmax(masked_indices, axis=1)
-        ap_matrix = tf.divide(1, tf.add(res, 1))
-        ap_sum = tf.reduce_sum(ap_matrix)
-        shape = tf.cast(tf.shape(indices)[0], tf.float64)
-        display_id_counter.assign_add(shape)
+        ap_sum, num_displays = map_at_k(display_ids, predictions, labels)
+        display_id_counter.assign_add(num_displays)
         streaming_map.assign_add(ap_sum)
         return loss
 
@@ -332,6 +312,8 @@ def evaluate(args, model, config):
         else:
             logger.warning(f'Failed to restore model from checkpoint {args.model_dir}')
 
+    map_at_k = get_map_at_k_fn(args.map_calculation)
+
     @tf.function
     def evaluation_step(x, y):
         predictions = model(x, training=False)
@@ -346,32 +328,8 @@ def evaluate(args, model, config):
         display_ids = x[DISPLAY_ID_COLUMN]
         display_ids = tf.reshape(display_ids, [-1])
         labels = tf.reshape(y, [-1])
-        sorted_ids = tf.argsort(display_ids)
-        display_ids = tf.gather(display_ids, indices=sorted_ids)
-        predictions = tf.gather(predictions, indices=sorted_ids)
-        labels = tf.gather(labels, indices=sorted_ids)
-        _, display_ids_idx, display_ids_ads_count = tf.unique_with_counts(display_ids, out_idx=tf.int64)
-        pad_length = 30 - tf.reduce_max(display_ids_ads_count)
-        preds = tf.RaggedTensor.from_value_rowids(predictions, display_ids_idx).to_tensor()
-        labels = tf.RaggedTensor.from_value_rowids(labels, display_ids_idx).to_tensor()
-
-        labels_mask = tf.math.reduce_max(labels, 1)
-        preds_masked = tf.boolean_mask(preds, labels_mask)
-        labels_masked = tf.boolean_mask(labels, labels_mask)
-        labels_masked = tf.argmax(labels_masked, axis=1, output_type=tf.int32)
-        labels_masked = tf.reshape(labels_masked, [-1, 1])
-
-        preds_masked = tf.pad(preds_masked, [(0, 0), (0, pad_length)])
-        _, predictions_idx = tf.math.top_k(preds_masked, 12)
-        indices = tf.math.equal(predictions_idx, labels_masked)
-        indices_mask = tf.math.reduce_any(indices, 1)
-        masked_indices = tf.boolean_mask(indices, indices_mask)
-
-        res = tf.argmax(masked_indices, axis=1)
-        ap_matrix = tf.divide(1, tf.add(res, 1))
-        ap_sum = tf.reduce_sum(ap_matrix)
-        shape = tf.cast(tf.shape(indices)[0], tf.float64)
-        display_id_counter.assign_add(shape)
+        ap_sum, num_displays = map_at_k(display_ids, predictions, labels)
+        display_id_counter.assign_add(num_displays)
         streaming_map.assign_add(ap_sum)
         return loss
 
@@ -18,9 +18,13 @@
 # - replaced 'cpu' argument with 'device' to add support for more devices: cpu/gpu/hpu
 # - replaced 'amp' argument with 'dtype' to add support for bfloat16 mixed precision conversion
 # - added use_horovod, log_every arguments
+# - added map_calculation, batch_parsing arguments
+# - added embedding_mode, category_counts_path, hot_embedding_coverage, cold_embedding_fraction arguments
 
 import argparse
 
+from trainer.utils.metrics import MAP_CALCULATION_METHODS
+
 # Default train dataset size
 TRAIN_DATASET_SIZE = 59761827
 
@@ -101,6 +105,22 @@ def parse_args():
     model_construction.add_argument('--deep_dropout', type=float, default=0.1,
                                     help='Dropout regularization for deep model')
 
+    model_construction.add_argument('--embedding_mode', type=str, default='dense', choices=['dense', 'hybrid'],
+                                    help='Embedding tables of the deep model: "dense" has one row per hash bucket, '
+                                         '"hybrid" keeps the frequent ids in dense hot rows and hashes the rest into '
+                                         'a smaller cold table')
+
+    model_construction.add_argument('--category_counts_path', type=str, default='/outbrain/tfrecords/category_counts.npz',
+                                    help='Id counts of the categorical columns written by data/outbrain/category_counts.py, '
+                                         'used to rank the rows in hybrid embedding mode')
+
+    model_construction.add_argument('--hot_embedding_coverage', type=float, default=0.9,
+                                    help='Fraction of the training lookups covered by the hot rows in hybrid embedding mode')
+
+    model_construction.add_argument('--cold_embedding_fraction', type=float, default=0.1,
+                                    help='Size of the cold table relative to the number of ids not in the hot rows '
+                                         'in hybrid embedding mode')
+
     run_params = parser.add_argument_group('run mode parameters')
 
     run_params.add_argument('--evaluate', default=False, action='store_true',
@@ -122,7 +142,16 @@ def parse_args():
                                      'disabled'],
                             help='Type of CPU affinity')
 
+    run_params.add_argument('--batch_parsing', default=False, action='store_true',
+                            help='Batch the serialized records before parsing them with one parse_example call '
+                                 'and read the eval files in parallel')
+
     run_params.add_argument('--log_every', type=int, default=100,
                             help="""Log data every n steps""")
 
+    run_params.add_argument('--map_calculation', type=str, default='sort', choices=MAP_CALCULATION_METHODS,
+                            help='Method of the MAP@12 calculation during evaluation: "sort" sorts every batch by '
+                                 'display_id, "unique" and "grouped" use segment reductions, "grouped" requires '
+                                 'the ads of a display_id to be contiguous in the eval files')
+
     return parser.parse_args()
@@ -0,0 +1,104 @@
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import tensorflow as tf
+
+MAP_CALCULATION_METHODS = ['sort', 'unique', 'grouped']
+
+
+def map_at_k_sort(display_ids, predictions, labels, k=12):
+    """Per batch MAP@k terms computed by sorting the batch by display_id.
+
+    Returns the sum of the average precisions and the number of displays with a click.
+    """
+    sorted_ids = tf.argsort(display_ids)
+    display_ids = tf.gather(display_ids, indices=sorted_ids)
+    predictions = tf.gather(predictions, indices=sorted_ids)
+    labels = tf.gather(labels, indices=sorted_ids)
+    _, display_ids_idx, display_ids_ads_count = tf.unique_with_counts(display_ids, out_idx=tf.int64)
+    pad_length = 30 - tf.reduce_max(display_ids_ads_count)
+    preds = tf.RaggedTensor.from_value_rowids(predictions, display_ids_idx).to_tensor()
+    labels = tf.RaggedTensor.from_value_rowids(labels, display_ids_idx).to_tensor()
+
+    labels_mask = tf.math.reduce_max(labels, 1)
+    preds_masked = tf.boolean_mask(preds, labels_mask)
+    labels_masked = tf.boolean_mask(labels, labels_mask)
+    labels_masked = tf.argmax(labels_masked, axis=1, output_type=tf.int32)
+    labels_masked = tf.reshape(labels_masked, [-1, 1])
+
+    preds_masked = tf.pad(preds_masked, [(0, 0), (0, pad_length)])
+    _, predictions_idx = tf.math.top_k(preds_masked, k)
+    indices = tf.math.equal(predictions_idx, labels_masked)
+    indices_mask = tf.math.reduce_any(indices, 1)
+    masked_indices = tf.boolean_mask(indices, indices_mask)
+
+    res = tf.argmax(masked_indices, axis=1)
+    ap_matrix = tf.divide(1, tf.add(res, 1))
+    ap_sum = tf.reduce_sum(ap_matrix)
+    num_displays = tf.cast(tf.shape(indices)[0], tf.float64)
+    return ap_sum, num_displays
+
+
+def map_at_k_segments(display_ids, predictions, labels, k=12, grouped=False):
+    """Per batch MAP@k terms computed with segment reductions, without sorting the batch.
+
+    The clicked ad of a display is ranked by counting the ads of the same display that
+    top_k would place before it: a higher prediction, or an equal one earlier in the batch.
+    This gives the same ranks as map_at_k_sort, whose argsort keeps the batch order of the
+    ads of a display. With grouped=True the ads of a display must be contiguous in the
+    batch, which holds for the eval files, and the segments are found from the display_id
+    changes instead of with tf.unique.
+
+    Returns the sum of the average precisions and the number of displays with a click.
+    """
+    if grouped:
+        starts = tf.not_equal(display_ids[1:], display_ids[:-1])
+        segment_ids = tf.cumsum(tf.concat([[0], tf.cast(starts, tf.int32)], axis=0))
+        num_segments = segment_ids[-1] + 1
+    else:
+        unique_ids, segment_ids = tf.unique(display_ids, out_idx=tf.int32)
+        num_segments = tf.size(unique_ids)
+
+    num_ads = tf.size(predictions)
+    positions = tf.range(num_ads)
+    is_clicked = tf.math.not_equal(labels, tf.zeros_like(labels))
+    # the first clicked ad of a display, as the argmax over its labels picks it
+    clicked_position = tf.math.unsorted_segment_min(tf.where(is_clicked, positions, num_ads),
+                                                    segment_ids, num_segments)
+    has_click = tf.less(clicked_position, num_ads)
+    clicked_position = tf.minimum(clicked_position, num_ads - 1)
+    clicked_prediction = tf.gather(predictions, clicked_position)
+
+    ad_clicked_position = tf.gather(clicked_position, segment_ids)
+    ad_clicked_prediction = tf.gather(clicked_prediction, segment_ids)
+    ranked_before = tf.logical_or(
+        tf.greater(predictions, ad_clicked_prediction),
+        tf.logical_and(tf.equal(predictions, ad_clicked_prediction), tf.less(positions, ad_clicked_position)))
+    rank = tf.math.unsorted_segment_sum(tf.cast(ranked_before, tf.int32), segment_ids, num_segments)
+
+    hit = tf.logical_and(has_click, tf.less(rank, k))
+    ap = tf.where(hit, tf.divide(1, tf.cast(rank + 1, tf.float64)), tf.zeros_like(rank, dtype=tf.float64))
+    ap_sum = tf.reduce_sum(ap)
+    num_displays = tf.reduce_sum(tf.cast(has_click, tf.float64))
+    return ap_sum, num_displays
+
+
+def get_map_at_k_fn(method):
+    if method == 'sort':
+        return map_at_k_sort
+    if method == 'unique':
+        return map_at_k_segments
+    if method == 'grouped':
+        return lambda display_ids, predictions, labels, k=12: map_at_k_segments(
+            display_ids, predictions, labels, k=k, grouped=True)
+    raise ValueError(f'Unknown MAP calculation method: {method}')
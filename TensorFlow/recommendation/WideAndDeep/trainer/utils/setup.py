@@ -19,6 +19,7 @@
 # - horovod.tensorflow replaced with custom horovod_helpers
 # - enable environment variable TF_ENABLE_WIDE_AND_DEEP_WA, which applies
 #   performance workaround in SynapseAI. It will be removed in a subsequent release.
+# - added batch_parsing variant of the input pipelines
 
 import json
 import logging
@@ -27,7 +28,7 @@ import os
 import dllogger
 import tensorflow as tf
 import tensorflow_transform as tft
-from data.outbrain.dataloader import train_input_fn, eval_input_fn
+from data.outbrain.dataloader import train_input_fn, eval_input_fn, batched_train_input_fn, batched_eval_input_fn
 from data.outbrain.features import PREBATCH_SIZE
 
 from TensorFlow.common.horovod_helpers import hvd, hvd_init
@@ -138,7 +139,12 @@ def create_config(args):
         args.transformed_metadata_path
     ).transformed_feature_spec()
 
-    train_spec_input_fn = train_input_fn(
+    if args.batch_parsing:
+        train_input_fn_, eval_input_fn_ = batched_train_input_fn, batched_eval_input_fn
+    else:
+        train_input_fn_, eval_input_fn_ = train_input_fn, eval_input_fn
+
+    train_spec_input_fn = train_input_fn_(
         num_devices=num_devices,
         id=device_id,
         filepath_pattern=args.train_data_pattern,
@@ -146,7 +152,7 @@ def create_config(args):
         records_batch_size=train_batch_size // PREBATCH_SIZE,
     )
 
-    eval_spec_input_fn = eval_input_fn(
+    eval_spec_input_fn = eval_input_fn_(
         num_devices=num_devices,
         id=device_id,
         repeat=None if args.benchmark else 1,
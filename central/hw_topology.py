@@ -0,0 +1,211 @@
+###############################################################################
+# Copyright (C) 2021 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Host CPU topology for process binding
+
+Reads sockets, physical cores, SMT siblings and NUMA nodes from sysfs once and
+derives the mpirun binding options and the per-rank core sets used by the
+TensorFlow and PyTorch launchers.
+"""
+
+import os
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+SYSFS_ROOT = "/sys/devices/system"
+
+# cores: tuples of the SMT sibling CPUs of every physical core, ordered by NUMA node
+# numa_nodes: NUMA node id -> list of the cores (sibling tuples) of that node
+CpuTopology = namedtuple("CpuTopology", ["sockets", "cores", "numa_nodes"])
+
+# compute_cpus: one CPU per physical core of the rank
+# dataloader_cpus: CPUs left for the data loader workers of the rank
+RankCpuBinding = namedtuple("RankCpuBinding", ["local_rank", "numa_node", "compute_cpus", "dataloader_cpus"])
+
+
+def parse_cpu_list(cpu_list):
+    """ Parses a sysfs CPU list such as "0-3,8,10-11" into a list of CPU ids.
+    """
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read(path, default=None):
+    try:
+        return Path(path).read_text().strip()
+    except OSError:
+        return default
+
+
+@lru_cache()
+def get_cpu_topology(sysfs_root=SYSFS_ROOT):
+    """ Returns the CpuTopology of this host, read from sysfs on the first call only.
+    """
+    cpu_dir = Path(sysfs_root, "cpu")
+    online = _read(cpu_dir.joinpath("online"))
+    cpus = parse_cpu_list(online) if online else list(range(os.cpu_count()))
+
+    online_cpus = set(cpus)
+    packages = set()
+    siblings_of = {}
+    for cpu in cpus:
+        topology_dir = cpu_dir.joinpath(f"cpu{cpu}", "topology")
+        packages.add(_read(topology_dir.joinpath("physical_package_id"), "0"))
+        siblings = _read(topology_dir.joinpath("thread_siblings_list"))
+        # only keep the siblings that are online
+        siblings_of[cpu] = tuple(c for c in parse_cpu_list(siblings) if c in online_cpus) if siblings else (cpu,)
+
+    cpu_to_node = {}
+    for node_dir in sorted(Path(sysfs_root, "node").glob("node[0-9]*")):
+        node_cpus = _read(node_dir.joinpath("cpulist"))
+        for cpu in parse_cpu_list(node_cpus) if node_cpus else []:
+            cpu_to_node[cpu] = int(node_dir.name[len("node"):])
+
+    numa_nodes = {}
+    for core in sorted(set(siblings_of.values())):
+        numa_nodes.setdefault(cpu_to_node.get(core[0], 0), []).append(core)
+    cores = [core for node in sorted(numa_nodes) for core in numa_nodes[node]]
+    return CpuTopology(sockets=len(packages), cores=cores, numa_nodes=numa_nodes)
+
+
+def get_cores_per_rank(num_local_ranks, topology=None):
+    """ Returns the number of physical cores available to each of the local ranks.
+    """
+    topology = topology or get_cpu_topology()
+    return len(topology.cores) // num_local_ranks
+
+
+def get_mpi_map_by(map_by, num_local_ranks, topology=None):
+    """ Returns the mpirun --map-by value for the local ranks, or '' if there are too few cores.
+
+        "socket" and "slot" keep their OpenMPI meaning with PE set to the physical cores per rank.
+        "numa" places the same number of ranks on every NUMA node, so that a rank, its memory and
+        its data loader workers stay on one node; it falls back to "socket" when the ranks cannot
+        be spread evenly over the NUMA nodes.
+    """
+    topology = topology or get_cpu_topology()
+    pe = get_cores_per_rank(num_local_ranks, topology)
+    if pe <= 0:
+        return ''
+    if map_by == "numa":
+        num_nodes = len(topology.numa_nodes)
+        if num_local_ranks % num_nodes == 0:
+            return f"ppr:{num_local_ranks // num_nodes}:numa:PE={pe}"
+        map_by = "socket"
+    return f"{map_by}:PE={pe}"
+
+
+def _split_rank_cores(local_rank, node, rank_cores, dataloader_cores_per_rank):
+    """ Splits the cores (sibling tuples) of a rank into its compute and data loader CPUs.
+
+        By default the SMT siblings of a rank's cores are left to its data loader workers, or,
+        without SMT, the workers share the rank's cores. With dataloader_cores_per_rank, that many
+        physical cores (with their siblings) are instead taken off the end of the rank's cores for
+        the workers.
+    """
+    if dataloader_cores_per_rank:
+        num_compute = max(1, len(rank_cores) - dataloader_cores_per_rank)
+        compute_cpus = [core[0] for core in rank_cores[:num_compute]]
+        dataloader_cpus = [cpu for core in rank_cores[num_compute:] for cpu in core]
+    else:
+        compute_cpus = [core[0] for core in rank_cores]
+        dataloader_cpus = [cpu for core in rank_cores for cpu in core[1:]]
+    return RankCpuBinding(local_rank, node, compute_cpus, dataloader_cpus or list(compute_cpus))
+
+
+def get_rank_cpu_bindings(num_local_ranks, dataloader_cores_per_rank=None, topology=None):
+    """ Splits the cores of the host into NUMA-local core sets, one per local rank.
+
+        The ranks are spread evenly over the NUMA nodes in contiguous blocks and every node's cores
+        are split evenly among its ranks. This is where mpirun places the ranks with the "numa"
+        mapping (ppr:N:numa), but not with "socket", which places them round-robin over the
+        sockets; ranks bound by mpirun use get_rank_cpu_binding with their affinity instead.
+        See _split_rank_cores for the data loader CPUs.
+    """
+    topology = topology or get_cpu_topology()
+    nodes = sorted(topology.numa_nodes)
+    bindings = []
+    for local_rank in range(num_local_ranks):
+        # contiguous blocks of ranks per node, so that neighbouring ranks share a node
+        node = nodes[local_rank * len(nodes) // num_local_ranks]
+        node_ranks = [r for r in range(num_local_ranks) if nodes[r * len(nodes) // num_local_ranks] == node]
+        node_cores = topology.numa_nodes[node]
+        index = node_ranks.index(local_rank)
+        rank_cores = node_cores[index * len(node_cores) // len(node_ranks):
+                                (index + 1) * len(node_cores) // len(node_ranks)] or node_cores
+        bindings.append(_split_rank_cores(local_rank, node, rank_cores, dataloader_cores_per_rank))
+    return bindings
+
+
+def get_rank_cpu_binding(local_rank, cpus, dataloader_cores_per_rank=None, topology=None):
+    """ Splits the CPUs a rank is bound to, e.g. by mpirun --bind-to core, into its compute and
+        data loader CPUs, whatever the mapping that placed it. The physical cores of the CPUs are
+        taken with all their SMT siblings, see _split_rank_cores.
+    """
+    topology = topology or get_cpu_topology()
+    cpus = set(cpus)
+    rank_cores = [core for core in topology.cores if cpus.intersection(core)]
+    node = next(node for node, node_cores in sorted(topology.numa_nodes.items()) if rank_cores[0] in node_cores)
+    return _split_rank_cores(local_rank, node, rank_cores, dataloader_cores_per_rank)
+
+
+def get_local_rank_and_size():
+    """ Returns (local_rank, num_local_ranks) of the calling process from the environment set by
+        mpirun or torch.distributed, or None outside of a multi-process launch.
+    """
+    for rank_var, size_var in (("OMPI_COMM_WORLD_LOCAL_RANK", "OMPI_COMM_WORLD_LOCAL_SIZE"),
+                               ("LOCAL_RANK", "LOCAL_WORLD_SIZE")):
+        if rank_var in os.environ and size_var in os.environ:
+            return int(os.environ[rank_var]), int(os.environ[size_var])
+    return None
+
+
+def _get_binding(local_rank, num_local_ranks, dataloader_cores_per_rank, topology=None):
+    if local_rank is None:
+        local_ranks = get_local_rank_and_size()
+        if local_ranks is None:
+            return None
+        local_rank, num_local_ranks = local_ranks
+    topology = topology or get_cpu_topology()
+    affinity = os.sched_getaffinity(0)
+    if affinity < {cpu for core in topology.cores for cpu in core}:
+        # bound by the launcher: keep to its cores, which only it knows for the socket mapping
+        return get_rank_cpu_binding(local_rank, affinity, dataloader_cores_per_rank, topology)
+    return get_rank_cpu_bindings(num_local_ranks, dataloader_cores_per_rank, topology)[local_rank]
+
+
+def bind_dataloader_worker(local_rank=None, num_local_ranks=None, dataloader_cores_per_rank=None):
+    """ Pins the calling process (e.g. from a data loader worker_init_fn) to the data loader
+        CPUs of local_rank, by default the local rank of the launch environment. If the process
+        is bound to a part of the host, as by mpirun, they are taken from the cores it is bound to.
+
+        Returns the RankCpuBinding, or None without a local rank, in which case nothing is pinned.
+    """
+    binding = _get_binding(local_rank, num_local_ranks, dataloader_cores_per_rank)
+    if binding is not None:
+        os.sched_setaffinity(0, binding.dataloader_cpus)
+    return binding
+
+
+def bind_rank(local_rank=None, num_local_ranks=None, dataloader_cores_per_rank=None):
+    """ Pins the calling process and its future threads to the compute and data loader CPUs of
+        local_rank, for frameworks running their input pipeline on threads of the rank's process
+        (e.g. the tf.data private thread pool), which cannot be pinned separately. A process bound
+        by mpirun stays on the cores it is bound to, extended with their SMT siblings.
+
+        Returns the RankCpuBinding, or None without a local rank, in which case nothing is pinned.
+    """
+    binding = _get_binding(local_rank, num_local_ranks, dataloader_cores_per_rank)
+    if binding is not None:
+        os.sched_setaffinity(0, sorted(set(binding.compute_cpus) | set(binding.dataloader_cpus)))
+    return binding
@@ -0,0 +1,79 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Tests of central.hw_topology, run from the repository root with
+python -m unittest central.hw_topology_test"""
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from central import hw_topology
+
+
+def write_sysfs(root, sockets=2, cores_per_socket=4):
+    """Writes the sysfs files of a host with one NUMA node per socket and 2 SMT siblings per core,
+    CPU c and c + number of cores being the siblings of core c."""
+    num_cores = sockets * cores_per_socket
+    cpu_dir = Path(root, "cpu")
+    cpu_dir.mkdir(parents=True)
+    cpu_dir.joinpath("online").write_text(f"0-{2 * num_cores - 1}\n")
+    for cpu in range(2 * num_cores):
+        core = cpu % num_cores
+        topology_dir = cpu_dir.joinpath(f"cpu{cpu}", "topology")
+        topology_dir.mkdir(parents=True)
+        topology_dir.joinpath("physical_package_id").write_text(f"{core // cores_per_socket}\n")
+        topology_dir.joinpath("thread_siblings_list").write_text(f"{core},{core + num_cores}\n")
+    for node in range(sockets):
+        node_dir = Path(root, "node", f"node{node}")
+        node_dir.mkdir(parents=True)
+        first, last = node * cores_per_socket, (node + 1) * cores_per_socket - 1
+        node_dir.joinpath("cpulist").write_text(f"{first}-{last},{first + num_cores}-{last + num_cores}\n")
+
+
+class RankCpuBindingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        write_sysfs(self.tmp_dir.name)
+        self.topology = hw_topology.get_cpu_topology(self.tmp_dir.name)
+        self.addCleanup(hw_topology.get_cpu_topology.cache_clear)
+
+    def get_binding(self, local_rank, affinity, dataloader_cores_per_rank=None):
+        with mock.patch("os.sched_getaffinity", return_value=set(affinity)):
+            return hw_topology._get_binding(local_rank, 4, dataloader_cores_per_rank, self.topology)
+
+    def test_topology(self):
+        self.assertEqual(self.topology.sockets, 2)
+        self.assertEqual(self.topology.numa_nodes[1], [(4, 12), (5, 13), (6, 14), (7, 15)])
+
+    def test_unbound_rank(self):
+        binding = self.get_binding(1, range(16))
+        self.assertEqual(binding, hw_topology.RankCpuBinding(1, 0, [2, 3], [10, 11]))
+
+    def test_socket_mapped_rank(self):
+        # --map-by socket:PE=2 places rank 1 on the second socket
+        binding = self.get_binding(1, [4, 5, 12, 13])
+        self.assertEqual(binding, hw_topology.RankCpuBinding(1, 1, [4, 5], [12, 13]))
+
+    def test_bound_to_first_siblings_only(self):
+        binding = self.get_binding(1, [4, 5])
+        self.assertEqual(binding, hw_topology.RankCpuBinding(1, 1, [4, 5], [12, 13]))
+
+    def test_dataloader_cores_of_bound_rank(self):
+        binding = self.get_binding(3, [6, 7, 14, 15], dataloader_cores_per_rank=1)
+        self.assertEqual(binding, hw_topology.RankCpuBinding(3, 1, [6], [7, 15]))
+
+    def test_bind_rank(self):
+        with mock.patch("os.sched_getaffinity", return_value={4, 5, 12, 13}), \
+                mock.patch("os.sched_setaffinity") as sched_setaffinity, \
+                mock.patch.object(hw_topology, "get_cpu_topology", return_value=self.topology):
+            hw_topology.bind_rank(local_rank=1, num_local_ranks=4)
+        sched_setaffinity.assert_called_once_with(0, [4, 5, 12, 13])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,8 @@ import os
 import socket
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from pathlib import Path
 
@@ -104,6 +106,67 @@ def run_per_ip(cmd, env_vars_for_mpi=None, use_devnull=False, kubernetes_run=Fal
         run_cmd_as_subprocess(scmd, use_devnull)
 
 
+# Host names that are treated as the local host by run_per_ip_concurrently(), so
+# the fan-out can be exercised on a single machine, e.g. MULTI_HLS_IPS=127.0.0.1,localhost
+LOOPBACK_HOSTS = ["localhost", "127.0.0.1", "::1"]
+
+
+def _run_on_ip(ip, cmd, env_vars_for_mpi, timeout, use_devnull):
+    if ip in LOOPBACK_HOSTS:
+        args = ["/bin/bash", "-c", cmd]
+    else:
+        portnum = os.environ.get('DOCKER_SSHD_PORT', str(3022))
+        args = ["mpirun", "--allow-run-as-root", "--mca", "plm_rsh_args", f"-p{portnum}",
+                "--mca", "btl_tcp_if_include", get_mpi_tcp_include(verbose=False),
+                "--tag-output", "--merge-stderr-to-stdout", "--prefix", str(os.environ.get('MPI_ROOT')),
+                "-H", ip, "-np", "1"]
+        for env_var in env_vars_for_mpi or []:
+            if env_var in os.environ:
+                args += ["-x", env_var]
+        args += ["/bin/bash", "-c", cmd]
+
+    output = subprocess.DEVNULL if use_devnull else None
+    start = time.perf_counter()
+    try:
+        returncode = subprocess.run(args, stdout=output, stderr=output, timeout=timeout).returncode
+        status = "ok" if returncode == 0 else f"exit code {returncode}"
+    except subprocess.TimeoutExpired:
+        status = f"timed out after {timeout}s"
+    return status, time.perf_counter() - start
+
+
+def run_per_ip_concurrently(cmd, env_vars_for_mpi=None, use_devnull=False, timeout=None):
+    """ Runs "cmd" on every host in MULTI_HLS_IPS at the same time, with one launcher per host.
+
+        Unlike run_per_ip(), every host gets its own launcher process, so a slow or hung host only
+        costs its own "timeout" (in seconds) and the wall time is that of the slowest host.
+        Returns a dictionary of host -> (status, seconds), prints the per-host timing and raises
+        RuntimeError if "cmd" failed or timed out on any host.
+    """
+    if os.environ.get('OMPI_COMM_WORLD_SIZE') is not None:
+        raise RuntimeError(
+            "Function run_per_ip_concurrently is not meant to be run from within an OpenMPI context. It is intended to invoke mpirun by itelf.")
+
+    nodes = get_multi_node_config_nodes()
+    if not nodes:
+        nodes = [LOOPBACK_HOSTS[0]]
+    print(f"{socket.gethostname()}: In run_per_ip_concurrently(): cmd = {cmd}")
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        futures = {ip: executor.submit(_run_on_ip, ip, cmd, env_vars_for_mpi, timeout, use_devnull)
+                   for ip in nodes}
+        results = {ip: future.result() for ip, future in futures.items()}
+
+    for ip, (status, elapsed) in results.items():
+        print(f"{ip}: {status} in {elapsed:.2f}s")
+    failed = [ip for ip, (status, _) in results.items() if status != "ok"]
+    if failed:
+        raise RuntimeError(f"Command failed on {failed}: {cmd}")
+    return results
+
+
 # Generate the MPI hostfile
 def generate_mpi_hostfile(file_path, devices_per_hls=8):
     mpi_hostfile_path = ''
@@ -0,0 +1,62 @@
+###############################################################################
+# Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
+###############################################################################
+
+"""Tests of central.multi_node_utils, run from the repository root with
+python -m unittest central.multi_node_utils_test"""
+
+import os
+import shlex
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from central.multi_node_utils import LOOPBACK_HOSTS, run_per_ip_concurrently
+
+
+class RunPerIpConcurrentlyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="multi node ")
+        env = {"MULTI_HLS_IPS": ",".join(LOOPBACK_HOSTS[:2])}
+        self.env = mock.patch.dict(os.environ, env)
+        self.env.start()
+        os.environ.pop("OMPI_COMM_WORLD_SIZE", None)
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def test_runs_on_every_host(self):
+        out_dir = os.path.join(self.tmp_dir.name, "out dir")
+        results = run_per_ip_concurrently(
+            f"mkdir -p {shlex.quote(out_dir)} && touch {shlex.quote(out_dir)}/$$", use_devnull=True)
+        self.assertEqual(sorted(results), sorted(LOOPBACK_HOSTS[:2]))
+        self.assertTrue(all(status == "ok" for status, _ in results.values()))
+        # One process per host
+        self.assertEqual(len(os.listdir(out_dir)), 2)
+
+    def test_hosts_run_at_the_same_time(self):
+        start = time.perf_counter()
+        results = run_per_ip_concurrently("sleep 1", use_devnull=True)
+        self.assertLess(time.perf_counter() - start, 1.9)
+        self.assertTrue(all(elapsed >= 1 for _, elapsed in results.values()))
+
+    def test_failure(self):
+        with self.assertRaises(RuntimeError):
+            run_per_ip_concurrently("exit 3", use_devnull=True)
+
+    def test_timeout(self):
+        start = time.perf_counter()
+        with self.assertRaises(RuntimeError):
+            run_per_ip_concurrently("sleep 10", use_devnull=True, timeout=0.5)
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_openmpi_context(self):
+        with mock.patch.dict(os.environ, {"OMPI_COMM_WORLD_SIZE": "2"}):
+            with self.assertRaises(RuntimeError):
+                run_per_ip_concurrently("true")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,19 +10,22 @@ run hardware constraints for scaleout.
 import os
 import sys
 import shlex
-import subprocess
 from pathlib import Path
 
 import central.generate_hcl_config as generate_hcl_config
+import central.hw_topology as hw_topology
 from central.multi_node_utils import (generate_mpi_hostfile,
                                       get_mpi_tcp_include,
                                       get_relevant_env_vars,
                                       print_file_contents, run_per_ip,
+                                      run_per_ip_concurrently,
                                       is_valid_multi_node_config,
                                       get_multi_node_config_nodes)
 
-ALLOWED_MPI_MAP_BY = ["socket", "slot", "none", ""]
+ALLOWED_MPI_MAP_BY = ["socket", "slot", "numa", "none", ""]
 DEFAULT_MPI_MAP_BY = ALLOWED_MPI_MAP_BY[0]
+# Seconds each node may spend on its Multi-HLS setup, overridable by MULTI_HLS_SETUP_TIMEOUT
+DEFAULT_MULTI_HLS_SETUP_TIMEOUT = 300
 
 
 class TrainingRunHWConfig():
@@ -34,6 +37,7 @@ class TrainingRunHWConfig():
         self.output_filename = output_filename
         self.hls_ips = ''
         self.mpirun_cmd = ''
+        self.node_setup_times = {}
 
         self.num_workers_total = self.num_workers_per_hls
 
@@ -68,8 +72,10 @@ class TrainingRunHWConfig():
         if not self.kubernetes_run:
             assert self.scaleout and self.num_workers_per_hls > 1, "Scaleout run requires at least 2 workers"
         tmp_dir = Path(os.path.expandvars(os.path.expanduser("$HOME/tmp/")))
-        run_per_ip(f"mkdir -p {str(tmp_dir)}",
-                   ['MULTI_HLS_IPS', 'PYTHONPATH'], False, self.kubernetes_run)
+        # The Multi-HLS setup creates tmp_dir together with the rest of the per-node preparation
+        if self.kubernetes_run or not is_valid_multi_node_config():
+            run_per_ip(f"mkdir -p {str(tmp_dir)}",
+                       ['MULTI_HLS_IPS', 'PYTHONPATH'], False, self.kubernetes_run)
         hcl_config_path = ''
 
         if self.kubernetes_run:
@@ -115,24 +121,12 @@ class TrainingRunHWConfig():
         mpi_cmd += f" --tag-output --merge-stderr-to-stdout --output-filename {output_file_name}"
 
         if mpi_map_by not in ["none", ""]:
-            # Get lscpu
-            cmd = 'lscpu | grep \"CPU(s):\"'
-            lscpu_output = []
-            with subprocess.Popen(cmd, shell=True, executable='/bin/bash', stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env={"LD_PRELOAD": ""}) as proc:
-                lscpu_output = proc.stdout.read()
-            # Determine the optimal value of resources per process of OpenMPI binding based on local lscpu.
-            if mpi_map_by == "socket":
-                mpi_map_by_pe = int(lscpu_output.split()[
-                                    1])//self.num_workers_per_hls//2
-            else:
-                assert mpi_map_by == "slot"
-                mpi_map_by_pe = int(lscpu_output.split()[
-                                    1])//self.num_workers_per_hls
-
-            print(f"mpi_map_by_pe = {mpi_map_by_pe}")
-
-            if mpi_map_by_pe > 0:
-                mpi_cmd += f" --bind-to core --map-by {mpi_map_by}:PE={mpi_map_by_pe}"
+            # Determine the resources per process of OpenMPI binding based on the local CPU topology.
+            mpi_map_by_value = hw_topology.get_mpi_map_by(mpi_map_by, self.num_workers_per_hls)
+            print(f"mpi_map_by = {mpi_map_by_value}")
+
+            if mpi_map_by_value:
+                mpi_cmd += f" --bind-to core --map-by {mpi_map_by_value}"
 
         return mpi_cmd
 
@@ -156,9 +150,13 @@ class TrainingRunHWConfig():
         # Multi-HLS Mode
         #
         gen_hcl_path = Path(__file__).parent.joinpath('generate_hcl_config.py')
-        # Create HCL config on each remote IP.
-        run_per_ip(f"{sys.executable} {str(gen_hcl_path)} {str(tmp_dir)} {self.num_workers_per_hls} {self.hls_type}", [
-                   'MULTI_HLS_IPS', 'PYTHONPATH', 'HOROVOD_HIERARCHICAL_ALLREDUCE'], False)
+        # Create tmp_dir and the HCL config on all remote IPs at once.
+        setup_timeout = float(os.environ.get(
+            'MULTI_HLS_SETUP_TIMEOUT', DEFAULT_MULTI_HLS_SETUP_TIMEOUT))
+        self.node_setup_times = {
+            ip: elapsed for ip, (_, elapsed) in run_per_ip_concurrently(
+                f"mkdir -p {shlex.quote(str(tmp_dir))} && {shlex.quote(sys.executable)} {shlex.quote(str(gen_hcl_path))} {shlex.quote(str(tmp_dir))} {self.num_workers_per_hls} {shlex.quote(self.hls_type)}",
+                ['MULTI_HLS_IPS', 'PYTHONPATH', 'HOROVOD_HIERARCHICAL_ALLREDUCE'], False, setup_timeout).items()}
 
         # Set HCL_CONFIG_PATH in this script, so it can be propagated in self.mpirun_cmd to remote IPs.
         hcl_config_path = generate_hcl_config.generate_hcl_config_unless_hccl(